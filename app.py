@@ -16,28 +16,65 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 from flask import Flask
 from flask import render_template
+from flask import Response
+from flask import request
 from simple_task_server import TaskManager
 from simple_task_server import Task
+from simple_task_server import OutputStore
+from simple_task_server import ID_GENERATORS
 from flask_restful import Resource, Api
 from flask_restful import reqparse
+from flask_restful import inputs
 from datetime import datetime
 from flask_bootstrap import Bootstrap
-import uuid
+import json
 import util
 import logging
 import argparse
+import atexit
+import threading
+import time
 
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 
-class TaskIDCreator:
+def parse_queue_weight(value):
+    """
+    A queue's weight given as name=weight, for the command line.
+    """
+    queue, _, weight = value.rpartition("=")
+    if not queue or float(weight) <= 0:
+        raise argparse.ArgumentTypeError("queue weights are given as name=weight with a weight above 0, not %s" % value)
+    return queue, float(weight)
+
+
+def parse_pool_limit(value):
+    """
+    A pool's limit given as name=limit, for the command line.
+    """
+    pool, _, limit = value.rpartition("=")
+    if not pool or int(limit) < 1:
+        raise argparse.ArgumentTypeError("pool limits are given as name=limit with a limit of at least 1, not %s" % value)
+    return pool, int(limit)
 
-    def __init__(self):
-        pass
 
-    def id(self):
-        return uuid.uuid1().hex
+def parse_fraction(value):
+    """
+    A part of something, from 0 to 1.
+    """
+    fraction = float(value)
+    if not 0 <= fraction <= 1:
+        raise ValueError("%s is not from 0 to 1" % value)
+    return fraction
+
+
+def parse_time(value):
+    """
+    Times are given as "%Y-%m-%d %H:%M:%S" with optional fractional seconds; a T can separate the date and time.
+    """
+    value = value.replace("T", " ")
+    return datetime.strptime(value, TIME_FORMAT + (".%f" if "." in value else ""))
 
 
 errors = {
@@ -51,12 +88,41 @@ app = Flask(__name__)
 Bootstrap(app)
 api = Api(app, catch_all_404s=True, errors=errors)
 
-task_id_creator = TaskIDCreator()
+# tasks and attempts get their ids from the same generator
+id_generator = ID_GENERATORS["uuid"]()
+
+
+def parse_id(value):
+    return id_generator.parse(value)
+
 
 log_file_name = util.time_stamped_file_name("stq")
 logger = util.basic_logger(log_file_name, file_level=logging.DEBUG, console_level=logging.DEBUG)
 
-task_manager = TaskManager(logger)
+task_manager = TaskManager(logger, attempt_ids=id_generator)
+output_store = OutputStore(logger)
+# requests and the background compactor take turns with the tasks
+task_lock = threading.Lock()
+
+
+@app.before_request
+def lock_tasks():
+    task_lock.acquire()
+
+
+@app.teardown_request
+def unlock_tasks(exception=None):
+    task_lock.release()
+
+
+def forget_tasks(tasks):
+    """
+    Drops what the server keeps for deleted tasks outside of the task manager: attempt output and dashboard rows.
+    """
+    for task in tasks:
+        for attempt_id in task.attempt_ids():
+            output_store.remove(attempt_id)
+        row_cache.remove(task.task_id())
 
 task_post_parser = reqparse.RequestParser()
 task_post_parser.add_argument('command', dest='command', required=True,
@@ -69,23 +135,99 @@ task_post_parser.add_argument('duration', dest='duration', required=False, type=
                               help='how long, in seconds, the task should run before a new attempt is made. Microseconds are defined to the right of the decimal (optional, with default of no applied duration).')
 task_post_parser.add_argument('max_attempts', dest='max_attempts', required=False, type=int,
                               help="The max amount of times you want to try to attempt to run the task (optional, with default of 1)")
-task_post_parser.add_argument('dependent_on', dest='dependent_on', required=False, action='append',
+task_post_parser.add_argument('dependent_on', dest='dependent_on', type=parse_id, required=False, action='append',
                               help="the ID of a task that this task is dependent upon (optional, can be multiple).")
+task_post_parser.add_argument('labels', dest='labels', required=False, action='append',
+                              help="a label a runner must have to attempt the task (optional, can be multiple).")
+task_post_parser.add_argument('queue', dest='queue', required=False,
+                              help="the name of the queue the task waits in; queues share runners by weight (optional, with default of \"default\").")
+task_post_parser.add_argument('pool', dest='pool', required=False,
+                              help="the concurrency pool the task's attempts count against (optional).")
+task_post_parser.add_argument('not_before', dest='not_before', type=parse_time, required=False,
+                              help='no attempt is made before this time, as YYYY-MM-DD HH:MM:SS (optional).')
+task_post_parser.add_argument('expires_at', dest='expires_at', type=parse_time, required=False,
+                              help='if no attempt has been made by this time, as YYYY-MM-DD HH:MM:SS, the task is cancelled (optional).')
+task_post_parser.add_argument('retry_delay', dest='retry_delay', type=float, required=False,
+                              help='seconds to wait before retrying after the first failed attempt (optional, with default of retrying right away).')
+task_post_parser.add_argument('retry_multiplier', dest='retry_multiplier', type=float, required=False, default=2.0,
+                              help='how many times longer each failure after the first waits (optional, with default of 2).')
+task_post_parser.add_argument('retry_max_delay', dest='retry_max_delay', type=float, required=False,
+                              help='the most seconds to wait before a retry (optional, with default of no max).')
+task_post_parser.add_argument('retry_jitter', dest='retry_jitter', type=parse_fraction, required=False, default=0.0,
+                              help='up to this part (0 to 1) of each wait is randomly taken off (optional, with default of 0).')
+task_post_parser.add_argument('cache_key', dest='cache_key', required=False,
+                              help='tasks with the same cache key share results when the server caches them (optional).')
+task_post_parser.add_argument('cache', dest='cache', type=inputs.boolean, required=False, default=False,
+                              help='use a hash of the command as the cache key (optional, with default of false).')
+task_post_parser.add_argument('idempotency_key', dest='idempotency_key', required=False,
+                              help='a task posted again with the same key is not added twice; the task already added is returned instead. Can also be given as an Idempotency-Key header (optional).')
 
 task_delete_parser = reqparse.RequestParser()
-task_delete_parser.add_argument("task_id", dest="task_id", required=True, help="ID of Task to be deleted.")
+task_delete_parser.add_argument("task_id", dest="task_id", type=parse_id, required=True, help="ID of Task to be deleted.")
 
 get_next_attempt = reqparse.RequestParser()
 get_next_attempt.add_argument('runner_id', dest='runner_id', required=True,
                               help='The unique identifier of the runner.')
+get_next_attempt.add_argument('labels', dest='labels', required=False, action='append',
+                              help='A label the runner has, such as a capability or installed software (optional, can be multiple).')
 
 attempt_update = reqparse.RequestParser()
 attempt_update.add_argument('runner_id', dest='runner_id', required=True, help='The unique identifier of the runner.')
-attempt_update.add_argument('task_id', dest='task_id', required=True, help='The unique identifier of the task being attempted.')
-attempt_update.add_argument('attempt_id', dest='attempt_id', required=True, help='The unique identifier of the attempt.')
+attempt_update.add_argument('task_id', dest='task_id', type=parse_id, required=True, help='The unique identifier of the task being attempted.')
+attempt_update.add_argument('attempt_id', dest='attempt_id', type=parse_id, required=True, help='The unique identifier of the attempt.')
 attempt_update.add_argument('status', dest='status', required=True, help='Status of attempt: "failed" or "completed".')
 attempt_update.add_argument('message', dest='message', required=False, help='Status of attempt: "failed" or "completed".')
 
+heartbeat_parser = reqparse.RequestParser()
+heartbeat_parser.add_argument('runner_id', dest='runner_id', required=True, help='The unique identifier of the runner.')
+heartbeat_parser.add_argument('task_id', dest='task_id', type=parse_id, required=True, action='append',
+                              help='The unique identifier of a task being attempted (can be multiple, paired in order with attempt_id).')
+heartbeat_parser.add_argument('attempt_id', dest='attempt_id', type=parse_id, required=True, action='append',
+                              help='The unique identifier of an attempt still running (can be multiple).')
+
+output_post_parser = reqparse.RequestParser()
+output_post_parser.add_argument('runner_id', dest='runner_id', required=True, help='The unique identifier of the runner.')
+output_post_parser.add_argument('task_id', dest='task_id', type=parse_id, required=True, help='The unique identifier of the task being attempted.')
+output_post_parser.add_argument('attempt_id', dest='attempt_id', type=parse_id, required=True, help='The unique identifier of the attempt.')
+output_post_parser.add_argument('data', dest='data', required=True, help='The next chunk of the attempt\'s output.')
+
+output_get_parser = reqparse.RequestParser()
+output_get_parser.add_argument('task_id', dest='task_id', type=parse_id, required=True, help='The unique identifier of the task.')
+output_get_parser.add_argument('attempt_id', dest='attempt_id', type=parse_id, required=True, help='The unique identifier of the attempt.')
+
+changes_parser = reqparse.RequestParser()
+changes_parser.add_argument('since', dest='since', type=int, required=False, default=0,
+                            help='Sequence number of the last change already seen (optional, with default of 0).')
+changes_parser.add_argument('limit', dest='limit', type=int, required=False, default=1000,
+                            help='The max number of changes to return (optional, with default of 1000).')
+changes_parser.add_argument('epoch', dest='epoch', required=False,
+                            help='The epoch returned with the previous changes. If the server has restarted since, a resync is needed (optional).')
+
+query_parser = reqparse.RequestParser()
+query_parser.add_argument('name', dest='name', required=False, help='Only tasks with this name (optional).')
+query_parser.add_argument('runner_id', dest='runner_id', required=False, help='Only tasks attempted by this runner (optional).')
+query_parser.add_argument('created_after', dest='created_after', type=parse_time, required=False,
+                          help='Only tasks created at or after this time, as YYYY-MM-DD HH:MM:SS (optional).')
+query_parser.add_argument('created_before', dest='created_before', type=parse_time, required=False,
+                          help='Only tasks created before this time, as YYYY-MM-DD HH:MM:SS (optional).')
+query_parser.add_argument('command_prefix', dest='command_prefix', required=False,
+                          help='Only tasks whose command starts with this (optional).')
+query_parser.add_argument('cursor', dest='cursor', required=False,
+                          help='The cursor returned with the previous page (optional).')
+query_parser.add_argument('limit', dest='limit', type=int, required=False, default=100,
+                          help='The max number of tasks to return, up to 1000 (optional, with default of 100).')
+
+bulk_delete_parser = query_parser.copy()
+bulk_delete_parser.replace_argument('limit', dest='limit', type=int, required=False, default=1000,
+                                    help='The max number of tasks to look at, up to 10000 (optional, with default of 1000).')
+bulk_delete_parser.add_argument('list', dest='list_types', action='append', choices=TaskManager.LIST_TYPES,
+                                required=False, help='Only tasks in this list; can be given more than once (optional).')
+
+pool_put_parser = reqparse.RequestParser()
+pool_put_parser.add_argument('pool', dest='pool', required=True, help='The name of the concurrency pool.')
+pool_put_parser.add_argument('limit', dest='limit', type=inputs.positive, required=True,
+                             help='The max number of attempts in the pool that can run at once.')
+
 
 # a wrapper that creates a Resource to interact with TaskManager and does some JSON/restful specific stuff
 class TaskManagement(Resource):
@@ -96,22 +238,38 @@ class TaskManagement(Resource):
     def post(self):
         args = task_post_parser.parse_args()
         self._logger.info("TaskManagement.post: %s" % str(args))
-        task = Task(task_id_creator.id(),
+        task = Task(id_generator.next_id(),
                     args.command,
                     datetime.now(),
                     name=args.name if args.name is not None else "",
                     desc=args.description if args.description is not None else "",
                     duration=args.duration,
                     max_attempts=args.max_attempts if args.max_attempts is not None else 1,
-                    dependent_on=args.dependent_on)
-        task_manager.add_task(task)
+                    dependent_on=args.dependent_on,
+                    labels=args.labels,
+                    queue=args.queue if args.queue else "default",
+                    pool=args.pool,
+                    not_before=args.not_before,
+                    expires_at=args.expires_at,
+                    retry_delay=args.retry_delay,
+                    retry_multiplier=args.retry_multiplier,
+                    retry_max_delay=args.retry_max_delay,
+                    retry_jitter=args.retry_jitter,
+                    # an empty cache key is no key, or every task posted with one would share its results
+                    cache_key=args.cache_key or (Task.command_cache_key(args.command) if args.cache else None))
+        idempotency_key = args.idempotency_key or request.headers.get("Idempotency-Key")
+        added = task_manager.add_task(task, idempotency_key=idempotency_key)
+        if added is not task:
+            return added.to_json(), 200
         return task.to_json(), 201
 
     def delete(self):
         args = task_delete_parser.parse_args()
         self._logger.info("TaskManagement.delete: %s" % str(args))
+        task = task_manager.task(args.task_id)
         deleted = task_manager.delete_task(args.task_id)
         if deleted:
+            forget_tasks([task])
             return {"status": "task deleted", "task_id": args.task_id}, 200
         else:
             return {"message": "task for %s not found, cannot delete" % args.task_id}, 400
@@ -135,7 +293,7 @@ class AttemptManagement(Resource):
         args = get_next_attempt.parse_args()
         self._logger.info("AttemptManagement.get: %s" % str(args))
         current_time = datetime.now()
-        task, attempt = task_manager.start_next_attempt(args.runner_id, current_time)
+        task, attempt = task_manager.start_next_attempt(args.runner_id, current_time, labels=args.labels)
         if task is not None:
             json_dict = self._task_attempt_json(task, attempt)
             self._logger.info("AttemptManagement.get next attempt: %s" % str(json_dict))
@@ -148,17 +306,236 @@ class AttemptManagement(Resource):
     def put(self):
         args = attempt_update.parse_args()
         self._logger.info("AttemptManagement.put: %s" % str(args))
+        task_manager.runner_seen(args.runner_id, datetime.now())
         status = args.status.lower()
         if status == "failed":
-            task_manager.fail_attempt(args.task_id, args.attempt_id, "client reported")
+            task_manager.fail_attempt(args.task_id, args.attempt_id,
+                                      args.message if args.message is not None else "client reported",
+                                      time_stamp=datetime.now())
         elif status == "completed":
             task_manager.complete_attempt(args.task_id, args.attempt_id, datetime.now())
         else:
-            task_manager.fail_attempt(args.task_id, args.attempt_id, "unknown status reported")
+            task_manager.fail_attempt(args.task_id, args.attempt_id, "unknown status reported", time_stamp=datetime.now())
             # TODO log this
             return {"message": "%s is an unknown status. Should be 'completed' or 'failed'. Falling back to failed." % args.status}, 400
 
 
+class Heartbeat(Resource):
+    """
+    Runners heartbeat all of their running attempts in one request; each heartbeat pushes back that attempt's
+     timeout. Attempts the server no longer wants (task done, deleted or attempt already reported) are sent back in
+     "stop" so the runner can give up on them, as are attempts that belong to another runner, which aren't extended.
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def put(self):
+        args = heartbeat_parser.parse_args()
+        if len(args.task_id) != len(args.attempt_id):
+            return {"message": "task_id and attempt_id must be given in pairs."}, 400
+        current_time = datetime.now()
+        task_manager.runner_seen(args.runner_id, current_time)
+        stop = []
+        for task_id, attempt_id in zip(args.task_id, args.attempt_id):
+            if not task_manager.heartbeat(task_id, attempt_id, current_time, runner=args.runner_id):
+                stop.append(attempt_id)
+        return {"status": "ok", "stop": stop}, 200
+
+
+class OutputManagement(Resource):
+    """
+    Runners stream an attempt's output here in chunks. Only a bounded head and tail of each attempt's output is kept
+     (see OutputStore).
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def post(self):
+        args = output_post_parser.parse_args()
+        task = task_manager.task(args.task_id)
+        if task is None or task.get_attempt(args.attempt_id) is None:
+            return {"message": "attempt %s of task %s not found, output not stored" % (args.attempt_id, args.task_id)}, 404
+        output_store.append(args.attempt_id, args.data)
+        return {"status": "ok"}, 200
+
+    def get(self):
+        args = output_get_parser.parse_args()
+        task = task_manager.task(args.task_id)
+        output = None
+        if task is not None and task.get_attempt(args.attempt_id) is not None:
+            output = output_store.get(args.attempt_id)
+        if output is None:
+            return {"message": "no output for attempt %s of task %s" % (args.attempt_id, args.task_id)}, 404
+        output['head'] = output['head'].decode("utf-8", "replace")
+        output['tail'] = output['tail'].decode("utf-8", "replace")
+        output['task_id'] = args.task_id
+        output['attempt_id'] = args.attempt_id
+        return output, 200
+
+
+class TaskRowCache(object):
+    """
+    Keeps the JSON of each task's row in the task lists so that listing a task that hasn't changed is just joining
+     strings. A row is cached with a key of what it depends on (which list the task is in, its attempts, ...) and is
+     only rebuilt when that key changes.
+    """
+
+    def __init__(self):
+        self._rows = {}
+
+    def row(self, task, key, build_row):
+        cached = self._rows.get(task.task_id())
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        row = json.dumps(build_row(task))
+        self._rows[task.task_id()] = (key, row)
+        return row
+
+    def remove(self, task_id):
+        self._rows.pop(task_id, None)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+row_cache = TaskRowCache()
+# list versions and change numbers restart at 0 with the server, so etags and the change feed include when it started
+server_epoch = datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+class Changes(Resource):
+    """
+    A feed of task changes for keeping a copy of the queue's state in sync. Poll with since=<last_seq> and
+     epoch=<epoch> from the previous response. When "resync" is true the changes asked for are no longer kept (or
+     the server restarted): reload the task lists and carry on from the returned last_seq. To start, call this
+     first and then load the lists, so no change can fall between the two.
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def get(self):
+        args = changes_parser.parse_args()
+        events, resync, last_seq = task_manager.changes(args.since, limit=args.limit)
+        if args.epoch is not None and args.epoch != server_epoch:
+            events, resync = [], True
+        return {"epoch": server_epoch,
+                "events": events,
+                "resync": resync,
+                "last_seq": last_seq}, 200
+
+
+class Runners(Resource):
+    """
+    Every runner the server has heard from, when it was last seen, whether it is considered alive and the attempts it
+     has in flight.
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def get(self):
+        runners = []
+        for runner in task_manager.runners():
+            runners.append({"runner_id": runner["runner"],
+                            "last_seen": runner["last_seen"].strftime(TIME_FORMAT),
+                            "alive": runner["alive"],
+                            "attempts": [{"task_id": task_id, "attempt_id": attempt_id}
+                                         for task_id, attempt_id in runner["attempts"]]})
+        return {"runners": runners}, 200
+
+
+class QueryTasks(Resource):
+    """
+    Tasks in any list that match all of the given criteria, oldest first. When "cursor" in the response isn't null
+     there are more: ask again with it to get the next page.
+    """
+
+    MAX_LIMIT = 1000
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def get(self):
+        args = query_parser.parse_args()
+        try:
+            tasks, cursor = task_manager.query(name=args.name, runner=args.runner_id, created_after=args.created_after,
+                                               created_before=args.created_before,
+                                               command_prefix=args.command_prefix, cursor=args.cursor,
+                                               limit=max(1, min(args.limit, self.MAX_LIMIT)))
+        except ValueError:
+            return {"message": "Unknown cursor %s." % args.cursor}, 400
+        rows = []
+        for task, list_type in tasks:
+            row = task.to_json()
+            row["list"] = list_type
+            row["created"] = task.created_time.strftime(TIME_FORMAT)
+            rows.append(row)
+        return {"tasks": rows, "cursor": cursor}, 200
+
+
+class DeleteTasks(Resource):
+    """
+    Deletes every task matching all of the given criteria (the ones of /tasks/query plus list). At least one has to
+     be given. When "cursor" in the response isn't null there are more to look at: ask again with it.
+    """
+
+    MAX_LIMIT = 10000
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def delete(self):
+        args = bulk_delete_parser.parse_args()
+        self._logger.info("DeleteTasks.delete: %s" % str(args))
+        if all(args[key] is None for key in ("name", "runner_id", "created_after", "created_before", "command_prefix",
+                                             "list_types")):
+            return {"message": "No criteria given. Not deleting every task!"}, 400
+        try:
+            deleted, cursor = task_manager.delete_tasks(list_types=args.list_types, name=args.name,
+                                                        runner=args.runner_id, created_after=args.created_after,
+                                                        created_before=args.created_before,
+                                                        command_prefix=args.command_prefix, cursor=args.cursor,
+                                                        limit=max(1, min(args.limit, self.MAX_LIMIT)))
+        except ValueError:
+            return {"message": "Unknown cursor %s." % args.cursor}, 400
+        forget_tasks(deleted)
+        return {"deleted": [task.task_id() for task in deleted], "cursor": cursor}, 200
+
+
+class Pools(Resource):
+    """
+    The concurrency pools and, for operators, changing a pool's limit while the server runs. A pool's limit applies
+     to every task in it, so it isn't something a client adding a task gets to set.
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def get(self):
+        return task_manager.pool_stats(), 200
+
+    def put(self):
+        args = pool_put_parser.parse_args()
+        self._logger.info("Pools.put: %s" % str(args))
+        task_manager.set_pool_limit(args.pool, args.limit)
+        return task_manager.pool_stats()[args.pool], 200
+
+
+class Stats(Resource):
+    """
+    How many tasks are in each state and how many attempts are running or waiting to be retried.
+    """
+
+    def __init__(self, **kwargs):
+        self._logger = kwargs.get("logger")
+
+    def get(self):
+        return task_manager.stats(), 200
+
+
 class MonitorTasks(Resource):
 
     def __init__(self, **kwargs):
@@ -172,80 +549,128 @@ class MonitorTasks(Resource):
     def _dependencies_str(dependencies):
         return ", ".join([str(dependency) for dependency in dependencies])
 
+    @staticmethod
+    def _todo_row(task):
+        return {"task_id": task.task_id(),
+                "status": "To Do",
+                "created": task.created_time.strftime(TIME_FORMAT),
+                "name": task.name,
+                "description": task.desc,
+                "command": task.cmd,
+                "dependent_on": MonitorTasks._dependent_on_str(task.dependent_on),
+                "duration": task.duration,
+                "max_attempts": task.max_attempts,
+                "not_before": task.not_before.strftime(TIME_FORMAT) if task.not_before is not None else "",
+                "expires_at": task.expires_at.strftime(TIME_FORMAT) if task.expires_at is not None else "",
+                }
+
+    @staticmethod
+    def _in_process_row(task):
+        current_runner = ""
+        if task.most_recent_attempt().is_in_process():
+            current_runner = task.most_recent_attempt().runner
+        return {"task_id": task.task_id(),
+                "status": "In Process",
+                "created": str(task.created_time),
+                "started": task.started_time().strftime(TIME_FORMAT),
+                "name": task.name,
+                "description": task.desc,
+                "command": task.cmd,
+                "dependent_on": MonitorTasks._dependent_on_str(task.dependent_on),
+                "duration": task.duration,
+                "attempted": task.num_attempts(),
+                "attempts_left": task.max_attempts - task.num_attempts(),
+                "attempt_open": task.most_recent_attempt().is_in_process() is True,
+                "current_runner": current_runner
+                }
+
+    @staticmethod
+    def _failed_row(task):
+        return {"task_id": task.task_id(),
+                "status": "Failed",
+                "created": task.created_time.strftime(TIME_FORMAT),
+                "name": task.name,
+                "description": task.desc,
+                "command": task.cmd,
+                "dependencies": MonitorTasks._dependencies_str(task_manager.dependencies(task.task_id())),
+                "attempts": task.num_attempts()
+                }
+
+    @staticmethod
+    def _cancelled_row(task):
+        return {"task_id": task.task_id(),
+                "status": task.cancel_reason,
+                "created": task.created_time.strftime(TIME_FORMAT),
+                "name": task.name,
+                "description": task.desc,
+                "command": task.cmd,
+                "dependent_on": MonitorTasks._dependent_on_str(task.dependent_on),
+                "dependencies": MonitorTasks._dependencies_str(task_manager.dependencies(task.task_id()))
+                }
+
+    @staticmethod
+    def _completed_row(task):
+        return {"task_id": task.task_id(),
+                "status": "Completed",
+                "created": task.created_time.strftime(TIME_FORMAT),
+                "finished": task.completed_time().strftime(TIME_FORMAT),
+                "name": task.name,
+                "description": task.desc,
+                "command": task.cmd,
+                "dependencies": MonitorTasks._dependencies_str(task_manager.dependencies(task.task_id())),
+                "attempts": task.num_attempts()
+                }
+
     def get(self, list_type):
         self._logger.info("MonitorTasks.get: %s" % list_type)
-        list_of_tasks = []
-        if list_type.lower() == "todo":
-            to_do = task_manager.todo_tasks()
-            for task in to_do:
-                d = {"task_id": task.task_id(),
-                     "status": "To Do",
-                     "created": task.created_time.strftime(TIME_FORMAT),
-                     "name": task.name,
-                     "description": task.desc,
-                     "command": task.cmd,
-                     "dependent_on": self._dependent_on_str(task.dependent_on),
-                     "duration": task.duration,
-                     "max_attempts": task.max_attempts,
-                     }
-                list_of_tasks.append(d)
-        elif list_type.lower() == "inprocess":
-            in_process = task_manager.in_process_tasks()
-            for task in in_process:
-                current_runner = ""
-                if task.most_recent_attempt().is_in_process():
-                    current_runner = task.most_recent_attempt().runner
-                d = {"task_id": task.task_id(),
-                     "status": "In Process",
-                     "created": str(task.created_time),
-                     "started": task.started_time().strftime(TIME_FORMAT),
-                     "name": task.name,
-                     "description": task.desc,
-                     "command": task.cmd,
-                     "dependent_on": self._dependent_on_str(task.dependent_on),
-                     "duration": task.duration,
-                     "attempted": task.num_attempts(),
-                     "attempts_left": task.max_attempts - task.num_attempts(),
-                     "attempt_open": task.most_recent_attempt().is_in_process() is True,
-                     "current_runner": current_runner
-                     }
-                list_of_tasks.append(d)
-        elif list_type.lower() == "failed":
-            done = task_manager.done_tasks()
-            for task in done:
-                if task.is_failed():
-                    d = {"task_id": task.task_id(),
-                         "status": "Failed",
-                         "created": task.created_time.strftime(TIME_FORMAT),
-                         "name": task.name,
-                         "description": task.desc,
-                         "command": task.cmd,
-                         "dependencies": self._dependent_on_str(task_manager.dependencies(task.task_id())),
-                         "attempts": task.num_attempts()
-                         }
-                    list_of_tasks.append(d)
-        elif list_type.lower() == "completed":
-            done = task_manager.done_tasks()
-            for task in done:
-                if task.is_completed():
-                    d = {"task_id": task.task_id(),
-                         "status": "Completed",
-                         "created": task.created_time.strftime(TIME_FORMAT),
-                         "finished": task.completed_time().strftime(TIME_FORMAT),
-                         "name": task.name,
-                         "description": task.desc,
-                         "command": task.cmd,
-                         "dependencies": self._dependent_on_str(task_manager.dependencies(task.task_id())),
-                         "attempts": task.num_attempts()
-                         }
-                    list_of_tasks.append(d)
-        else:
+        list_type = list_type.lower()
+        version = task_manager.list_version(list_type)
+        if version is None:
             return {"message": "%s is an unknown list type. No tasks to return." % list_type}, 400
-        return {"data": list_of_tasks}, 200
+        etag = "%s-%s-%d" % (server_epoch, list_type, version)
+        # browsers only revalidate with If-None-Match if told not to use what they have without asking
+        headers = {"Cache-Control": "no-cache"}
+        if etag in request.if_none_match:
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+        rows = []
+        if list_type == "todo":
+            for task in task_manager.todo_tasks():
+                rows.append(row_cache.row(task, ("todo",), self._todo_row))
+        elif list_type == "inprocess":
+            for task in task_manager.in_process_tasks():
+                key = ("inprocess", task.num_attempts(), task.most_recent_attempt().is_in_process())
+                rows.append(row_cache.row(task, key, self._in_process_row))
+        elif list_type == "failed":
+            for task in task_manager.failed_tasks():
+                # done rows show the task's dependents, which can be deleted and added without their number changing
+                key = ("failed", task.num_attempts(), tuple(task_manager.dependencies(task.task_id())))
+                rows.append(row_cache.row(task, key, self._failed_row))
+        elif list_type == "cancelled":
+            for task in task_manager.cancelled_tasks():
+                key = ("cancelled", tuple(task_manager.dependencies(task.task_id())))
+                rows.append(row_cache.row(task, key, self._cancelled_row))
+        elif list_type == "completed":
+            for task in task_manager.completed_tasks():
+                key = ("completed", task.num_attempts(), tuple(task_manager.dependencies(task.task_id())))
+                rows.append(row_cache.row(task, key, self._completed_row))
+        response = Response('{"data": [%s]}' % ", ".join(rows), status=200, mimetype="application/json",
+                            headers=headers)
+        response.set_etag(etag)
+        return response
 
 
 api.add_resource(TaskManagement, '/task', resource_class_kwargs={'logger': logger})
 api.add_resource(AttemptManagement, '/attempt', resource_class_kwargs={'logger': logger})
+api.add_resource(Heartbeat, '/heartbeat', resource_class_kwargs={'logger': logger})
+api.add_resource(OutputManagement, '/output', resource_class_kwargs={'logger': logger})
+api.add_resource(Changes, '/changes', resource_class_kwargs={'logger': logger})
+api.add_resource(Runners, '/runners', resource_class_kwargs={'logger': logger})
+api.add_resource(QueryTasks, '/tasks/query', resource_class_kwargs={'logger': logger})
+api.add_resource(DeleteTasks, '/admin/tasks', resource_class_kwargs={'logger': logger})
+api.add_resource(Pools, '/admin/pools', resource_class_kwargs={'logger': logger})
+api.add_resource(Stats, '/stats', resource_class_kwargs={'logger': logger})
 api.add_resource(MonitorTasks, '/listtasks/<list_type>', resource_class_kwargs={'logger': logger})
 
 
@@ -254,6 +679,42 @@ def task_queue_overview():
     return render_template('overview.html')
 
 
+class Compactor(threading.Thread):
+    """
+    Deletes done tasks past retention every interval seconds. It works in batches of at most batch_size tasks and
+     only holds the task lock for one batch at a time, so requests wait for a batch at most.
+    """
+
+    def __init__(self, interval, batch_size=100, pause=0.01):
+        super(Compactor, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def compact(self):
+        total = 0
+        while True:
+            with task_lock:
+                deleted = task_manager.compact(datetime.now(), max_tasks=self.batch_size)
+                forget_tasks(deleted)
+            total += len(deleted)
+            if len(deleted) < self.batch_size:
+                return total
+            # give waiting requests their turn before the next batch
+            time.sleep(self.pause)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                deleted = self.compact()
+                if deleted:
+                    logger.info("Compactor.run: Deleted %d tasks past retention." % deleted)
+            except Exception:
+                logger.exception("Compactor.run: Compaction failed.")
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-host", action="store", dest="host", nargs=1,
@@ -262,7 +723,80 @@ if __name__ == '__main__':
     parser.add_argument("-port", action="store", dest="port", type=int, nargs=1,
                         default=5000, required=False,
                         help="The port. Defaults to 5000")
+    parser.add_argument("-output_memory_mb", action="store", dest="output_memory_mb", type=float, default=64,
+                        required=False, help="MB of attempt output kept in memory before spilling to disk. Defaults to 64.")
+    parser.add_argument("-output_spill_dir", action="store", dest="output_spill_dir", default=None, required=False,
+                        help="where attempt output is spilled to. Defaults to a new temp directory.")
+    parser.add_argument("-output_disk_mb", action="store", dest="output_disk_mb", type=float, default=1024,
+                        required=False, help="MB of spilled attempt output kept on disk; the output spilled longest ago is forgotten first. Defaults to 1024.")
+    parser.add_argument("-id_scheme", action="store", dest="id_scheme", choices=sorted(ID_GENERATORS.keys()),
+                        default="uuid", required=False,
+                        help="how task and attempt ids are made: uuid (32 hex characters), int (increasing integers) or ulid (26 sortable characters). Defaults to uuid.")
+    parser.add_argument("-change_feed_size", action="store", dest="change_feed_size", type=int, default=10000,
+                        required=False, help="how many of the most recent task changes /changes keeps. Defaults to 10000.")
+    parser.add_argument("-index_commands", action="store_true", dest="index_commands", default=False, required=False,
+                        help="index task commands so /tasks/query can find them by prefix without a scan.")
+    parser.add_argument("-runner_timeout", action="store", dest="runner_timeout", type=float, default=None,
+                        required=False,
+                        help="seconds a runner can go without getting an attempt, reporting or heartbeating before its attempts are failed. Off by default.")
+    parser.add_argument("-queue_weights", action="store", dest="queue_weights", type=parse_queue_weight, nargs='*',
+                        default=[], required=False,
+                        help="each queue's share of attempts as name=weight, e.g. interactive=4 backfill=1. Queues not given have a weight of 1.")
+    parser.add_argument("-pools", action="store", dest="pools", type=parse_pool_limit, nargs='*', default=[],
+                        required=False,
+                        help="concurrency pools as name=limit, the max number of the pool's attempts running at once, e.g. database=20.")
+    parser.add_argument("-priority", action="store", dest="priority", choices=TaskManager.PRIORITY_POLICIES,
+                        default="fifo", required=False,
+                        help="which ready task is attempted first: fifo (oldest) or critical_path (longest chain of expected durations left behind it). Defaults to fifo.")
+    parser.add_argument("-completed_max_age", action="store", dest="completed_max_age", type=float, default=None,
+                        required=False, help="seconds completed tasks are kept. Kept forever by default.")
+    parser.add_argument("-completed_max_count", action="store", dest="completed_max_count", type=int, default=None,
+                        required=False, help="the max number of completed tasks kept, the newest ones. No max by default.")
+    parser.add_argument("-failed_max_age", action="store", dest="failed_max_age", type=float, default=None,
+                        required=False, help="seconds failed (and cancelled) tasks are kept. Kept forever by default.")
+    parser.add_argument("-failed_max_count", action="store", dest="failed_max_count", type=int, default=None,
+                        required=False,
+                        help="the max number of failed tasks, and separately of cancelled tasks, kept, the newest ones. No max by default.")
+    parser.add_argument("-compact_interval", action="store", dest="compact_interval", type=float, default=60,
+                        required=False, help="seconds between deleting the tasks past retention. Defaults to 60.")
+    parser.add_argument("-compact_batch", action="store", dest="compact_batch", type=int, default=100,
+                        required=False,
+                        help="the max number of tasks deleted at once, between which requests get handled. Defaults to 100.")
+    parser.add_argument("-speculate", action="store", dest="speculate", type=float, default=None, required=False,
+                        help="back up an attempt on an idle runner once it has run longer than this quantile (e.g. 0.9) of the runtimes of tasks with the same name (or command but for its numbers), within max_attempts. Off by default.")
+    parser.add_argument("-adaptive_timeout", action="store", dest="adaptive_timeout", type=float, default=None,
+                        required=False,
+                        help="time out attempts of tasks without a duration after the 99th percentile of the runtimes of tasks with the same name (or command but for its numbers) times this factor, e.g. 3. Off by default.")
+    parser.add_argument("-result_cache_ttl", action="store", dest="result_cache_ttl", type=float, default=None,
+                        required=False,
+                        help="seconds a completed task's result satisfies new tasks with its cache key; pending tasks with the same cache key also ride on one attempt. Off by default.")
+    parser.add_argument("-result_cache_size", action="store", dest="result_cache_size", type=int, default=10000,
+                        required=False, help="the max number of cache keys whose results are kept. Defaults to 10000.")
+    parser.add_argument("-idempotency_ttl", action="store", dest="idempotency_ttl", type=float, default=86400,
+                        required=False, help="seconds an idempotency key given with a new task is remembered for. Defaults to 86400 (a day).")
+    parser.add_argument("-idempotency_size", action="store", dest="idempotency_size", type=int, default=100000,
+                        required=False, help="the max number of idempotency keys remembered. Defaults to 100000.")
     cmd_args = parser.parse_args()
+    id_generator = ID_GENERATORS[cmd_args.id_scheme]()
+    retention = {}
+    if cmd_args.completed_max_age is not None or cmd_args.completed_max_count is not None:
+        retention["completed"] = (cmd_args.completed_max_age, cmd_args.completed_max_count)
+    if cmd_args.failed_max_age is not None or cmd_args.failed_max_count is not None:
+        retention["failed"] = (cmd_args.failed_max_age, cmd_args.failed_max_count)
+    task_manager = TaskManager(logger, attempt_ids=id_generator, change_feed_size=cmd_args.change_feed_size,
+                               index_commands=cmd_args.index_commands, runner_timeout=cmd_args.runner_timeout,
+                               queue_weights=dict(cmd_args.queue_weights), pool_limits=dict(cmd_args.pools),
+                               priority_policy=cmd_args.priority, retention=retention,
+                               speculate_quantile=cmd_args.speculate, adaptive_timeout=cmd_args.adaptive_timeout,
+                               result_cache_ttl=cmd_args.result_cache_ttl,
+                               result_cache_size=cmd_args.result_cache_size,
+                               idempotency_ttl=cmd_args.idempotency_ttl, idempotency_size=cmd_args.idempotency_size)
+    output_store = OutputStore(logger, memory_limit=int(cmd_args.output_memory_mb * 1024 * 1024),
+                               spill_dir=cmd_args.output_spill_dir,
+                               disk_limit=int(cmd_args.output_disk_mb * 1024 * 1024))
+    atexit.register(output_store.close)
+    if retention:
+        Compactor(cmd_args.compact_interval, batch_size=cmd_args.compact_batch).start()
     app.run(host=cmd_args.host[0], port=cmd_args.port[0], threaded=False)
 
 
@@ -0,0 +1,220 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import csv
+import json
+import Queue
+import sys
+import threading
+from simple_task_client import SimpleTaskClient
+
+
+class ConcurrentTaskClient(object):
+    """
+    Makes many requests to a SimpleTaskServer at once for bulk submission and monitoring.
+
+    At most `concurrency` requests are in flight at any time; they share the pooled connections of one
+     SimpleTaskClient. Work is pulled from the given iterables only as workers free up and results are handed back
+     as they finish, so memory use stays constant no matter how many tasks go through.
+
+    Every bulk method is a generator of (item, result, error) tuples, in completion order. Exactly one of result and
+     error is None. If reading the iterable itself fails (a malformed line in a file of tasks) no more items are
+     read, and the error is raised from the generator once the items already read have been handed back.
+
+    A caller can stop iterating part way (break, or an error of its own). No more items are read or requests made,
+     and the generator waits for the requests already in flight before it lets go.
+    """
+
+    _DONE = object()
+
+    def __init__(self, server, concurrency=16, timeout=10.0, retries=3):
+        self.concurrency = concurrency
+        self.client = SimpleTaskClient(server, pool_size=concurrency, timeout=timeout, retries=retries)
+
+    def _feed(self, items, work, errors, stop):
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                work.put(item)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            for _ in range(self.concurrency):
+                work.put(self._DONE)
+
+    def _work(self, call, work, results, stop):
+        while True:
+            item = work.get()
+            if item is self._DONE:
+                results.put(self._DONE)
+                return
+            if stop.is_set():
+                continue
+            try:
+                results.put((item, call(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+    def _run(self, call, items):
+        work = Queue.Queue(maxsize=self.concurrency * 2)
+        results = Queue.Queue(maxsize=self.concurrency * 2)
+        errors = []
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._feed, args=(items, work, errors, stop))]
+        threads.extend(threading.Thread(target=self._work, args=(call, work, results, stop))
+                       for _ in range(self.concurrency))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        finished = 0
+        try:
+            while finished < self.concurrency:
+                result = results.get()
+                if result is self._DONE:
+                    finished += 1
+                else:
+                    yield result
+        finally:
+            # if the caller stopped early the threads would block on the full queues forever; once stopped they
+            #  skip the rest of the work, so taking the results left lets every one of them finish
+            stop.set()
+            while finished < self.concurrency:
+                if results.get() is self._DONE:
+                    finished += 1
+            for thread in threads:
+                thread.join()
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def add_tasks(self, tasks):
+        """
+        :param tasks: iterable of dicts with the keyword arguments of SimpleTaskClient.add_task
+        :return: generator of (task dict, task_id, error)
+        """
+        return self._run(lambda task: self.client.add_task(**task), tasks)
+
+    def delete_tasks(self, task_ids):
+        return self._run(self.client.delete_task, task_ids)
+
+    def report_attempts(self, reports):
+        """
+        :param reports: iterable of dicts with runner_id, task_id, attempt_id, status ('completed' or 'failed') and
+         optionally message
+        """
+        def report(r):
+            if r['status'] == 'completed':
+                return self.client.report_completed_attempt(r['runner_id'], r['task_id'], r['attempt_id'],
+                                                            message=r.get('message'))
+            return self.client.report_failed_attempt(r['runner_id'], r['task_id'], r['attempt_id'],
+                                                     message=r.get('message'))
+        return self._run(report, reports)
+
+    def get_tasks(self, task_types=("todo", "inprocess", "failed", "completed")):
+        """
+        Fetches every list in task_types at the same time.
+
+        :return: dict of task type to the tasks in it (keyed by task_id)
+        """
+        lists = {}
+        for task_type, tasks, error in self._run(self.client.get_tasks, task_types):
+            if error is not None:
+                raise error
+            lists[task_type] = tasks
+        return lists
+
+
+def _task_from_row(row):
+    task = {'command': row['command']}
+    for key in ('name', 'description', 'queue', 'pool', 'not_before', 'expires_at', 'cache_key', 'idempotency_key'):
+        if row.get(key):
+            task[key] = row[key]
+    dependent_on = row.get('dependent_on')
+    if dependent_on:
+        # in CSV files dependencies (and labels) are separated by spaces
+        task['dependent_on'] = dependent_on.split() if isinstance(dependent_on, basestring) else dependent_on
+    labels = row.get('labels')
+    if labels:
+        task['labels'] = labels.split() if isinstance(labels, basestring) else labels
+    if row.get('max_attempts') not in (None, ""):
+        task['max_attempts'] = int(row['max_attempts'])
+    for key in ('duration', 'retry_delay', 'retry_multiplier', 'retry_max_delay', 'retry_jitter'):
+        if row.get(key) not in (None, ""):
+            task[key] = float(row[key])
+    if row.get('cache') not in (None, ""):
+        task['cache'] = row['cache'] if isinstance(row['cache'], bool) else row['cache'].lower() in ("true", "1", "yes")
+    return task
+
+
+def read_tasks(file_name):
+    """
+    Streams tasks out of an NDJSON file (one JSON object per line) or, for files ending in .csv, a CSV file with a
+     header row. Only one line is held in memory at a time.
+
+    The fields are the ones POST /task takes: command (required), name, description, dependent_on, max_attempts,
+     duration, labels, queue, pool, not_before, expires_at, retry_delay, retry_multiplier,
+     retry_max_delay, retry_jitter, cache_key, cache and idempotency_key. Give every task an idempotency_key and a
+     load can be run again after failing part way without adding any task twice.
+
+    A line that isn't JSON raises ValueError naming the line.
+    """
+    with open(file_name, 'rb') as f:
+        if file_name.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield _task_from_row(row)
+        else:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if line:
+                    try:
+                        row = json.loads(line)
+                    except ValueError as e:
+                        raise ValueError("%s line %d is not JSON: %s" % (file_name, line_number, str(e)))
+                    yield _task_from_row(row)
+
+
+def bulk_add_tasks(server, file_name, concurrency=16):
+    """
+    Submits every task in file_name, with up to `concurrency` submissions in flight.
+
+    :return: generator of (task dict, task_id, error)
+    """
+    return ConcurrentTaskClient(server, concurrency=concurrency).add_tasks(read_tasks(file_name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', action="store", dest="server_url", required=True,
+                        help="the url of the SimpleTaskServer")
+    parser.add_argument('-f', action="store", dest="file_name", required=True,
+                        help="NDJSON (or .csv) file of tasks to add")
+    parser.add_argument("-concurrency", action="store", dest="concurrency", type=int, default=16, required=False,
+                        help="the max number of requests in flight at once. Defaults to 16.")
+    args = parser.parse_args()
+    added = 0
+    failed = 0
+    try:
+        for task, task_id, error in bulk_add_tasks(args.server_url, args.file_name, concurrency=args.concurrency):
+            if error is None:
+                added += 1
+            else:
+                failed += 1
+                print "Failed to add %s: %s" % (json.dumps(task), str(error))
+    except (ValueError, KeyError) as e:
+        print "Stopped reading %s: %s" % (args.file_name, str(e))
+    print "Added %d tasks. %d failed." % (added, failed)
@@ -16,75 +16,221 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import os
+import Queue
 import shlex
 import subprocess
+import threading
 import time
 from urlparse import urljoin
 import uuid
 
 
-def add_task(server, command, name=None, description=None, dependent_on=None, max_attempts=None, duration=None):
-    payload = {"command": command}
-    if name is not None:
-        payload["name"] = str(name)
-    if description is not None:
-        payload["description"] = str(description)
-    if dependent_on is not None:
-        dependent_on_list = []
-        for d in dependent_on:
-            dependent_on_list.append(str(d))
-        payload["dependent_on"] = dependent_on_list
-    if max_attempts is not None:
-        payload['max_attempts'] = max_attempts
-    if duration is not None:
-        payload['duration'] = duration
-    r = requests.post(urljoin(server,  "task"), data=payload)
-    response_dict = json.loads(r.text)
-    return str(response_dict['task_id'])
+class SimpleTaskClient(object):
+    """
+    Talks to a SimpleTaskServer over a single requests.Session so that connections are pooled and kept alive between
+     calls instead of a new TCP connection being opened for every add, attempt and report.
+
+    Requests that fail with a connection error or a 502/503/504 are retried with exponential backoff. POSTs and PUTs
+     are not retried because they are not idempotent: a retried POST could create the task twice and a retried PUT
+     could deliver an attempt's report twice (heartbeats are PUTs too, but the next one follows soon enough). The
+     exception is add_task given an idempotency key: the server adds a task only once per key, so it is retried on
+     connection errors and timeouts.
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+    RETRY_METHODS = frozenset(['GET', 'DELETE'])
+
+    def __init__(self, server, pool_size=10, timeout=10.0, retries=3, backoff_factor=0.5):
+        self.server = server
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                      method_whitelist=self.RETRY_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        r = self._session.request(method, urljoin(self.server, path), **kwargs)
+        return json.loads(r.text)
+
+    def add_task(self, command, name=None, description=None, dependent_on=None, max_attempts=None, duration=None,
+                 labels=None, queue=None, pool=None, not_before=None, expires_at=None, retry_delay=None,
+                 retry_multiplier=None, retry_max_delay=None, retry_jitter=None, cache_key=None, cache=False,
+                 idempotency_key=None):
+        """
+        :param not_before: datetime (or string like "2019-01-01 12:00:00") before which the task isn't attempted
+        :param expires_at: datetime (or string) by which the task is cancelled if it hasn't been attempted
+        :param retry_delay: seconds to wait before retrying after the first failure, growing by retry_multiplier
+         with each failure up to retry_max_delay, less up to retry_jitter (0 to 1) of it at random
+        :param cache_key: tasks with the same cache key share results, if the server caches them. With cache True
+         the server uses a hash of the command instead.
+        :param idempotency_key: a task added again with the same key (within the server's idempotency ttl) isn't
+         added twice; the id of the task already added is returned
+        """
+        payload = {"command": command}
+        if name is not None:
+            payload["name"] = str(name)
+        if description is not None:
+            payload["description"] = str(description)
+        if dependent_on is not None:
+            dependent_on_list = []
+            for d in dependent_on:
+                dependent_on_list.append(str(d))
+            payload["dependent_on"] = dependent_on_list
+        if max_attempts is not None:
+            payload['max_attempts'] = max_attempts
+        if duration is not None:
+            payload['duration'] = duration
+        if labels is not None:
+            payload['labels'] = list(labels)
+        if queue is not None:
+            payload['queue'] = queue
+        if pool is not None:
+            payload['pool'] = pool
+        if not_before is not None:
+            payload['not_before'] = str(not_before)
+        if expires_at is not None:
+            payload['expires_at'] = str(expires_at)
+        for key, value in (('retry_delay', retry_delay), ('retry_multiplier', retry_multiplier),
+                           ('retry_max_delay', retry_max_delay), ('retry_jitter', retry_jitter)):
+            if value is not None:
+                payload[key] = value
+        if cache_key is not None:
+            payload['cache_key'] = cache_key
+        if cache:
+            payload['cache'] = 'true'
+        if idempotency_key is None:
+            response_dict = self._request('POST', "task", data=payload)
+            return str(response_dict['task_id'])
+        payload['idempotency_key'] = idempotency_key
+        for retry in range(self.retries + 1):
+            try:
+                response_dict = self._request('POST', "task", data=payload)
+                return str(response_dict['task_id'])
+            except (requests.ConnectionError, requests.Timeout):
+                if retry == self.retries:
+                    raise
+                time.sleep(self.backoff_factor * (2 ** retry))
+
+    def delete_task(self, task_id):
+        return self._request('DELETE', "task", data={'task_id': task_id})
+
+    def set_pool_limit(self, pool, limit):
+        """
+        Sets the max number of the pool's attempts that can run at once (an admin operation).
+
+        :return: the pool's limit, attempts in flight and parked tasks
+        """
+        return self._request('PUT', "admin/pools", data={'pool': pool, 'limit': limit})
+
+    def _report_attempt(self, runner_id, task_id, attempt_id, status, message=None):
+        payload = {'runner_id': runner_id,
+                   'task_id': task_id,
+                   'attempt_id': attempt_id,
+                   'status': status}
+        if message is not None:
+            payload['message'] = message
+        return self._request('PUT', "attempt", data=payload)
+
+    def report_failed_attempt(self, runner_id, task_id, attempt_id, message=None):
+        return self._report_attempt(runner_id, task_id, attempt_id, 'failed', message=message)
+
+    def report_completed_attempt(self, runner_id, task_id, attempt_id, message=None):
+        return self._report_attempt(runner_id, task_id, attempt_id, 'completed', message=message)
+
+    def heartbeat(self, runner_id, attempts):
+        """
+        Heartbeats every (task_id, attempt_id) in attempts in a single request.
+
+        :return: the attempt ids the server no longer wants worked on.
+        """
+        payload = {'runner_id': runner_id,
+                   'task_id': [str(task_id) for task_id, attempt_id in attempts],
+                   'attempt_id': [str(attempt_id) for task_id, attempt_id in attempts]}
+        return self._request('PUT', "heartbeat", data=payload).get('stop', [])
+
+    def append_output(self, runner_id, task_id, attempt_id, data):
+        payload = {'runner_id': runner_id,
+                   'task_id': task_id,
+                   'attempt_id': attempt_id,
+                   'data': data}
+        return self._request('POST', "output", data=payload)
+
+    def get_output(self, task_id, attempt_id):
+        return self._request('GET', "output", params={'task_id': task_id, 'attempt_id': attempt_id})
+
+    def get_next_attempt(self, runner_id, labels=None):
+        params = {'runner_id': runner_id}
+        if labels:
+            params['labels'] = list(labels)
+        return self._request('GET', 'attempt', params=params)
+
+    def get_tasks(self, task_type):
+        d = self._request('GET', 'listtasks/%s' % task_type)
+        tasks = {}
+        if d is not None:
+            for task_dict in d.get("data"):
+                tasks[task_dict.get('task_id')] = task_dict
+        return tasks
+
+    def close(self):
+        self._session.close()
+
+
+# the module level functions share one client per server so they also get pooled connections
+_clients = {}
+
+
+def _client(server):
+    client = _clients.get(server)
+    if client is None:
+        client = _clients[server] = SimpleTaskClient(server)
+    return client
+
+
+def add_task(server, command, name=None, description=None, dependent_on=None, max_attempts=None, duration=None,
+             labels=None, queue=None, pool=None, not_before=None, expires_at=None, retry_delay=None,
+             retry_multiplier=None, retry_max_delay=None, retry_jitter=None, cache_key=None, cache=False,
+             idempotency_key=None):
+    return _client(server).add_task(command, name=name, description=description, dependent_on=dependent_on,
+                                    max_attempts=max_attempts, duration=duration, labels=labels, queue=queue,
+                                    pool=pool, not_before=not_before, expires_at=expires_at,
+                                    retry_delay=retry_delay, retry_multiplier=retry_multiplier,
+                                    retry_max_delay=retry_max_delay, retry_jitter=retry_jitter, cache_key=cache_key,
+                                    cache=cache, idempotency_key=idempotency_key)
 
 
 def delete_task(server, task_id):
-    r = requests.delete(urljoin(server, "task"), data={'task_id': task_id})
-    return json.loads(r.text)
+    return _client(server).delete_task(task_id)
+
+
+def set_pool_limit(server, pool, limit):
+    return _client(server).set_pool_limit(pool, limit)
 
 
 def report_failed_attempt(server, runner_id, task_id, attempt_id, message=None):
-    payload = {'runner_id': runner_id,
-               'task_id': task_id,
-               'attempt_id': attempt_id,
-               'status': 'failed'}
-    if message is not None:
-        payload['message'] = message
-    r = requests.put(urljoin(server, "attempt"), data=payload)
-    return json.loads(r.text)
+    return _client(server).report_failed_attempt(runner_id, task_id, attempt_id, message=message)
 
 
 def report_completed_attempt(server, runner_id, task_id, attempt_id, message=None):
-    payload = {'runner_id': runner_id,
-               'task_id': task_id,
-               'attempt_id': attempt_id,
-               'status': 'completed'}
-    if message is not None:
-        payload['message'] = message
-    r = requests.put(urljoin(server, "attempt"), data=payload)
-    return json.loads(r.text)
+    return _client(server).report_completed_attempt(runner_id, task_id, attempt_id, message=message)
 
 
-def get_next_attempt(server, runner_id):
-    payload = {'runner_id': runner_id}
-    r = requests.get(urljoin(server, 'attempt'), params=payload)
-    return json.loads(r.text)
+def get_next_attempt(server, runner_id, labels=None):
+    return _client(server).get_next_attempt(runner_id, labels=labels)
 
 
 def get_tasks(server, task_type):
-    r = requests.get(urljoin(server, 'listtasks/%s' % task_type))
-    d = json.loads(r.text)
-    tasks = {}
-    if d is not None:
-        for task_dict in d.get("data"):
-            tasks[task_dict.get('task_id')] = task_dict
-    return tasks
+    return _client(server).get_tasks(task_type)
 
 
 def get_todo_tasks(server):
@@ -103,22 +249,270 @@ def get_completed_tasks(server):
     return get_tasks(server, "completed")
 
 
-def main(server, wait_seconds, runner_id, risky=False):
-    print runner_id
-    while True:
-        attempt_info = get_next_attempt(server, runner_id)
-        if attempt_info["status"] == "attempt":
-            cmd = attempt_info['command']
+def get_cancelled_tasks(server):
+    return get_tasks(server, "cancelled")
+
+
+class OutputReader(threading.Thread):
+    """
+    Reads an attempt's combined stdout/stderr and hands it to `upload` in chunks of up to chunk_size bytes. A chunk
+     is sent once it is full or flush_seconds after it was started, whichever comes first (checked as output
+     arrives). The last tail_size bytes are also kept locally so a failure can be reported with them.
+    """
+
+    def __init__(self, pipe, upload, chunk_size=32 * 1024, flush_seconds=2.0, tail_size=1024):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._pipe = pipe
+        self._upload = upload
+        self._chunk_size = chunk_size
+        self._flush_seconds = flush_seconds
+        self._tail_size = tail_size
+        self.tail = ""
+
+    def run(self):
+        chunk = ""
+        chunk_started = time.time()
+        fd = self._pipe.fileno()
+        while True:
+            data = os.read(fd, self._chunk_size)
+            if not data:
+                break
+            self.tail = (self.tail + data)[-self._tail_size:]
+            if not chunk:
+                chunk_started = time.time()
+            chunk += data
+            while len(chunk) >= self._chunk_size:
+                self._upload(chunk[:self._chunk_size])
+                chunk = chunk[self._chunk_size:]
+            if chunk and time.time() - chunk_started >= self._flush_seconds:
+                self._upload(chunk)
+                chunk = ""
+        if chunk:
+            self._upload(chunk)
+        self._pipe.close()
+
+
+class Runner(object):
+    """
+    Runs attempts from the server in up to `slots` concurrent subprocesses.
+
+    With more than one slot, a background thread keeps the next attempt leased and waiting so a slot that frees up
+     starts its next command without a round trip to the server. Outcomes, heartbeats and output are sent from a
+     separate thread so a slow server never holds up starting the next command. With one slot an attempt's outcome
+     has been sent (after its output) before the next attempt is asked for, as the runner has always done.
+
+    While attempts are running or leased and waiting they are heartbeated, all in one request, every
+     `heartbeat_seconds` so that the server only times out an attempt when this runner stops heartbeating. Attempts
+     the server says it no longer wants are terminated (or never started) and not reported.
+
+    Each attempt's stdout and stderr are streamed to the server in chunks (unless upload_output is False). The queue
+     of things to send is bounded, so if the server can't keep up the commands end up waiting on their output
+     rather than the runner's memory growing.
+
+    The runner is only given tasks whose required labels are all in `labels`.
+    """
+
+    POLL_INTERVAL = 0.1
+    MAX_QUEUED_SENDS = 64
+
+    def __init__(self, client, runner_id, slots=1, wait_seconds=5.0, risky=False, heartbeat_seconds=30.0,
+                 upload_output=True, labels=None):
+        self._client = client
+        self._runner_id = runner_id
+        self._labels = labels
+        self._slots = slots
+        self._wait_seconds = wait_seconds
+        self._risky = risky
+        self._heartbeat_seconds = heartbeat_seconds
+        self._upload_output = upload_output
+        self._last_heartbeat = time.time()
+        self._running = {}
+        self._readers = {}
+        # processes that have exited, to their attempt, return code and how long to wait for the rest of their output
+        self._finishing = {}
+        self._stopped = set()
+        self._prefetched = Queue.Queue(maxsize=1)
+        # attempt id to the attempts leased by the prefetch thread that haven't started yet
+        self._leased = {}
+        # guards what both the main and the other threads look at: running, stopped and leased
+        self._lock = threading.Lock()
+        self._sends = Queue.Queue(maxsize=self.MAX_QUEUED_SENDS)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _prefetch(self):
+        """
+        Leases the next attempt to have waiting, unless one already is.
+
+        :return: how long to wait before trying again
+        """
+        # only ever hold one leased attempt that isn't running yet
+        if self._prefetched.full():
+            return self.POLL_INTERVAL
+        try:
+            attempt_info = self._client.get_next_attempt(self._runner_id, labels=self._labels)
+        except Exception as e:
+            print "Runner: could not get next attempt: %s" % str(e)
+            attempt_info = None
+        if attempt_info is None or attempt_info["status"] != "attempt":
+            return self._wait_seconds
+        # heartbeated while it waits for a slot, so it isn't timed out before it starts
+        with self._lock:
+            self._leased[attempt_info['attempt_id']] = attempt_info
+        self._prefetched.put(attempt_info)
+        return 0
+
+    def _prefetch_loop(self):
+        while True:
+            wait = self._prefetch()
+            if wait:
+                time.sleep(wait)
+
+    def _send_loop(self):
+        while True:
+            send, args, kwargs = self._sends.get()
             try:
-                if risky:
-                    subprocess.check_call(cmd, shell=True)
-                else:
-                    subprocess.check_call(shlex.split(cmd))
-                report_completed_attempt(server, runner_id, attempt_info['task_id'], attempt_info['attempt_id'])
+                send(*args, **kwargs)
             except Exception as e:
-                report_failed_attempt(server, runner_id, attempt_info['task_id'], attempt_info['attempt_id'], message=str(e))
-        else:
-            time.sleep(wait_seconds)
+                print "Runner: could not send %s to server: %s" % (send.__name__, str(e))
+            finally:
+                self._sends.task_done()
+
+    def _send(self, send, *args, **kwargs):
+        self._sends.put((send, args, kwargs))
+
+    def _report(self, attempt_info, message=None, failed=False):
+        report = self._client.report_failed_attempt if failed else self._client.report_completed_attempt
+        self._send(report, self._runner_id, attempt_info['task_id'], attempt_info['attempt_id'], message=message)
+        if self._slots == 1:
+            self._sends.join()
+
+    def _send_heartbeat(self, attempts):
+        stop = self._client.heartbeat(self._runner_id, attempts)
+        if stop:
+            with self._lock:
+                self._stopped.update(stop)
+                running = self._running.items()
+            for process, attempt_info in running:
+                if attempt_info['attempt_id'] in stop:
+                    process.terminate()
+
+    def _heartbeat(self):
+        with self._lock:
+            attempt_infos = self._running.values() + self._leased.values()
+        now = time.time()
+        if not attempt_infos:
+            # heartbeats are counted from when the first attempt of a busy spell started (or was leased)
+            self._last_heartbeat = now
+        if not self._heartbeat_seconds or not attempt_infos:
+            return
+        if now - self._last_heartbeat < self._heartbeat_seconds:
+            return
+        self._last_heartbeat = now
+        attempts = [(attempt_info['task_id'], attempt_info['attempt_id']) for attempt_info in attempt_infos]
+        self._send(self._send_heartbeat, attempts)
+
+    def _next_attempt(self):
+        if self._slots > 1:
+            try:
+                attempt_info = self._prefetched.get(timeout=self.POLL_INTERVAL)
+            except Queue.Empty:
+                return None
+            with self._lock:
+                del self._leased[attempt_info['attempt_id']]
+                if attempt_info['attempt_id'] in self._stopped:
+                    # the server stopped wanting it while it waited
+                    self._stopped.discard(attempt_info['attempt_id'])
+                    return None
+            return attempt_info
+        attempt_info = self._client.get_next_attempt(self._runner_id, labels=self._labels)
+        if attempt_info["status"] == "attempt":
+            return attempt_info
+        time.sleep(self._wait_seconds)
+        return None
+
+    def _start(self, attempt_info):
+        cmd = attempt_info['command']
+        output = {}
+        if self._upload_output:
+            output = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
+        try:
+            if self._risky:
+                process = subprocess.Popen(cmd, shell=True, **output)
+            else:
+                process = subprocess.Popen(shlex.split(cmd), **output)
+        except Exception as e:
+            self._report(attempt_info, message=str(e), failed=True)
+            return
+        with self._lock:
+            self._running[process] = attempt_info
+        if self._upload_output:
+            def upload(data):
+                self._send(self._client.append_output, self._runner_id, attempt_info['task_id'],
+                           attempt_info['attempt_id'], data)
+            self._readers[process] = reader = OutputReader(process.stdout, upload)
+            reader.start()
+
+    def _reap(self):
+        with self._lock:
+            running = self._running.items()
+        for process, attempt_info in running:
+            return_code = process.poll()
+            if return_code is None:
+                continue
+            with self._lock:
+                del self._running[process]
+            self._finishing[process] = (attempt_info, return_code, time.time() + self.POLL_INTERVAL * 10)
+        for process, (attempt_info, return_code, output_deadline) in self._finishing.items():
+            reader = self._readers.get(process)
+            if reader is not None and reader.is_alive() and time.time() < output_deadline:
+                # let the last of the output get queued before the outcome so it reaches the server first, but
+                #  without holding up the other slots
+                continue
+            del self._finishing[process]
+            self._readers.pop(process, None)
+            tail = reader.tail if reader is not None else ""
+            with self._lock:
+                stopped = attempt_info['attempt_id'] in self._stopped
+                self._stopped.discard(attempt_info['attempt_id'])
+            if stopped:
+                # the server no longer wants it, so there is nothing to report
+                continue
+            if return_code == 0:
+                self._report(attempt_info)
+            else:
+                message = str(subprocess.CalledProcessError(return_code, attempt_info['command']))
+                if tail:
+                    message = "%s Output ended with:\n%s" % (message, tail)
+                self._report(attempt_info, message=message, failed=True)
+
+    def run(self):
+        if self._slots > 1:
+            self._start_thread(self._prefetch_loop)
+        self._start_thread(self._send_loop)
+        while True:
+            self._reap()
+            self._heartbeat()
+            while len(self._running) < self._slots:
+                attempt_info = self._next_attempt()
+                if attempt_info is None:
+                    break
+                self._start(attempt_info)
+            if self._running or self._finishing:
+                time.sleep(self.POLL_INTERVAL)
+
+
+def main(server, wait_seconds, runner_id, risky=False, client=None, slots=1, heartbeat_seconds=30.0,
+         upload_output=True, labels=None):
+    client = client if client is not None else _client(server)
+    print runner_id
+    Runner(client, runner_id, slots=slots, wait_seconds=wait_seconds, risky=risky,
+           heartbeat_seconds=heartbeat_seconds, upload_output=upload_output, labels=labels).run()
 
 
 if __name__ == "__main__":
@@ -134,5 +528,22 @@ if __name__ == "__main__":
     parser.add_argument("-runner_id", action="store", dest="runner_id", nargs='?', const=temp_runner_id,
                         default=temp_runner_id, required=False,
                         help="The client's identifier. It should be unique across runners. If not defined, a unique id is randomly selected")
+    parser.add_argument("-pool_size", action="store", dest="pool_size", type=int, default=10, required=False,
+                        help="the max number of kept-alive connections to the server. Defaults to 10.")
+    parser.add_argument("-timeout", action="store", dest="timeout", type=float, default=10.0, required=False,
+                        help="seconds to wait on the server before a request is considered failed. Defaults to 10.")
+    parser.add_argument("-retries", action="store", dest="retries", type=int, default=3, required=False,
+                        help="the number of times a failed request is retried, with exponential backoff. Defaults to 3.")
+    parser.add_argument("-slots", action="store", dest="slots", type=int, default=1, required=False,
+                        help="the number of attempts this runner runs at the same time. Defaults to 1.")
+    parser.add_argument("-heartbeat", action="store", dest="heartbeat", type=float, default=30.0, required=False,
+                        help="seconds between heartbeats for running attempts; keep it below the tasks' durations. 0 turns heartbeats off. Defaults to 30.")
+    parser.add_argument("-no_output", action="store_false", dest="upload_output", required=False,
+                        help="if present attempts' stdout and stderr are left on the runner's console instead of being sent to the server.")
+    parser.add_argument("-labels", action="store", dest="labels", nargs='*', default=None, required=False,
+                        help="labels this runner has (capabilities, installed software, ...). It only runs tasks whose required labels it all has.")
     args = parser.parse_args()
-    main(args.server_url, args.wait_time, args.runner_id, risky=args.risky)
+    task_client = SimpleTaskClient(args.server_url, pool_size=max(args.pool_size, args.slots + 2), timeout=args.timeout,
+                                   retries=args.retries)
+    main(args.server_url, args.wait_time, args.runner_id, risky=args.risky, client=task_client, slots=args.slots,
+         heartbeat_seconds=args.heartbeat, upload_output=args.upload_output, labels=args.labels)
@@ -18,7 +18,18 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 """
 
 import uuid
+import bisect
 import collections
+import datetime
+import hashlib
+import heapq
+import itertools
+import math
+import os
+import random
+import re
+import tempfile
+import time
 
 
 # Custom Exceptions
@@ -26,12 +37,98 @@ class UnknownDependencyException(Exception):
     pass
 
 
+class IDGenerator(object):
+    """
+    Creates the ids of Tasks and TaskAttempts. Ids come back from clients as strings, so parse turns a string back
+     into the id as it was created.
+    """
+
+    def next_id(self):
+        raise NotImplementedError
+
+    def parse(self, value):
+        return value
+
+
+class UUIDGenerator(IDGenerator):
+
+    def next_id(self):
+        return uuid.uuid1().hex  # to avoid the whole json serialization of a UUID, i'm just going straight to hex
+
+
+class MonotonicIDGenerator(IDGenerator):
+    """
+    Integer ids that always increase, and are seeded from the clock so they keep increasing across server restarts.
+     The millisecond timestamp is shifted by 10 bits, which keeps ids under 2**53 (so javascript, ie the dashboard,
+     can represent them exactly) for a couple hundred years, and more than 1024 ids a millisecond just borrow from
+     the next millisecond.
+    """
+
+    def __init__(self):
+        self._last = 0
+
+    def next_id(self):
+        self._last = max(self._last + 1, int(time.time() * 1000) << 10)
+        return self._last
+
+    def parse(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+
+class ULIDGenerator(IDGenerator):
+    """
+    ULIDs: a 48 bit millisecond timestamp followed by 80 random bits, written as 26 Crockford base32 characters.
+     They sort in creation order. Within the same millisecond the random part is incremented so that order holds
+     for ids created by this generator.
+    """
+
+    ENCODING = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+    def __init__(self):
+        self._last_millis = 0
+        self._last_random = 0
+
+    def next_id(self):
+        millis = int(time.time() * 1000)
+        if millis <= self._last_millis:
+            millis = self._last_millis
+            self._last_random += 1
+        else:
+            self._last_random = random.getrandbits(79)  # leave room to increment within the millisecond
+        self._last_millis = millis
+        value = (millis << 80) | self._last_random
+        chars = []
+        for _ in range(26):
+            chars.append(self.ENCODING[value & 31])
+            value >>= 5
+        return "".join(reversed(chars))
+
+
+ID_GENERATORS = {"uuid": UUIDGenerator,
+                 "int": MonotonicIDGenerator,
+                 "ulid": ULIDGenerator}
+
+
 # Task states are either to be done or complete
 # TaskAttempt states are in is_started, confirmed, in-process, completed, failed
 
 class Task(object):
 
-    def __init__(self, task_id, command, create_time, name="", desc="", duration=None, max_attempts=1, dependent_on=None):
+    def __init__(self, task_id, command, create_time, name="", desc="", duration=None, max_attempts=1, dependent_on=None,
+                 labels=None, queue="default", pool=None, not_before=None, expires_at=None, retry_delay=None,
+                 retry_multiplier=2.0, retry_max_delay=None, retry_jitter=0.0, cache_key=None):
+        """
+        :param retry_delay: seconds to wait before retrying after the first failed attempt. Each failure after that
+         waits retry_multiplier times longer, up to retry_max_delay, less a random part of up to retry_jitter (0 to 1)
+         of it so tasks that failed together don't all come back at once. None retries right away.
+        :param cache_key: tasks with the same cache key are taken to do the same thing, so one that completed
+         recently or one that is pending can stand in for another (see TaskManager). None opts out.
+        """
+        if not 0 <= retry_jitter <= 1:
+            raise ValueError("retry_jitter is the part of a wait taken off, from 0 to 1, not %s" % str(retry_jitter))
         self.__task_id = task_id
         self.cmd = command
         self.name = name
@@ -40,10 +137,26 @@ class Task(object):
         self.max_attempts = max_attempts
         self.created_time = create_time
         self.dependent_on = dependent_on if dependent_on is not None else []
+        # a runner needs every one of these labels to attempt the task
+        self.labels = frozenset(labels) if labels is not None else frozenset()
+        self.queue = queue
+        # the concurrency pool the task's attempts count against, if any
+        self.pool = pool
+        # not attempted before not_before and dropped if still not attempted at expires_at
+        self.not_before = not_before
+        self.expires_at = expires_at
+        self.retry_delay = retry_delay
+        self.retry_multiplier = retry_multiplier
+        self.retry_max_delay = retry_max_delay
+        self.retry_jitter = retry_jitter
+        self.cache_key = cache_key
+        # the task whose completion this task's result was taken from
+        self.cached_from = None
+        self.cancel_reason = None
         self._attempts = collections.OrderedDict()
         self._most_recent_attempt = None
 
-    def attempt_task(self, runner, time_stamp):
+    def attempt_task(self, runner, time_stamp, attempt_id=None):
         """
         Creates a new attempt and returns the attempt that was created.
 
@@ -51,13 +164,16 @@ class Task(object):
         """
         if len(self._attempts) >= self.max_attempts:
             return None
-        attempt = TaskAttempt(runner, time_stamp)
+        attempt = TaskAttempt(runner, time_stamp, attempt_id=attempt_id)
         self._attempts[attempt.id()] = self._most_recent_attempt = attempt
         return self._most_recent_attempt
 
     def get_attempt(self, attempt_id):
         return self._attempts.get(attempt_id)
 
+    def attempt_ids(self):
+        return self._attempts.keys()
+
     def most_recent_attempt(self):
         return self._most_recent_attempt
 
@@ -106,6 +222,36 @@ class Task(object):
             failed = False
         return failed
 
+    @staticmethod
+    def command_cache_key(command):
+        """
+        A cache key for tasks that are the same if their commands are.
+        """
+        return "cmd:" + hashlib.sha1(command.encode("utf-8")).hexdigest()
+
+    def retry_backoff(self, rand=random.random):
+        """
+        How long to wait before retrying after the most recent attempt failed.
+
+        :return: seconds, or None if the task is retried right away
+        """
+        if self.retry_delay is None:
+            return None
+        failures = sum(1 for attempt in self._attempts.itervalues() if attempt.is_failed())
+        delay = self.retry_delay * self.retry_multiplier ** max(0, failures - 1)
+        if self.retry_max_delay is not None:
+            delay = min(delay, self.retry_max_delay)
+        return delay - delay * self.retry_jitter * rand()
+
+    def cancel(self, reason):
+        """
+        Marks the task as never to be attempted, e.g. because a task it depends on failed.
+        """
+        self.cancel_reason = reason
+
+    def is_cancelled(self):
+        return self.cancel_reason is not None
+
     def open_time(self):
         """
         The amount of time between when a task is created and when it is completed. If the task fails or if the task
@@ -149,6 +295,9 @@ class Task(object):
     def num_attempts(self):
         return len(self._attempts)
 
+    def num_open_attempts(self):
+        return sum(1 for attempt in self._attempts.itervalues() if attempt.is_in_process())
+
     def __hash__(self):
         return self.task_id
 
@@ -159,17 +308,29 @@ class Task(object):
                 'description': self.desc,
                 'duration': self.duration,
                 'max_attempts': self.max_attempts,
-                'dependent_on': self.dependent_on}
+                'dependent_on': self.dependent_on,
+                'labels': sorted(self.labels),
+                'queue': self.queue,
+                'pool': self.pool,
+                'not_before': str(self.not_before) if self.not_before is not None else None,
+                'expires_at': str(self.expires_at) if self.expires_at is not None else None,
+                'retry_delay': self.retry_delay,
+                'retry_multiplier': self.retry_multiplier,
+                'retry_max_delay': self.retry_max_delay,
+                'retry_jitter': self.retry_jitter,
+                'cache_key': self.cache_key,
+                'cached_from': self.cached_from}
 
 
 class TaskAttempt:
     COMPLETED = 30
     FAILED = 40
 
-    def __init__(self, runner, time_stamp):
-        self._attempt_id = uuid.uuid1().hex  # to avoid the whole json serialization of a UUID, i'm just going straight to hex
+    def __init__(self, runner, time_stamp, attempt_id=None):
+        self._attempt_id = attempt_id if attempt_id is not None else UUIDGenerator().next_id()
         self.runner = runner
         self.start_time = time_stamp
+        self.last_heartbeat = time_stamp
         self._fail_reason = None
         self.completed_time = None
         self._status = 0
@@ -177,6 +338,13 @@ class TaskAttempt:
     def id(self):
         return self._attempt_id
 
+    def heartbeat(self, time_stamp):
+        """
+        Records that the runner is still working on the attempt. The attempt's duration is measured from the most
+         recent heartbeat, so a runner that keeps heartbeating never has its attempt timed out.
+        """
+        self.last_heartbeat = time_stamp
+
     def mark_failed(self, reason):
         self._fail_reason = reason
         self._status = TaskAttempt.FAILED
@@ -225,21 +393,226 @@ class TaskQueue(object):
         raise NotImplementedError
 
 
+class ReadyTasks(object):
+    """
+    Tasks that are ready to be attempted, kept in a heap so the next one to attempt (lowest key) is found in
+     O(log n). Removing a task just forgets it; its heap entry is skipped once it gets to the top. Adding a task
+     that is already here with a new key moves it.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._tasks = {}
+
+    def add(self, task, key):
+        self._tasks[task.task_id()] = (key, task)
+        heapq.heappush(self._heap, (key, task.task_id()))
+
+    def remove(self, task_id):
+        return self._tasks.pop(task_id, (None, None))[1]
+
+    def peek(self):
+        while self._heap:
+            key, task_id = self._heap[0]
+            entry = self._tasks.get(task_id)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            heapq.heappop(self._heap)
+        return None
+
+    def __contains__(self, task_id):
+        return task_id in self._tasks
+
+    def __len__(self):
+        return len(self._tasks)
+
+
+class Timers(object):
+    """
+    Task ids each due at a time, kept in a heap so the ones that are due are found without looking at the ones that
+     aren't. Removing a task id just forgets it; its heap entry is skipped once it gets to the top.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._times = {}
+        self._seq = itertools.count()
+
+    def add(self, task_id, when):
+        self._times[task_id] = when
+        heapq.heappush(self._heap, (when, next(self._seq), task_id))
+
+    def remove(self, task_id):
+        self._times.pop(task_id, None)
+
+    def due(self, now):
+        """
+        Removes and returns the task ids due at or before now, earliest first.
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, task_id = heapq.heappop(self._heap)
+            if self._times.get(task_id) == when:
+                del self._times[task_id]
+                due.append(task_id)
+        return due
+
+    def when(self, task_id):
+        return self._times.get(task_id)
+
+    def __contains__(self, task_id):
+        return task_id in self._times
+
+    def __len__(self):
+        return len(self._times)
+
+
+class Pools(object):
+    """
+    Concurrency pools: a pool caps how many attempts of its tasks can be in flight at once. A pool without a limit
+     is never full.
+    """
+
+    def __init__(self, logger, limits=None):
+        self._limits = dict(limits) if limits is not None else {}
+        self._in_flight = collections.Counter()
+        self._logger = logger
+
+    def set_limit(self, pool, limit):
+        self._limits[pool] = limit
+
+    def limit(self, pool):
+        return self._limits.get(pool)
+
+    def is_full(self, pool):
+        limit = self._limits.get(pool)
+        return pool is not None and limit is not None and self._in_flight[pool] >= limit
+
+    def free(self, pool):
+        """
+        :return: how many more attempts can start in the pool (None if there is no limit)
+        """
+        limit = self._limits.get(pool)
+        return None if limit is None else max(0, limit - self._in_flight[pool])
+
+    def acquire(self, pool):
+        if pool is not None:
+            self._in_flight[pool] += 1
+
+    def release(self, pool):
+        if pool is not None and self._in_flight[pool] > 0:
+            self._in_flight[pool] -= 1
+
+    def in_flight(self, pool):
+        return self._in_flight[pool]
+
+    def pools(self):
+        return set(self._limits.keys()) | set(pool for pool, n in self._in_flight.iteritems() if n)
+
+
 class SimpleTaskQueue(TaskQueue):
+    """
+    Tasks to do, oldest first. Tasks are either ready to be attempted or blocked (waiting on dependencies); only the
+     ready ones are ever looked at for the next task, so blocked tasks cost nothing while they wait.
 
-    def __init__(self, logger):
+    Every task is in a named queue and each queue keeps its own ready tasks, apart by the set of labels they
+     require. Finding the next task for a runner only peeks at the sets of labels the runner has, so it costs the
+     number of distinct label sets, not the number of tasks.
+
+    Queues take turns by weighted deficit round robin: on its turn a queue is credited its weight and gives out
+     tasks until it has used up its credit, so over time each queue with ready tasks gets a share of the attempts in
+     proportion to its weight, no matter how many tasks it has waiting.
+
+    A ready task whose concurrency pool is full when it comes up is parked with its pool and not looked at again
+     until the pool has room (see unpark), so a full pool doesn't get rescanned on every pick.
+    """
+
+    DEFAULT_QUEUE = "default"
+
+    def __init__(self, logger, weights=None, pools=None):
         TaskQueue.__init__(self, logger)
+        self._pools = pools
+        # pool to its parked tasks
+        self._parked = {}
         self._queue = collections.OrderedDict()
-
-    def next_task(self, skip_task_ids=None):
+        # queue name to required labels to the ready tasks that require them
+        self._ready = {}
+        self._order = {}
+        self._counter = itertools.count()
+        self._weights = dict(weights) if weights is not None else {}
+        # queues with ready tasks in the order they take turns; the one at the front has the turn
+        self._turns = collections.deque()
+        self._deficits = {}
+        self._num_todo = collections.Counter()
+
+    def weight(self, queue):
+        return self._weights.get(queue, 1.0)
+
+    def _peek(self, queue, labels):
         task_to_send_back = None
-        for task in self._queue.itervalues():
-            if skip_task_ids is not None and task.task_id() in skip_task_ids:
-                self._logger.debug("SimpleTaskQueue.next_task: Task %s is in skip_task_ids so skipping it." % str(task.task_id()))
+        for required, ready in self._ready.get(queue, {}).items():
+            if labels is not None and not required <= labels:
                 continue
-            else:
+            task = ready.peek()
+            while task is not None and self._pools is not None and self._pools.is_full(task.pool):
+                self._park(task)
+                task = ready.peek()
+            if task is not None and (task_to_send_back is None or
+                                     self._order[task.task_id()] < self._order[task_to_send_back.task_id()]):
                 task_to_send_back = task
-                break
+        return task_to_send_back
+
+    def _next_turn(self, labels):
+        """
+        The next task by weighted deficit round robin, charging its queue for it. Queues with nothing the runner
+         can do are passed over without using up their turn's credit.
+        """
+        # a queue's credit reaches 1 within 1 / weight turns, so this many turns finds a task if there is one
+        max_turns = len(self._turns) * int(math.ceil(1.0 / min(self.weight(q) for q in self._turns))) if self._turns else 0
+        skipped = 0
+        for _ in xrange(max_turns + len(self._turns)):
+            if not self._turns:
+                return None
+            queue = self._turns[0]
+            task = self._peek(queue, labels)
+            if task is None:
+                if self._turns and self._turns[0] == queue:
+                    # (otherwise parking emptied the queue and it has dropped out of the turns)
+                    skipped += 1
+                    self._turns.rotate(-1)
+                if skipped >= len(self._turns):
+                    return None
+                continue
+            skipped = 0
+            if self._deficits[queue] < 1:
+                self._deficits[queue] += self.weight(queue)
+            if self._deficits[queue] >= 1:
+                self._deficits[queue] -= 1
+                if self._deficits[queue] < 1:
+                    self._turns.rotate(-1)
+                return task
+            self._turns.rotate(-1)
+        return None
+
+    def next_task(self, skip_task_ids=None, labels=None):
+        """
+        :param labels: the labels of the runner; only tasks requiring a subset of them are considered. None
+         considers every task.
+        """
+        task_to_send_back = None
+        if not skip_task_ids:
+            task_to_send_back = self._next_turn(labels)
+            if task_to_send_back is None and self._unpark_with_room():
+                # parked tasks whose pool has room again but weren't let out still get their turn
+                task_to_send_back = self._next_turn(labels)
+        else:
+            for task in self._queue.itervalues():
+                if task.task_id() in skip_task_ids:
+                    self._logger.debug("SimpleTaskQueue.next_task: Task %s is in skip_task_ids so skipping it." % str(task.task_id()))
+                    continue
+                elif self.is_ready(task.task_id()) and (labels is None or task.labels <= labels):
+                    task_to_send_back = task
+                    break
         if task_to_send_back is None:
             self._logger.debug("SimpleTaskQueue.next_task: No next task to return.")
         else:
@@ -249,12 +622,117 @@ class SimpleTaskQueue(TaskQueue):
     def task(self, task_id):
         return self._queue.get(task_id)
 
-    def add_task(self, task):
+    def add_task(self, task, ready=True, priority=0):
+        """
+        :param priority: tasks with a lower priority go first; tasks with the same priority go oldest first
+        """
         self._queue[task.task_id()] = task
+        self._order[task.task_id()] = (priority, next(self._counter))
+        self._num_todo[task.queue] += 1
+        if ready:
+            self.set_ready(task.task_id())
+
+    def set_priority(self, task_id, priority):
+        task = self._queue.get(task_id)
+        if task is None or self._order[task_id][0] == priority:
+            return
+        self._order[task_id] = (priority, self._order[task_id][1])
+        if self.is_ready(task_id):
+            self._ready[task.queue][task.labels].add(task, self._order[task_id])
+        elif self.is_parked(task_id):
+            self._parked[task.pool].add(task, self._order[task_id])
+
+    def priority(self, task_id):
+        return self._order[task_id][0] if task_id in self._order else None
+
+    def set_ready(self, task_id):
+        """
+        Marks a blocked task as ready to be attempted. It keeps its place in line from when it was added.
+        """
+        task = self._queue.get(task_id)
+        if task is not None and not self.is_ready(task_id) and not self.is_parked(task_id):
+            queue = self._ready.get(task.queue)
+            if queue is None:
+                queue = self._ready[task.queue] = {}
+                self._turns.append(task.queue)
+                self._deficits[task.queue] = 0
+            ready = queue.get(task.labels)
+            if ready is None:
+                ready = queue[task.labels] = ReadyTasks()
+            ready.add(task, self._order[task_id])
+
+    def is_ready(self, task_id):
+        task = self._queue.get(task_id)
+        return task is not None and task_id in self._ready.get(task.queue, {}).get(task.labels, ())
+
+    def is_parked(self, task_id):
+        task = self._queue.get(task_id)
+        return task is not None and task_id in self._parked.get(task.pool, ())
+
+    def _unready(self, task):
+        queue = self._ready.get(task.queue, {})
+        ready = queue.get(task.labels)
+        if ready is not None and ready.remove(task.task_id()) is not None:
+            if not ready:
+                del queue[task.labels]
+            if not queue:
+                # a queue without ready tasks drops out of the turns and loses any credit it had
+                del self._ready[task.queue]
+                del self._deficits[task.queue]
+                self._turns.remove(task.queue)
+
+    def _park(self, task):
+        self._unready(task)
+        parked = self._parked.get(task.pool)
+        if parked is None:
+            parked = self._parked[task.pool] = ReadyTasks()
+        parked.add(task, self._order[task.task_id()])
+        self._logger.debug("SimpleTaskQueue._park: Task %s parked as pool %s is full." % (str(task.task_id()), str(task.pool)))
+
+    def unpark(self, pool, count=None):
+        """
+        Makes up to count (all if None) of the pool's parked tasks, oldest first, ready again.
+        """
+        parked = self._parked.get(pool)
+        while parked and (count is None or count > 0):
+            task = parked.peek()
+            parked.remove(task.task_id())
+            self.set_ready(task.task_id())
+            if count is not None:
+                count -= 1
+        if parked is not None and not parked:
+            del self._parked[pool]
+
+    def _unpark_with_room(self):
+        """
+        Makes the parked tasks of every pool that has room ready again, as many as the pool has room for.
+
+        :return: True if any task was made ready
+        """
+        unparked = False
+        for pool in self._parked.keys():
+            if self._pools is None or not self._pools.is_full(pool):
+                self.unpark(pool, count=self._pools.free(pool) if self._pools is not None else None)
+                unparked = True
+        return unparked
+
+    def num_parked(self, pool=None):
+        if pool is not None:
+            return len(self._parked.get(pool, ()))
+        return sum(len(parked) for parked in self._parked.itervalues())
 
     def remove_task(self, task_id):
         if task_id in self._queue:
+            task = self._queue[task_id]
+            self._unready(task)
+            parked = self._parked.get(task.pool)
+            if parked is not None and parked.remove(task_id) is not None and not parked:
+                del self._parked[task.pool]
             del self._queue[task_id]
+            del self._order[task_id]
+            self._num_todo[task.queue] -= 1
+            if not self._num_todo[task.queue]:
+                del self._num_todo[task.queue]
             self._logger.debug("SimpleTaskQueue.remove_task: removing Task %s." % str(task_id))
         else:
             self._logger.debug("SimpleTaskQueue.remove_task: Task %s cannot be removed; not in queue." % str(task_id))
@@ -265,6 +743,20 @@ class SimpleTaskQueue(TaskQueue):
     def all_tasks(self):
         return self._queue.values()
 
+    def num_ready(self, queue=None):
+        """
+        :param queue: just count the ready tasks in this queue
+        """
+        queues = self._ready.itervalues() if queue is None else [self._ready.get(queue, {})]
+        return sum(len(ready) for q in queues for ready in q.itervalues())
+
+    def queue_stats(self):
+        """
+        :return: dict of queue name to its number of todo and ready tasks and its weight
+        """
+        return dict((queue, {"todo": todo, "ready": self.num_ready(queue), "weight": self.weight(queue)})
+                    for queue, todo in self._num_todo.iteritems())
+
     def __len__(self):
         return len(self._queue)
 
@@ -280,6 +772,9 @@ class OpenTasks(object):
      with ordereddict.
 
     tasks that have an expected duration associated are being kept separate from those without a duration.
+
+    tasks waiting out a retry backoff are kept apart too, in a timer heap, so they aren't looked at again until
+     they are due.
     """
 
     def __init__(self, logger):
@@ -289,12 +784,16 @@ class OpenTasks(object):
         #  2) tasks without a duration
         self._durations = collections.OrderedDict()
         self._no_durations = collections.OrderedDict()
+        # tasks waiting to be retried, and when each is due
+        self._waiting = {}
+        self._backoffs = Timers()
 
-    def task_to_retry(self, current_time):
+    def task_to_retry(self, current_time, labels=None, pools=None, timeout_for=None):
         """
         Tasks get retried if:
             1) previous attempt failed (and they are allowed to have more attempts)
-            2) current attempt has been running for longer than expected duration
+            2) current attempt has gone longer than expected duration without a heartbeat (an attempt that never
+                heartbeats is timed from its start). Tasks without a duration use timeout_for(task) if given.
 
         If mulitple tasks match the above critera then the oldest one gets returned.
 
@@ -304,34 +803,59 @@ class OpenTasks(object):
         If there are tasks that have run out of attempts, they are "failed" and get returned as second value
          in tuple
 
+        A task whose most recent attempt failed or timed out while an earlier attempt of it is still running (a
+         speculative backup that failed) is neither: it is left to that attempt.
+
+        :param labels: the labels of the runner; a task requiring labels it doesn't have isn't returned for retry.
+         None allows every task.
+        :param pools: Pools; a task whose pool is full isn't returned for retry, unless its attempt timed out: that
+         attempt still holds a place in the pool, which its retry takes over
+        :param timeout_for: function of a task without a duration to the seconds its attempts get, or None if they
+         don't time out
         :return: (Task, failed_tasks)
         """
+        # tasks done waiting out their backoff get looked at again
+        for task_id in self._backoffs.due(current_time):
+            self.add_task(self._waiting.pop(task_id))
         # since both queues are ordered dicts the first one in the dict should be the oldest
         #  so we need to get the first one to be redone from each dict and then take the oldest of those two
         failed_tasks = []
         no_duration = None
         for task in self._no_durations.itervalues():
-            if task.most_recent_attempt().is_failed():
+            failed = task.most_recent_attempt().is_failed()
+            timed_out = False
+            if not failed and timeout_for is not None:
+                timeout = timeout_for(task)
+                timed_out = (timeout is not None and
+                             (current_time - task.most_recent_attempt().last_heartbeat).total_seconds() > timeout)
+            if (failed or timed_out) and self.has_running_attempt(task, current_time, timeout_for=timeout_for):
+                continue
+            if failed or timed_out:
                 if task.num_attempts() >= task.max_attempts:
-                    self._logger.debug("OpenTasks.task_to_retry: Task %s has failed attempt %d of %d. Treating it as failed." %
-                                       (str(task.task_id()), task.num_attempts(), task.max_attempts))
+                    self._logger.debug("OpenTasks.task_to_retry: Task %s has %s attempt %d of %d. Treating it as failed." %
+                                       (str(task.task_id()), "failed" if failed else "timed out", task.num_attempts(), task.max_attempts))
                     failed_tasks.append(task)
-                else:
-                    self._logger.debug("OpenTasks.task_to_retry: Task %s has failed attempt %d of %d. Should be retried." %
-                                       (str(task.task_id()), task.num_attempts(), task.max_attempts))
+                elif ((labels is None or task.labels <= labels) and
+                      (pools is None or (timed_out and not failed) or not pools.is_full(task.pool))):
+                    self._logger.debug("OpenTasks.task_to_retry: Task %s has %s attempt %d of %d. Should be retried." %
+                                       (str(task.task_id()), "failed" if failed else "timed out", task.num_attempts(),
+                                        task.max_attempts))
                     no_duration = task
                     break
 
         with_duration = None
         for task in self._durations.itervalues():
             failed = task.most_recent_attempt().is_failed()
-            timed_out = (current_time - task.most_recent_attempt().start_time).total_seconds() > task.duration
+            timed_out = (current_time - task.most_recent_attempt().last_heartbeat).total_seconds() > task.duration
+            if (failed or timed_out) and self.has_running_attempt(task, current_time):
+                continue
             if failed or timed_out:
                 if task.num_attempts() >= task.max_attempts:
                     self._logger.debug("OpenTasks.task_to_retry: Task %s has %s attempt %d of %d. Treating it as failed." %
                                        (str(task.task_id()), "failed" if failed else "timed out", task.num_attempts(), task.max_attempts))
                     failed_tasks.append(task)
-                else:
+                elif ((labels is None or task.labels <= labels) and
+                      (pools is None or (timed_out and not failed) or not pools.is_full(task.pool))):
                     self._logger.debug("OpenTasks.task_to_retry: Task %s has %s attempt %d of %d. Should be retried." %
                                        (str(task.task_id()), "failed" if failed else "timed out", task.num_attempts(),
                                         task.max_attempts))
@@ -355,6 +879,72 @@ class OpenTasks(object):
                                (str(retry_task.task_id()), len(failed_tasks)))
         return retry_task, failed_tasks
 
+    def has_running_attempt(self, task, current_time, timeout_for=None):
+        """
+        Whether an attempt of the task other than its most recent one is still running: in process and not timed
+         out. The first attempt to complete wins, so the task isn't retried or failed while one is.
+
+        :param timeout_for: as with task_to_retry, for a task without a duration
+        """
+        timeout = task.duration
+        if timeout is None and timeout_for is not None:
+            timeout = timeout_for(task)
+        most_recent = task.most_recent_attempt()
+        for attempt_id in task.attempt_ids():
+            attempt = task.get_attempt(attempt_id)
+            if (attempt is not most_recent and attempt.is_in_process() and
+                    (timeout is None or (current_time - attempt.last_heartbeat).total_seconds() <= timeout)):
+                return True
+        return False
+
+    def straggler(self, current_time, runner, straggler_after, labels=None, pools=None):
+        """
+        A task worth a backup attempt: its only open attempt is running on another runner, hasn't failed or timed out
+         and has run for longer than straggler_after(task) seconds, and the task has attempts left.
+
+        If mulitple tasks are stragglers the oldest one gets returned.
+
+        :param straggler_after: function of a task to the seconds after which it is a straggler, or None if it
+         can't be told yet
+        :param labels: the labels of the runner, as with task_to_retry
+        :param pools: Pools, as with task_to_retry
+        :return: Task or None
+        """
+        stragglers = []
+        for tasks in (self._no_durations, self._durations):
+            for task in tasks.itervalues():
+                attempt = task.most_recent_attempt()
+                if (not attempt.is_in_process() or attempt.runner == runner or
+                        task.num_attempts() >= task.max_attempts or task.num_open_attempts() > 1):
+                    continue
+                if (task.duration is not None and
+                        (current_time - attempt.last_heartbeat).total_seconds() > task.duration):
+                    continue
+                if (labels is not None and not task.labels <= labels) or (pools is not None and pools.is_full(task.pool)):
+                    continue
+                after = straggler_after(task)
+                if after is not None and (current_time - attempt.start_time).total_seconds() > after:
+                    stragglers.append(task)
+                    break
+        if not stragglers:
+            return None
+        task = min(stragglers, key=lambda t: t.created_time)
+        self._logger.debug("OpenTasks.straggler: Task %s is the oldest straggler." % str(task.task_id()))
+        return task
+
+    def back_off(self, task_id, until):
+        """
+        Keeps the task from being retried (or looked at) before until.
+        """
+        task = self._durations.pop(task_id, None) or self._no_durations.pop(task_id, None) or self._waiting.get(task_id)
+        if task is not None:
+            self._waiting[task_id] = task
+            self._backoffs.add(task_id, until)
+            self._logger.debug("OpenTasks.back_off: Task %s waits until %s to be retried." % (str(task_id), str(until)))
+
+    def num_waiting(self):
+        return len(self._waiting)
+
     def add_task(self, task):
         """
         If the task has an expected duration then add it to durations, otherwise add it to no durations
@@ -378,86 +968,1214 @@ class OpenTasks(object):
         elif task_id in self._durations:
             del self._durations[task_id]
             self._logger.debug("OpenTasks.remove_task: Task %s removed from durations." % str(task_id))
+        elif task_id in self._waiting:
+            del self._waiting[task_id]
+            self._backoffs.remove(task_id)
+            self._logger.debug("OpenTasks.remove_task: Task %s removed from waiting." % str(task_id))
 
     def get_task(self, task_id):
         # the task doesn't exist here then return none
         task = self._durations.get(task_id)
         if task is None:
             task = self._no_durations.get(task_id)
+        if task is None:
+            task = self._waiting.get(task_id)
         return task
 
     def all_tasks(self):
         tasks = []
         tasks.extend(self._durations.values())
         tasks.extend(self._no_durations.values())
+        tasks.extend(self._waiting.values())
         return sorted(tasks, key=lambda task: task.created_time)
 
     def __len__(self):
-        return len(self._durations) + len(self._no_durations)
+        return len(self._durations) + len(self._no_durations) + len(self._waiting)
 
 
-class TaskManager(object):
+class DoneTasks(object):
+    """
+    Tasks that are no longer being attempted, kept apart as completed, failed and cancelled so that listing any one
+     only touches the tasks in it. A task is completed if any attempt completed, cancelled if it was cancelled
+     before it could be attempted and failed otherwise (including a task whose last attempt timed out).
+
+    Each list is in the order its tasks got there, so the oldest done task of a list is always first.
+    """
 
     def __init__(self, logger):
-        self._todo_queue = SimpleTaskQueue(logger)
+        self._completed = collections.OrderedDict()
+        self._failed = collections.OrderedDict()
+        self._cancelled = collections.OrderedDict()
+        self._lists = {"completed": self._completed, "failed": self._failed, "cancelled": self._cancelled}
+        # task id to when it was done
+        self._done_times = {}
+        self._logger = logger
+
+    def add(self, task, done_time=None):
+        if task.is_completed():
+            self._completed[task.task_id()] = task
+        elif task.is_cancelled():
+            self._cancelled[task.task_id()] = task
+        else:
+            self._failed[task.task_id()] = task
+        self._done_times[task.task_id()] = done_time if done_time is not None else datetime.datetime.now()
+
+    def mark_completed(self, task_id, done_time=None):
+        """
+        Moves a failed task to completed, for when a late attempt completes after the task was given up on.
+
+        :return: True if the task was moved
+        """
+        task = self._failed.pop(task_id, None)
+        if task is None:
+            return False
+        self._completed[task_id] = task
+        self._done_times[task_id] = done_time if done_time is not None else datetime.datetime.now()
+        self._logger.debug("DoneTasks.mark_completed: Task %s moved from failed to completed." % str(task_id))
+        return True
+
+    def get(self, task_id):
+        task = self._completed.get(task_id)
+        if task is None:
+            task = self._failed.get(task_id)
+        if task is None:
+            task = self._cancelled.get(task_id)
+        return task
+
+    def remove(self, task_id):
+        """
+        If task doesn't exist then no-op.
+        """
+        if self._completed.pop(task_id, None) is None and self._failed.pop(task_id, None) is None:
+            self._cancelled.pop(task_id, None)
+        self._done_times.pop(task_id, None)
+
+    def done_time(self, task_id):
+        return self._done_times.get(task_id)
+
+    def next_expired(self, list_type, now, max_age=None, max_count=None):
+        """
+        The oldest task of a list if it is past retention: the list holds more than max_count tasks or the task was
+         done more than max_age seconds before now. Only the oldest task is looked at.
+
+        :param list_type: "completed", "failed" or "cancelled"
+        :return: task id, or None if nothing in the list has expired
+        """
+        tasks = self._lists[list_type]
+        if not tasks:
+            return None
+        task_id = next(iter(tasks))
+        if max_count is not None and len(tasks) > max_count:
+            return task_id
+        if max_age is not None and (now - self._done_times[task_id]).total_seconds() > max_age:
+            return task_id
+        return None
+
+    def is_completed(self, task_id):
+        return task_id in self._completed
+
+    def is_cancelled(self, task_id):
+        return task_id in self._cancelled
+
+    def completed_tasks(self):
+        return self._completed.values()
+
+    def failed_tasks(self):
+        return self._failed.values()
+
+    def cancelled_tasks(self):
+        return self._cancelled.values()
+
+    def all_tasks(self):
+        tasks = self._completed.values()
+        tasks.extend(self._failed.values())
+        tasks.extend(self._cancelled.values())
+        return tasks
+
+    def num_completed(self):
+        return len(self._completed)
+
+    def num_failed(self):
+        return len(self._failed)
+
+    def num_cancelled(self):
+        return len(self._cancelled)
+
+    def __contains__(self, task_id):
+        return task_id in self._completed or task_id in self._failed or task_id in self._cancelled
+
+    def __len__(self):
+        return len(self._completed) + len(self._failed) + len(self._cancelled)
+
+
+class TaskIndex(object):
+    """
+    Secondary indexes for finding tasks without looking at every one: by name, by the runners that have attempted it,
+     by created time and, if index_commands is set, by command prefix.
+
+    Every index is a sorted list of (created_time, sequence, task_id) keys, so any of them can be range searched by
+     created time and paged through in created order. Commands are kept in a sorted list of (command, key) where a
+     prefix is a contiguous range, but not in created order, so a page of a command prefix costs the size of its
+     range (see query).
+
+    Keys mostly arrive in created order so adding to the created time indexes is an append. Adding to the command
+     index (and removing from any index) is a bisect and a list insert or delete, which moves the entries after it:
+     O(n), though done as a single memmove.
+    """
+
+    CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+    def __init__(self, logger, index_commands=False):
+        self._index_commands = index_commands
+        self._seq = itertools.count()
+        self._keys = {}
+        self._tasks = {}
+        self._created = []
+        self._by_name = {}
+        self._by_runner = {}
+        # task id to the runners it has been indexed under
+        self._runners = {}
+        self._commands = []
+        self._logger = logger
+
+    @staticmethod
+    def _insert(keys, key):
+        # tasks mostly arrive in created order so this is usually an append
+        if not keys or keys[-1] < key:
+            keys.append(key)
+        else:
+            bisect.insort(keys, key)
+
+    @staticmethod
+    def _delete(keys, key):
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    def add(self, task):
+        task_id = task.task_id()
+        if task_id in self._keys:
+            return
+        key = (task.created_time, next(self._seq), task_id)
+        self._keys[task_id] = key
+        self._tasks[task_id] = task
+        self._insert(self._created, key)
+        self._insert(self._by_name.setdefault(task.name, []), key)
+        if self._index_commands:
+            bisect.insort(self._commands, (task.cmd, key))
+
+    def add_runner(self, task_id, runner):
+        key = self._keys.get(task_id)
+        runners = self._runners.setdefault(task_id, set()) if key is not None else None
+        if runners is None or runner in runners:
+            return
+        runners.add(runner)
+        self._insert(self._by_runner.setdefault(runner, []), key)
+
+    def remove(self, task_id):
+        """
+        If task doesn't exist then no-op.
+        """
+        key = self._keys.pop(task_id, None)
+        if key is None:
+            return
+        task = self._tasks.pop(task_id)
+        self._delete(self._created, key)
+        self._remove_key(self._by_name, task.name, key)
+        for runner in self._runners.pop(task_id, ()):
+            self._remove_key(self._by_runner, runner, key)
+        if self._index_commands:
+            self._delete(self._commands, (task.cmd, key))
+
+    def _remove_key(self, index, value, key):
+        keys = index.get(value)
+        if keys is not None:
+            self._delete(keys, key)
+            if not keys:
+                del index[value]
+
+    def _command_range(self, prefix):
+        start = bisect.bisect_left(self._commands, (prefix,))
+        if not prefix:
+            return start, len(self._commands)
+        # every command with the prefix sorts before the prefix with its last character bumped up by one
+        end = bisect.bisect_left(self._commands, (prefix[:-1] + unichr(ord(prefix[-1]) + 1),))
+        return start, end
+
+    def cursor(self, task_id):
+        key = self._keys[task_id]
+        return "%s.%d" % (key[0].strftime(self.CURSOR_TIME_FORMAT), key[1])
+
+    def _parse_cursor(self, cursor):
+        created, seq = cursor.split(".")
+        return datetime.datetime.strptime(created, self.CURSOR_TIME_FORMAT), int(seq)
+
+    def query(self, name=None, runner=None, created_after=None, created_before=None, command_prefix=None, cursor=None,
+              limit=100):
+        """
+        Tasks matching every criteria given, oldest first. Only the smallest index that applies is walked and the
+         other criteria are checked against each task in it.
+
+        When the command prefix is the smallest index, its range isn't in created order, so the whole range is
+         scanned and the oldest limit matches kept: O(range * log(limit)) per page.
+
+        :param created_after: inclusive
+        :param created_before: exclusive
+        :param cursor: the cursor returned with the previous page
+        :return: (tasks, cursor for the next page or None if there are no more)
+        """
+        candidates = [self._created]
+        if name is not None:
+            candidates.append(self._by_name.get(name, []))
+        if runner is not None:
+            candidates.append(self._by_runner.get(runner, []))
+        keys = min(candidates, key=len)
+        if command_prefix is not None and self._index_commands:
+            start, end = self._command_range(command_prefix)
+            if end - start < len(keys):
+                return self._query_commands(start, end, name, runner, created_after, created_before, cursor, limit)
+
+        start = 0
+        if created_after is not None:
+            start = bisect.bisect_left(keys, (created_after,))
+        if cursor is not None:
+            # past the last key of the previous page
+            created_time, seq = self._parse_cursor(cursor)
+            start = max(start, bisect.bisect_left(keys, (created_time, seq + 1)))
+        tasks = []
+        for i in xrange(start, len(keys)):
+            created_time, _, task_id = keys[i]
+            if created_before is not None and created_time >= created_before:
+                return tasks, None
+            if not self._matches(task_id, name, runner, command_prefix):
+                continue
+            if len(tasks) == limit:
+                return tasks, self.cursor(tasks[-1].task_id())
+            tasks.append(self._tasks[task_id])
+        return tasks, None
+
+    def _matches(self, task_id, name, runner, command_prefix):
+        task = self._tasks[task_id]
+        if name is not None and task.name != name:
+            return False
+        if runner is not None and runner not in self._runners.get(task_id, ()):
+            return False
+        return command_prefix is None or task.cmd.startswith(command_prefix)
+
+    def _query_commands(self, start, end, name, runner, created_after, created_before, cursor, limit):
+        """
+        A page of the tasks in the command index range [start, end) matching the other criteria, oldest first.
+        """
+        low = (created_after,) if created_after is not None else None
+        if cursor is not None:
+            created_time, seq = self._parse_cursor(cursor)
+            low = max(low, (created_time, seq + 1)) if low is not None else (created_time, seq + 1)
+        matches = (key for _, key in itertools.islice(self._commands, start, end)
+                   if (low is None or key >= low) and (created_before is None or key[0] < created_before) and
+                   self._matches(key[2], name, runner, None))
+        # one more than a page tells if there is a next page
+        keys = heapq.nsmallest(limit + 1, matches)
+        tasks = [self._tasks[key[2]] for key in keys[:limit]]
+        return tasks, self.cursor(tasks[-1].task_id()) if len(keys) > limit else None
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class RunnerRegistry(object):
+    """
+    The runners that have talked to the server: when each was last seen and the attempts each has in flight.
+
+    Runners that are alive are kept in last seen order, oldest first, so finding the ones that have gone quiet for
+     longer than the liveness window only looks at those runners. Only the max_dead most recently dead runners are
+     kept; older ones are forgotten.
+    """
+
+    def __init__(self, logger, liveness_seconds=None, max_dead=1000):
+        self.liveness_seconds = liveness_seconds
+        self.max_dead = max_dead
+        self._alive = collections.OrderedDict()
+        # in the order they died, oldest first
+        self._dead = collections.OrderedDict()
+        # runner to the attempts it has in flight, as attempt id to task id
+        self._attempts = {}
+        self._logger = logger
+
+    def seen(self, runner, time_stamp):
+        if runner in self._dead:
+            del self._dead[runner]
+            self._logger.info("RunnerRegistry.seen: Runner %s is back." % str(runner))
+        self._alive.pop(runner, None)
+        self._alive[runner] = time_stamp
+
+    def attempt_started(self, runner, task_id, attempt_id):
+        self._attempts.setdefault(runner, collections.OrderedDict())[attempt_id] = task_id
+
+    def attempt_ended(self, runner, attempt_id):
+        """
+        If the attempt isn't in flight for the runner then no-op.
+        """
+        attempts = self._attempts.get(runner)
+        if attempts is not None:
+            attempts.pop(attempt_id, None)
+            if not attempts:
+                del self._attempts[runner]
+
+    def attempts(self, runner):
+        """
+        :return: list of (task_id, attempt_id) in flight for the runner
+        """
+        return [(task_id, attempt_id) for attempt_id, task_id in self._attempts.get(runner, {}).iteritems()]
+
+    def dead_runners(self, current_time):
+        """
+        Marks every runner not seen within the liveness window as dead.
+
+        :return: list of the runners that have just been marked dead
+        """
+        dead = []
+        if self.liveness_seconds is None:
+            return dead
+        for runner, last_seen in self._alive.iteritems():
+            if (current_time - last_seen).total_seconds() <= self.liveness_seconds:
+                break
+            dead.append(runner)
+        for runner in dead:
+            self._dead[runner] = self._alive.pop(runner)
+            self._logger.info("RunnerRegistry.dead_runners: Runner %s has not been seen since %s." %
+                              (str(runner), str(self._dead[runner])))
+        while len(self._dead) > self.max_dead:
+            runner, _ = self._dead.popitem(last=False)
+            self._logger.debug("RunnerRegistry.dead_runners: Forgetting Runner %s." % str(runner))
+        return dead
+
+    def runners(self):
+        """
+        :return: list of dicts of runner, last_seen, alive and attempts (list of (task_id, attempt_id))
+        """
+        runners = []
+        for registry, alive in ((self._alive, True), (self._dead, False)):
+            for runner, last_seen in registry.iteritems():
+                runners.append({"runner": runner, "last_seen": last_seen, "alive": alive,
+                                "attempts": self.attempts(runner)})
+        return runners
+
+    def __len__(self):
+        return len(self._alive) + len(self._dead)
+
+
+class RuntimeSketch(object):
+    """
+    What is known about the runtimes of a family of tasks in constant memory: how many there were, their
+     exponentially weighted moving average and a quantile sketch.
+
+    The sketch counts runtimes in buckets whose bounds grow by a factor of (1 + accuracy), so any quantile is known
+     to within that relative accuracy (rounded up) and a day's range of runtimes takes a few hundred buckets at most.
+    """
+
+    # runtimes below this many seconds are counted as this
+    MIN_SECONDS = 0.001
+
+    def __init__(self, alpha=0.2, accuracy=0.05):
+        self.alpha = alpha
+        self._log_gamma = math.log(1 + accuracy)
+        self.count = 0
+        self.ewma = None
+        # bucket to how many runtimes are in it, bucket i holding (gamma^(i-1), gamma^i]
+        self._buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        bucket = int(math.ceil(math.log(max(seconds, self.MIN_SECONDS)) / self._log_gamma))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def quantile(self, q):
+        """
+        :param q: between 0 and 1
+        :return: the q quantile of the runtimes in seconds, or None if there are none
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return math.exp(bucket * self._log_gamma)
+
+    def num_buckets(self):
+        return len(self._buckets)
+
+
+class RuntimeStats(object):
+    """
+    Runtimes of completed attempts learned per family of tasks, so how long an attempt of a family usually runs can
+     be told without being given (see RuntimeSketch). At most max_families families are kept; the one that got a
+     runtime least recently is forgotten first.
+    """
+
+    def __init__(self, logger, max_families=10000, min_samples=10, alpha=0.2, accuracy=0.05):
+        self.max_families = max_families
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.accuracy = accuracy
+        # family to its RuntimeSketch, least recently updated first
+        self._families = collections.OrderedDict()
+        # family to its quantiles (quantile to runtime), until the family gets another runtime
+        self._quantiles = {}
+        self._logger = logger
+
+    def observe(self, family, seconds):
+        sketch = self._families.pop(family, None)
+        if sketch is None:
+            sketch = RuntimeSketch(alpha=self.alpha, accuracy=self.accuracy)
+            if len(self._families) >= self.max_families:
+                forgotten, _ = self._families.popitem(last=False)
+                self._quantiles.pop(forgotten, None)
+                self._logger.debug("RuntimeStats.observe: Forgot the runtimes of %s." % str(forgotten))
+        self._families[family] = sketch
+        sketch.add(seconds)
+        self._quantiles.pop(family, None)
+
+    def ewma(self, family):
+        """
+        :return: the family's moving average runtime in seconds, or None if it has no runtimes
+        """
+        sketch = self._families.get(family)
+        return sketch.ewma if sketch is not None else None
+
+    def quantile(self, family, q):
+        """
+        :param q: between 0 and 1
+        :return: the q quantile of the family's runtimes in seconds, or None if it has fewer than min_samples
+        """
+        quantiles = self._quantiles.get(family)
+        if quantiles is None or q not in quantiles:
+            sketch = self._families.get(family)
+            if sketch is None or sketch.count < self.min_samples:
+                return None
+            # only families with a sketch are cached, so the cache is forgotten along with the sketch
+            quantiles = self._quantiles.setdefault(family, {})
+            quantiles[q] = sketch.quantile(q)
+        return quantiles[q]
+
+    def num_samples(self, family):
+        sketch = self._families.get(family)
+        return sketch.count if sketch is not None else 0
+
+    def __len__(self):
+        return len(self._families)
+
+
+class ResultCache(object):
+    """
+    Which task completed each cache key, for ttl seconds after it completed. At most max_size keys are kept; the
+     least recently used one is forgotten first.
+    """
+
+    def __init__(self, logger, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # cache key to (task id, completed time), least recently used first
+        self._results = collections.OrderedDict()
+        self._logger = logger
+
+    def put(self, key, task_id, completed_time):
+        self._results.pop(key, None)
+        self._results[key] = (task_id, completed_time)
+        while len(self._results) > self.max_size:
+            forgotten, _ = self._results.popitem(last=False)
+            self._logger.debug("ResultCache.put: Forgot the result of %s." % str(forgotten))
+
+    def get(self, key, now):
+        """
+        :return: the id of the task that completed key within the ttl before now, or None
+        """
+        result = self._results.pop(key, None)
+        if result is None:
+            return None
+        task_id, completed_time = result
+        if (now - completed_time).total_seconds() > self.ttl:
+            return None
+        self._results[key] = result
+        return task_id
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def __len__(self):
+        return len(self._results)
+
+
+class IdempotencyKeys(object):
+    """
+    The task each idempotency key was used to add, for ttl seconds. Keys are kept in the order they were first
+     used, so expired ones are dropped from the front as new ones come in; at most max_size are kept.
+    """
+
+    def __init__(self, logger, ttl, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key to (task id, when it was used), oldest first
+        self._keys = collections.OrderedDict()
+        self._logger = logger
+
+    def _expire(self, now):
+        while self._keys:
+            key, (task_id, used) = next(self._keys.iteritems())
+            if (now - used).total_seconds() <= self.ttl and len(self._keys) <= self.max_size:
+                return
+            del self._keys[key]
+
+    def add(self, key, task_id, now):
+        self._keys.pop(key, None)
+        self._keys[key] = (task_id, now)
+        self._expire(now)
+
+    def get(self, key, now):
+        """
+        :return: the id of the task added with key within the ttl before now, or None
+        """
+        self._expire(now)
+        entry = self._keys.get(key)
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class CriticalPath(object):
+    """
+    Each unfinished task's remaining critical path: its expected duration plus the longest remaining critical path
+     of the tasks that depend on it. Starting the ready task with the longest one first keeps long chains from
+     starting late and stretching out the whole DAG.
+
+    Kept up to date as tasks are added and removed, only following the paths whose length changes.
+    """
+
+    def __init__(self, logger, estimate):
+        """
+        :param estimate: function of a task to its expected duration in seconds
+        """
+        self._estimate = estimate
+        self._tasks = {}
+        self._durations = {}
+        self._ranks = {}
+        # task id to the ids of the tracked tasks that depend on it
+        self._dependents = {}
+        self._logger = logger
+
+    def rank(self, task_id):
+        return self._ranks.get(task_id)
+
+    def add(self, task):
+        """
+        :return: list of the ids of the other tasks whose rank went up
+        """
+        task_id = task.task_id()
+        self._tasks[task_id] = task
+        self._durations[task_id] = self._estimate(task)
+        self._dependents[task_id] = set()
+        self._ranks[task_id] = self._durations[task_id]
+        for dependency in task.dependent_on:
+            if dependency in self._tasks:
+                self._dependents[dependency].add(task_id)
+        return self._raise(task_id)
+
+    def _raise(self, task_id):
+        changed = []
+        stack = [task_id]
+        while stack:
+            child = stack.pop()
+            for dependency in self._tasks[child].dependent_on:
+                if dependency in self._tasks:
+                    rank = self._durations[dependency] + self._ranks[child]
+                    if rank > self._ranks[dependency]:
+                        self._ranks[dependency] = rank
+                        changed.append(dependency)
+                        stack.append(dependency)
+        return changed
+
+    def remove(self, task_id):
+        """
+        Stops tracking a task that is done or deleted. If task doesn't exist then no-op.
+
+        :return: list of the ids of the other tasks whose rank went down
+        """
+        task = self._tasks.pop(task_id, None)
+        if task is None:
+            return []
+        del self._durations[task_id]
+        del self._ranks[task_id]
+        del self._dependents[task_id]
+        changed = []
+        stack = []
+        for dependency in task.dependent_on:
+            if dependency in self._tasks:
+                self._dependents[dependency].discard(task_id)
+                stack.append(dependency)
+        while stack:
+            parent = stack.pop()
+            rank = self._durations[parent] + max([self._ranks[child] for child in self._dependents[parent]] or [0])
+            if rank != self._ranks[parent]:
+                self._ranks[parent] = rank
+                changed.append(parent)
+                stack.extend(dependency for dependency in self._tasks[parent].dependent_on if dependency in self._tasks)
+        return changed
+
+    def __len__(self):
+        return len(self._tasks)
+
+
+class ChangeFeed(object):
+    """
+    The most recent `capacity` changes, each with a sequence number one higher than the one before it. Kept in a
+     fixed size ring so both adding a change and finding where a cursor left off are O(1).
+    """
+
+    def __init__(self, capacity=10000):
+        self._capacity = capacity
+        self._events = [None] * capacity
+        self._next_seq = 1
+
+    def append(self, event):
+        """
+        Adds the event dict, setting its 'seq'. Once the feed is full the oldest event is dropped.
+
+        :return: the event's sequence number
+        """
+        seq = self._next_seq
+        event['seq'] = seq
+        self._events[seq % self._capacity] = event
+        self._next_seq += 1
+        return seq
+
+    def last_seq(self):
+        return self._next_seq - 1
+
+    def first_seq(self):
+        return max(1, self._next_seq - self._capacity)
+
+    def since(self, seq, limit=None):
+        """
+        The events after seq, oldest first, up to limit of them.
+
+        :return: (events, resync) where resync is True if events after seq have already been dropped (or seq is
+         ahead of the feed). Then events is empty and the consumer needs to start over from the full task lists.
+        """
+        last_seq = self.last_seq()
+        if seq > last_seq or seq + 1 < self.first_seq():
+            return [], True
+        end = last_seq if limit is None else min(last_seq, seq + limit)
+        return [self._events[i % self._capacity] for i in xrange(seq + 1, end + 1)], False
+
+    def __len__(self):
+        return self.last_seq() - self.first_seq() + 1 if self._next_seq > 1 else 0
+
+
+class TaskManager(object):
+
+    LIST_TYPES = ("todo", "inprocess", "failed", "completed", "cancelled")
+    UPSTREAM_FAILED = "cancelled: upstream failed"
+    UPSTREAM_DELETED = "cancelled: upstream deleted"
+    UPSTREAM_EXPIRED = "cancelled: upstream expired"
+    # the runner of the attempts that complete tasks from cached results
+    CACHE_RUNNER = "cache"
+    EXPIRED = "cancelled: expired"
+    PRIORITY_POLICIES = ("fifo", "critical_path")
+    # what a task without a duration is expected to take, in seconds
+    DEFAULT_EXPECTED_DURATION = 1.0
+
+    def __init__(self, logger, attempt_ids=None, change_feed_size=10000, index_commands=False, runner_timeout=None,
+                 queue_weights=None, pool_limits=None, priority_policy="fifo", retention=None,
+                 speculate_quantile=None, adaptive_timeout=None, result_cache_ttl=None, result_cache_size=10000,
+                 idempotency_ttl=86400, idempotency_size=100000):
+        """
+        :param priority_policy: "fifo" attempts ready tasks oldest first. "critical_path" attempts the ready task with
+         the longest chain of work left behind it (by expected durations) first.
+        :param queue_weights: dict of queue name to its share of attempts relative to the other queues. Queues not
+         in it have a weight of 1.
+        :param pool_limits: dict of concurrency pool name to the max number of its attempts in flight at once
+        :param retention: dict of "completed" and/or "failed" to (max age in seconds, max count) of the done tasks
+         kept, either of which can be None. Cancelled tasks are kept like failed ones. See compact.
+        :param speculate_quantile: when given, an attempt that has run longer than this quantile (e.g. 0.9) of the
+         runtimes of its family (see task_family) gets a backup attempt on another runner that has nothing else to
+         do, within max_attempts. The first attempt to complete wins.
+        :param adaptive_timeout: when given, an attempt of a task without a duration times out after the 99th
+         percentile of its family's runtimes times this factor, once the family has enough runtimes
+        :param result_cache_ttl: when given, tasks with a cache key are memoized. A task added (and ready) within
+         this many seconds of another task with its cache key completing is completed right away from that result,
+         and one added while another task with its cache key is pending rides on that task instead of running. The
+         results of up to result_cache_size cache keys are kept.
+        :param idempotency_ttl: seconds an idempotency key given to add_task is remembered for, up to
+         idempotency_size of them
+        """
+        self._attempt_ids = attempt_ids if attempt_ids is not None else UUIDGenerator()
+        self._runners = RunnerRegistry(logger, liveness_seconds=runner_timeout)
+        self._index = TaskIndex(logger, index_commands=index_commands)
+        self._pools = Pools(logger, limits=pool_limits)
+        # attempt id to the pool it holds a place in
+        self._pool_attempts = {}
+        self._todo_queue = SimpleTaskQueue(logger, weights=queue_weights, pools=self._pools)
+        assert priority_policy in self.PRIORITY_POLICIES
+        self._critical_path = CriticalPath(logger, self.expected_duration) if priority_policy == "critical_path" else None
         self._in_process = OpenTasks(logger)
-        self._done = collections.OrderedDict()
+        self._done = DoneTasks(logger)
+        self._retention = dict(retention or {})
+        # todo tasks that can't be attempted before a time and todo tasks dropped if not attempted by a time
+        self._delays = Timers()
+        self._expiries = Timers()
+        self._speculate_quantile = speculate_quantile
+        self._adaptive_timeout = adaptive_timeout
+        self._runtimes = RuntimeStats(logger)
+        self._results = None
+        if result_cache_ttl is not None:
+            self._results = ResultCache(logger, result_cache_ttl, max_size=result_cache_size)
+        # cache key to the pending task standing in for every task with it, that task's id to the ids of the tasks
+        #  riding on it and each of those back to it
+        self._cache_leaders = {}
+        self._riders = {}
+        self._riding = {}
+        self._idempotency_keys = IdempotencyKeys(logger, idempotency_ttl, max_size=idempotency_size)
+        # task id to the ids of the tasks that are dependent on it
+        self._dependents = {}
+        # moves forward every time something in the list changes, so a list that hasn't changed can be recognized
+        self._list_versions = dict((list_type, 0) for list_type in self.LIST_TYPES)
+        self._changes = ChangeFeed(change_feed_size)
+        # blocked task id to the ids of its dependencies that aren't completed yet
+        self._unmet = {}
+        # counts that can't be had from the length of a container
+        self._counts = {"attempts_in_flight": 0, "retries_pending": 0}
+        # queue name to its in process, completed and failed counts
+        self._queue_counts = {}
         self._logger = logger
 
-    def _move_task_to_done(self, task):
+    def _tally(self, task):
+        """
+        What the task adds to the attempts in flight and retries pending counts.
+        """
+        if self._in_process.get_task(task.task_id()) is None:
+            return 0, 0
+        recent = task.most_recent_attempt()
+        retry_pending = recent.is_failed() and task.num_attempts() < task.max_attempts
+        return task.num_open_attempts(), 1 if retry_pending else 0
+
+    def _retally(self, task, before):
+        in_flight, retry_pending = self._tally(task)
+        self._counts["attempts_in_flight"] += in_flight - before[0]
+        self._counts["retries_pending"] += retry_pending - before[1]
+
+    def _count(self, task, list_type, delta):
+        counts = self._queue_counts.get(task.queue)
+        if counts is None:
+            counts = self._queue_counts[task.queue] = collections.Counter()
+        counts[list_type] += delta
+
+    def queue_stats(self):
+        """
+        :return: dict of queue name to its weight and its counts of todo, ready, in process, completed, failed and
+         cancelled tasks
+        """
+        stats = self._todo_queue.queue_stats()
+        for queue, counts in self._queue_counts.iteritems():
+            if queue not in stats:
+                stats[queue] = {"todo": 0, "ready": 0, "weight": self._todo_queue.weight(queue)}
+        for queue, queue_stats in stats.iteritems():
+            counts = self._queue_counts.get(queue, {})
+            for list_type in ("in_process", "completed", "failed", "cancelled"):
+                queue_stats[list_type] = counts.get(list_type, 0)
+        return stats
+
+    def stats(self):
+        """
+        Counts of tasks in each state and of attempts, all kept up to date as tasks change so this is O(1) (well,
+         O(number of queues) for the per queue counts).
+        """
+        todo = len(self._todo_queue)
+        ready = self._todo_queue.num_ready()
+        parked = self._todo_queue.num_parked()
+        return {"todo": todo,
+                "ready": ready,
+                "parked": parked,
+                "delayed": len(self._delays),
+                "coalesced": len(self._riding),
+                "blocked": todo - ready - parked - len(self._delays) - len(self._riding),
+                "in_process": len(self._in_process),
+                "completed": self._done.num_completed(),
+                "failed": self._done.num_failed(),
+                "cancelled": self._done.num_cancelled(),
+                "attempts_in_flight": self._counts["attempts_in_flight"],
+                "retries_pending": self._counts["retries_pending"],
+                "retries_waiting": self._in_process.num_waiting(),
+                "queues": self.queue_stats(),
+                "pools": self.pool_stats()}
+
+    def _release_dependents(self, task_id, time_stamp):
+        """
+        Task task_id has completed so any task that was only waiting on it is now ready.
+        """
+        for dependent_id in list(self._dependents.get(task_id, [])):
+            unmet = self._unmet.get(dependent_id)
+            if unmet is not None:
+                unmet.discard(task_id)
+                if not unmet:
+                    del self._unmet[dependent_id]
+                    if dependent_id not in self._delays:
+                        self._set_ready(self._todo_queue.task(dependent_id), time_stamp)
+                        self._logger.debug("TaskManager._release_dependents: Task %s is ready." % str(dependent_id))
+
+    def _set_ready(self, task, time_stamp):
+        """
+        A task with nothing left to wait for is completed with the cached result for its cache key if there is one,
+         rides on the task already standing in for its cache key if there is one, and otherwise is made ready (and
+         stands in for its cache key). Only ready tasks stand in, so the tasks riding on one never wait on a task
+         that is itself waiting. A task that is already ready, parked or riding is left as it is.
+        """
+        task_id = task.task_id()
+        if self._todo_queue.is_ready(task_id) or self._todo_queue.is_parked(task_id) or task_id in self._riding:
+            return
+        if self._results is not None and task.cache_key is not None:
+            cached_from = self._results.get(task.cache_key, time_stamp)
+            if cached_from is not None:
+                self._complete_from_cache(task, cached_from, time_stamp)
+                return
+            leader_id = self._cache_leaders.get(task.cache_key)
+            if leader_id is not None:
+                self._riders.setdefault(leader_id, []).append(task_id)
+                self._riding[task_id] = leader_id
+                self._logger.info("TaskManager._set_ready: Task %s rides on Task %s." % (str(task_id), str(leader_id)))
+                return
+            self._cache_leaders[task.cache_key] = task_id
+        self._todo_queue.set_ready(task_id)
+
+    def fire_timers(self, current_time):
+        """
+        Delayed tasks that are due become ready (unless still waiting on dependencies) and todo tasks that have
+         expired are cancelled, along with the tasks waiting on them. Only due timers are looked at.
+        """
+        for task_id in self._delays.due(current_time):
+            task = self._todo_queue.task(task_id)
+            if task is not None and task_id not in self._unmet:
+                self._set_ready(task, current_time)
+                self._logger.debug("TaskManager.fire_timers: Task %s is due and ready." % str(task_id))
+        for task_id in self._expiries.due(current_time):
+            task = self._todo_queue.task(task_id)
+            if task is not None:
+                task.cancel(self.EXPIRED)
+                self._move_task_to_done(task, current_time)
+                self._cancel_dependents(task_id, self.UPSTREAM_EXPIRED, current_time)
+                self._logger.info("TaskManager.fire_timers: Task %s expired before it was attempted." % str(task_id))
+
+    def _record(self, event, task_id, list_type, attempt_id=None):
+        self._changes.append({'event': event, 'task_id': task_id, 'attempt_id': attempt_id, 'list': list_type})
+
+    def changes(self, since, limit=None):
+        """
+        The changes to tasks after sequence number `since`. Each change is a dict with its seq, the event ("added",
+         "attempt_started", "attempt_failed", "attempt_completed", "done" or "deleted"), the task_id, the
+         attempt_id (None if not about an attempt) and the list the task is in after the change (None once deleted).
+
+        :return: (changes, resync, last_seq). If resync is True the changes after `since` are no longer kept; read
+         the full task lists again and continue from last_seq.
+        """
+        events, resync = self._changes.since(since, limit=limit)
+        return events, resync, self._changes.last_seq()
+
+    def _changed(self, *list_types):
+        """
+        Moves forward the versions of the lists whose tasks (or what is shown of them) changed. Only those lists,
+         so a client holding an unchanged list doesn't fetch it again.
+        """
+        for list_type in set(list_types):
+            if list_type is not None:
+                self._list_versions[list_type] += 1
+
+    def _dependency_lists(self, task):
+        """
+        The done lists of the tasks task depends on. Those lists show their tasks' dependents, so they change when
+         task is added or deleted.
+        """
+        return [self._list_type(dependency) for dependency in
+                (self._done.get(task_id) for task_id in task.dependent_on) if dependency is not None]
+
+    def list_version(self, list_type):
+        """
+        The version of one of the task lists (todo, inprocess, failed, completed, cancelled). The version moves
+         forward every time a task enters, leaves or changes in that list.
+
+        :return: int, or None for an unknown list type
+        """
+        return self._list_versions.get(list_type)
+
+    def _move_task_to_done(self, task, time_stamp=None):
+        """
+        :param time_stamp: when the task was done. Defaults to now.
+        """
+        time_stamp = time_stamp if time_stamp is not None else datetime.datetime.now()
         task_id = task.task_id()
+        left = None
         if self._find_task(task_id, in_process=True) is not None:
             self._in_process.remove_task(task_id)
+            self._count(task, "in_process", -1)
+            left = "inprocess"
             self._logger.debug("TaskManager._move_task_to_done: Task %s removed from in process tasks." % str(task_id))
         elif self._find_task(task_id, todo=True) is not None:
-            self._todo_queue.remove_task(task_id)
+            self._remove_from_todo(task)
+            left = "todo"
             self._logger.debug("TaskManager._move_task_to_done: Task %s removed from todo tasks." % str(task_id))
-        self._done[task.task_id()] = task
+        self._done.add(task, done_time=time_stamp)
+        if self._critical_path is not None:
+            self._reprioritize(self._critical_path.remove(task_id))
+        # attempts still out there (timed out ones, the losing backup of a speculative pair) are no longer in flight
+        #  for their runners and no longer count against the pool
+        for attempt_id in task.attempt_ids():
+            self._attempt_ended(task.get_attempt(attempt_id))
+        self._unmet.pop(task_id, None)
+        self._delays.remove(task_id)
+        self._expiries.remove(task_id)
+        list_type = self._list_type(task)
+        self._count(task, list_type, 1)
+        self._changed(left, list_type)
+        self._record("done", task_id, list_type)
+        if list_type == "completed":
+            self._release_dependents(task_id, task.completed_time())
+        elif list_type == "failed":
+            self._cancel_dependents(task_id, self.UPSTREAM_FAILED, time_stamp)
+        self._leave_cache(task)
         self._logger.debug("TaskManager._move_task_to_done: Task %s added to done tasks." % str(task_id))
 
-    def start_next_attempt(self, runner, current_time):
+    def _leave_cache(self, task):
+        """
+        Unties a task that is done or deleted from the tasks that share its cache key. The tasks riding on it are
+         completed with it if it completed; otherwise the first of them stands in for the rest and gets attempted.
+        """
+        task_id = task.task_id()
+        leader_id = self._riding.pop(task_id, None)
+        if leader_id is not None:
+            self._riders[leader_id].remove(task_id)
+            return
+        if task.cache_key is None or self._cache_leaders.get(task.cache_key) != task_id:
+            return
+        del self._cache_leaders[task.cache_key]
+        riders = self._riders.pop(task_id, [])
+        for rider_id in riders:
+            del self._riding[rider_id]
+        if task.is_completed() and self._find_task(task_id, done=True) is not None:
+            self._results.put(task.cache_key, task_id, task.completed_time())
+            for rider_id in riders:
+                self._complete_from_cache(self._todo_queue.task(rider_id), task_id, task.completed_time())
+        elif riders:
+            leader_id = riders[0]
+            self._cache_leaders[task.cache_key] = leader_id
+            self._riders[leader_id] = riders[1:]
+            for rider_id in riders[1:]:
+                self._riding[rider_id] = leader_id
+            self._todo_queue.set_ready(leader_id)
+            self._logger.info("TaskManager._leave_cache: Task %s stands in for Task %s." %
+                              (str(leader_id), str(task_id)))
+
+    def _complete_from_cache(self, task, source_id, time_stamp):
+        """
+        Completes a todo task with the result of task source_id, with an attempt that never ran.
+        """
+        attempt = task.attempt_task(self.CACHE_RUNNER, time_stamp, attempt_id=self._attempt_ids.next_id())
+        attempt.mark_completed(time_stamp)
+        task.cached_from = source_id
+        self._move_task_to_done(task, time_stamp)
+        self._logger.info("TaskManager._complete_from_cache: Task %s completed with the result of Task %s." %
+                          (str(task.task_id()), str(source_id)))
+
+    def _cancel_dependents(self, task_id, reason, time_stamp):
+        """
+        Cancels every task waiting on task_id, and every task waiting on those and so on, as they can never run.
+         Only the tasks that get cancelled are looked at.
+
+        :return: the number of tasks cancelled
+        """
+        cancelled = 0
+        upstream = [task_id]
+        while upstream:
+            upstream_id = upstream.pop()
+            for dependent_id in list(self._dependents.get(upstream_id, [])):
+                if upstream_id in self._unmet.get(dependent_id, ()):
+                    dependent = self._todo_queue.task(dependent_id)
+                    dependent.cancel(reason)
+                    self._move_task_to_done(dependent, time_stamp)
+                    self._logger.info("TaskManager._cancel_dependents: Task %s %s (Task %s)." %
+                                      (str(dependent_id), reason, str(task_id)))
+                    upstream.append(dependent_id)
+                    cancelled += 1
+        return cancelled
+
+    def compact(self, now, max_tasks=None):
+        """
+        Deletes the done tasks past retention, oldest first. With max_tasks it stops after that many so a caller can
+         spread the work out in small batches; it only looks at tasks that are deleted (plus one per list).
+
+        :return: list of the tasks deleted
+        """
+        deleted = []
+        for list_type in ("completed", "failed", "cancelled"):
+            max_age, max_count = self._retention.get("completed" if list_type == "completed" else "failed",
+                                                     (None, None))
+            if max_age is None and max_count is None:
+                continue
+            while max_tasks is None or len(deleted) < max_tasks:
+                task_id = self._done.next_expired(list_type, now, max_age=max_age, max_count=max_count)
+                if task_id is None:
+                    break
+                deleted.append(self._done.get(task_id))
+                self.delete_task(task_id, time_stamp=now)
+        if deleted:
+            self._logger.info("TaskManager.compact: Deleted %d done tasks past retention." % len(deleted))
+        return deleted
+
+    def delete_tasks(self, list_types=None, name=None, runner=None, created_after=None, created_before=None,
+                     command_prefix=None, cursor=None, limit=1000):
+        """
+        Deletes the tasks in list_types (all lists if None) that match the criteria of query. Up to limit tasks are
+         looked at; when the returned cursor isn't None call again with it to carry on.
+
+        :return: (list of the tasks deleted, cursor or None)
+        """
+        tasks, cursor = self.query(name=name, runner=runner, created_after=created_after,
+                                   created_before=created_before, command_prefix=command_prefix, cursor=cursor,
+                                   limit=limit)
+        deleted = []
+        for task, list_type in tasks:
+            # a task can be cancelled (and so move lists) by the deletion of a task before it
+            if list_types is None or self._list_type(task) in list_types:
+                if self.delete_task(task.task_id()):
+                    deleted.append(task)
+        self._logger.info("TaskManager.delete_tasks: Deleted %d tasks." % len(deleted))
+        return deleted, cursor
+
+    def expected_duration(self, task):
+        """
+        How long an attempt of the task is expected to take, in seconds: its duration if it has one, otherwise the
+         moving average runtime of its family.
+        """
+        if task.duration is not None:
+            return task.duration
+        learned = self._runtimes.ewma(self.task_family(task))
+        return learned if learned is not None else self.DEFAULT_EXPECTED_DURATION
+
+    @staticmethod
+    def task_family(task):
+        """
+        Tasks with the same name are a family. Tasks without a name are a family with the tasks whose command is the
+         same but for its numbers (e.g. dates and ids).
+        """
+        return task.name if task.name else re.sub(r"\d+", "#", task.cmd)
+
+    def _timeout_for(self, task):
+        p99 = self._runtimes.quantile(self.task_family(task), 0.99)
+        return p99 * self._adaptive_timeout if p99 is not None else None
+
+    def _reprioritize(self, task_ids):
+        for task_id in task_ids:
+            self._todo_queue.set_priority(task_id, -self._critical_path.rank(task_id))
+
+    def _attempt_started(self, task, attempt):
+        self._index.add_runner(task.task_id(), attempt.runner)
+        self._runners.attempt_started(attempt.runner, task.task_id(), attempt.id())
+        if task.pool is not None:
+            self._pools.acquire(task.pool)
+            self._pool_attempts[attempt.id()] = task.pool
+
+    def _attempt_ended(self, attempt):
+        self._runners.attempt_ended(attempt.runner, attempt.id())
+        self._release_pool(attempt.id())
+
+    def _release_pool(self, attempt_id):
+        """
+        Gives up the attempt's place in its pool (if it holds one) and lets a parked task take it.
+        """
+        pool = self._pool_attempts.pop(attempt_id, None)
+        if pool is not None:
+            self._pools.release(pool)
+            self._todo_queue.unpark(pool, count=self._pools.free(pool))
+
+    def _remove_from_todo(self, task):
+        """
+        Takes a task out of todo without attempting it. A ready task of a pool may have been let out of the parked
+         tasks for a place in the pool it is now not going to take, so the place goes to the next parked task.
+        """
+        self._todo_queue.remove_task(task.task_id())
+        if task.pool is not None:
+            self._todo_queue.unpark(task.pool, count=self._pools.free(task.pool))
+
+    def set_pool_limit(self, pool, limit):
+        """
+        Sets the max number of the pool's attempts in flight at once.
+        """
+        self._pools.set_limit(pool, limit)
+        self._todo_queue.unpark(pool, count=self._pools.free(pool))
+
+    def pool_stats(self):
+        """
+        :return: dict of pool name to its limit, attempts in flight and parked tasks
+        """
+        return dict((pool, {"limit": self._pools.limit(pool),
+                            "in_flight": self._pools.in_flight(pool),
+                            "parked": self._todo_queue.num_parked(pool)})
+                    for pool in self._pools.pools())
+
+    def start_next_attempt(self, runner, current_time, labels=None):
+        """
+        :param labels: the labels the runner has. It only gets tasks that require a subset of them.
+        """
         self._logger.debug("TaskManager.start_next_attempt: Starting next attempt for runner %s at %s" % (str(runner), str(current_time)))
+        labels = frozenset(labels) if labels is not None else frozenset()
         attempt = None
+        self._runners.seen(runner, current_time)
+        self.reclaim_dead_runners(current_time)
+        self.fire_timers(current_time)
         # if there is one in process that needs to be re-attempted then do that
-        next_task, failed_tasks = self._in_process.task_to_retry(current_time)
+        timeout_for = self._timeout_for if self._adaptive_timeout is not None else None
+        next_task, failed_tasks = self._in_process.task_to_retry(current_time, labels=labels, pools=self._pools,
+                                                                 timeout_for=timeout_for)
         # for each failed task: 1) remove from in process, 2) add to done
         for task in failed_tasks:
             self._logger.info("TaskManager.start_next_attempt: Task %s has failed. Moving it to Done." % str(task.task_id()))
-            self._move_task_to_done(task)
+            before = self._tally(task)
+            self._move_task_to_done(task, current_time)
+            self._retally(task, before)
 
         if next_task is not None:
-            attempt = next_task.attempt_task(runner, current_time)
-            self._logger.info("TaskManager.start_next_attempt: Created Attempt %s for Task %s. Attempt %d of %d." %
-                              (str(attempt.id()), str(next_task.task_id()), next_task.num_attempts(), next_task.max_attempts))
+            # the place in the pool a timed out attempt still holds goes over to its retry
+            timed_out = next_task.most_recent_attempt()
+            if timed_out.is_in_process() and self._pool_attempts.pop(timed_out.id(), None) is not None:
+                self._pools.release(next_task.pool)
+            attempt = self._attempt_again(next_task, runner, current_time)
         else:  # if still no next task, get one from the queued up new tasks
-            skip_task_ids = set()
-            todo_ids = self._todo_queue.task_ids()
-            # as long as not every task_id in todo_queue is in skip_tasks, we keep trying
-            while not skip_task_ids.issuperset(todo_ids):
-                possible_next_task = self._todo_queue.next_task(skip_task_ids=skip_task_ids)
-                # if any dependency is not done, then we need to continue
-                can_run = True
-                for dependency in possible_next_task.dependent_on:
-                    dependency_task = self._find_task(dependency, todo=True, in_process=True, done=True)
-                    if not dependency_task.is_completed():
-                        self._logger.debug("TaskManager.start_next_attempt: Task %s is dependent on Task %s, which is not completed. Skipping it for now." %
-                                           (str(possible_next_task.task_id()), str(dependency)))
-                        skip_task_ids.add(possible_next_task.task_id())
-                        can_run = False
-                        break
-                if can_run:  # if it can run then all dependencies are completed (or there are no dependencies) so break the while loop, we've found our next task
-                    next_task = possible_next_task
-                    break
+            # only tasks whose dependencies are all completed are ready, so the next ready one can be run
+            next_task = self._todo_queue.next_task(labels=labels)
 
             # and move this task from something to do to in process & create attempt
             if next_task is not None:
                 self._logger.debug("TaskManager.start_next_attempt: Task %s is being moved from todo to in process." % str(next_task.task_id()))
                 self._todo_queue.remove_task(next_task.task_id())
-                attempt = next_task.attempt_task(runner, current_time)
+                self._expiries.remove(next_task.task_id())
+                attempt = next_task.attempt_task(runner, current_time, attempt_id=self._attempt_ids.next_id())
+                self._attempt_started(next_task, attempt)
                 self._in_process.add_task(next_task)
+                self._count(next_task, "in_process", 1)
+                self._retally(next_task, (0, 0))
+                self._changed("todo", "inprocess")
+                self._record("attempt_started", next_task.task_id(), "inprocess", attempt_id=attempt.id())
                 self._logger.info("TaskManager.start_next_attempt: Created Attempt %s for Task %s. Attempt %d of %d." %
                                   (str(attempt.id()), str(next_task.task_id()), next_task.num_attempts(),
                                    next_task.max_attempts))
+            elif self._speculate_quantile is not None:
+                # with nothing new to do, back up an attempt that is taking much longer than its peers
+                next_task = self._in_process.straggler(current_time, runner, self._straggler_after, labels=labels,
+                                                       pools=self._pools)
+                if next_task is not None:
+                    self._logger.info("TaskManager.start_next_attempt: Task %s is a straggler. Backing it up." %
+                                      str(next_task.task_id()))
+                    attempt = self._attempt_again(next_task, runner, current_time)
         if attempt is not None:
             self._logger.info("TaskManager.start_next_attempt: Next attempt is Attempt %s for Task %s. Attempt %d of %d." %
                               (str(attempt.id()), str(next_task.task_id()), next_task.num_attempts(),
@@ -466,6 +2184,23 @@ class TaskManager(object):
             self._logger.info("TaskManager.start_next_attempt: No next task to attempt. Returning None for next task and None for attempt.")
         return next_task, attempt
 
+    def _attempt_again(self, task, runner, current_time):
+        """
+        Starts another attempt of a task that is in process.
+        """
+        before = self._tally(task)
+        attempt = task.attempt_task(runner, current_time, attempt_id=self._attempt_ids.next_id())
+        self._attempt_started(task, attempt)
+        self._retally(task, before)
+        self._changed("inprocess")
+        self._record("attempt_started", task.task_id(), "inprocess", attempt_id=attempt.id())
+        self._logger.info("TaskManager._attempt_again: Created Attempt %s for Task %s. Attempt %d of %d." %
+                          (str(attempt.id()), str(task.task_id()), task.num_attempts(), task.max_attempts))
+        return attempt
+
+    def _straggler_after(self, task):
+        return self._runtimes.quantile(self.task_family(task), self._speculate_quantile)
+
     def _find_task(self, task_id, todo=False, in_process=False, done=False):
         self._logger.debug("TaskManager._find_task: Looking for Task %s in todo = %s, is_in_process = %s, done = %s" %
                            (str(task_id), str(todo), str(in_process), str(done)))
@@ -484,63 +2219,281 @@ class TaskManager(object):
                 self._logger.debug("TaskManager._find_task: Task %s found in done." % str(task_id))
         return task
 
-    def fail_attempt(self, task_id, attempt_id, fail_reason):
+    def fail_attempt(self, task_id, attempt_id, fail_reason, time_stamp=None):
+        """
+        :param time_stamp: when the attempt failed, which a retry backoff counts from. Defaults to now.
+        """
+        time_stamp = time_stamp if time_stamp is not None else datetime.datetime.now()
         # need to fail the attempt
         # first find the task, should be in in process or done
         task = self._find_task(task_id, in_process=True, done=True)
-        if task is not None:
+        if task is not None and task.get_attempt(attempt_id) is None:
+            self._logger.warn("TaskManager.fail_attempt: Task %s has no Attempt %s. Can't fail it." % (str(task_id), str(attempt_id)))
+        elif task is not None:
+            before = self._tally(task)
             # fail the attempt
-            task.get_attempt(attempt_id).mark_failed(fail_reason)
+            attempt = task.get_attempt(attempt_id)
+            attempt.mark_failed(fail_reason)
+            self._attempt_ended(attempt)
+            self._changed(self._list_type(task))
+            self._record("attempt_failed", task_id, self._list_type(task), attempt_id=attempt_id)
             self._logger.info("TaskManager.fail_attempt: failed Attempt %s for Task %s." % (str(attempt_id), str(task_id)))
-            # if attempts is > max attempts and the attempt that failed is the most recent one then move it to done
-            if task.num_attempts() >= task.max_attempts and task.most_recent_attempt().id() == attempt_id:
-                self._move_task_to_done(task)
-                self._logger.info("TaskManager.fail_attempt: Task %s Attempt %s is last attempt failed. Moved to done" %
-                                  (str(task_id), str(attempt_id)))
+            # if attempts is > max attempts and the most recent attempt has failed then move it to done, unless it is
+            #  already there (its last attempt timed out or another attempt completed it) or an earlier attempt is
+            #  still running (the failed attempt was its backup) and may yet complete it
+            in_process = self._in_process.get_task(task_id) is not None
+            timeout_for = self._timeout_for if self._adaptive_timeout is not None else None
+            if in_process and self._in_process.has_running_attempt(task, time_stamp, timeout_for=timeout_for):
+                self._logger.info("TaskManager.fail_attempt: Task %s still has an attempt running. Leaving it in process." %
+                                  str(task_id))
+            elif task.num_attempts() >= task.max_attempts and task.most_recent_attempt().is_failed():
+                if in_process:
+                    self._move_task_to_done(task, time_stamp)
+                    self._logger.info("TaskManager.fail_attempt: Task %s Attempt %s is last attempt failed. Moved to done" %
+                                      (str(task_id), str(attempt_id)))
+                else:
+                    self._logger.info("TaskManager.fail_attempt: Task %s is already done. Leaving it there." %
+                                      str(task_id))
+            elif task.most_recent_attempt().id() == attempt_id and task.num_open_attempts() == 0:
+                backoff = task.retry_backoff()
+                if backoff is not None and in_process:
+                    self._in_process.back_off(task_id, time_stamp + datetime.timedelta(seconds=backoff))
+            self._retally(task, before)
         else:
             self._logger.warn("TaskManager.fail_attempt: Task %s not found in is_in_process or done. Can't fail task not in one of these sets." % str(task_id))
 
+    def task(self, task_id):
+        return self._find_task(task_id, todo=True, in_process=True, done=True)
+
+    def _list_type(self, task):
+        """
+        Which of the task lists the task is in (None if it isn't in any).
+        """
+        task_id = task.task_id()
+        if self._todo_queue.task(task_id) is not None:
+            return "todo"
+        elif self._in_process.get_task(task_id) is not None:
+            return "inprocess"
+        elif task_id in self._done:
+            if self._done.is_completed(task_id):
+                return "completed"
+            return "cancelled" if self._done.is_cancelled(task_id) else "failed"
+        return None
+
+    def heartbeat(self, task_id, attempt_id, time_stamp, runner=None):
+        """
+        Extends the deadline of an attempt that is still running. Only looks in in process tasks so it stays cheap
+         for runners heartbeating many attempts.
+
+        :param runner: the runner heartbeating. If given, only an attempt started by that runner is extended.
+        :return: True if the attempt is still wanted, False if the task is no longer in process, the attempt is
+         already completed/failed or isn't the runner's (so the runner can stop working on it).
+        """
+        task = self._in_process.get_task(task_id)
+        attempt = task.get_attempt(attempt_id) if task is not None else None
+        if attempt is None or not attempt.is_in_process():
+            self._logger.debug("TaskManager.heartbeat: Attempt %s for Task %s is not in process." % (str(attempt_id), str(task_id)))
+            return False
+        if runner is not None and attempt.runner != runner:
+            self._logger.warn("TaskManager.heartbeat: Attempt %s for Task %s is Runner %s's, not Runner %s's." %
+                              (str(attempt_id), str(task_id), str(attempt.runner), str(runner)))
+            return False
+        attempt.heartbeat(time_stamp)
+        return True
+
     def complete_attempt(self, task_id, attempt_id, time_stamp):
         task = self._find_task(task_id, in_process=True, done=True)
-        if task is not None:
-            task.get_attempt(attempt_id).mark_completed(time_stamp)
+        if task is not None and task.get_attempt(attempt_id) is None:
+            self._logger.warn("TaskManager.complete_attempt: Task %s has no Attempt %s. Can't complete it." % (str(task_id), str(attempt_id)))
+            return False
+        elif task is not None:
+            before = self._tally(task)
+            list_before = self._list_type(task)
+            attempt = task.get_attempt(attempt_id)
+            if attempt.is_in_process():
+                self._runtimes.observe(self.task_family(task), (time_stamp - attempt.start_time).total_seconds())
+            attempt.mark_completed(time_stamp)
+            self._attempt_ended(attempt)
+            # a late completion of a task that had been given up on moves it over to completed
+            late_completion = self._done.mark_completed(task_id, done_time=time_stamp)
+            if late_completion:
+                self._count(task, "failed", -1)
+                self._count(task, "completed", 1)
+                if self._results is not None and task.cache_key is not None:
+                    self._results.put(task.cache_key, task_id, time_stamp)
+            self._changed(list_before, self._list_type(task))
+            self._record("attempt_completed", task_id, self._list_type(task), attempt_id=attempt_id)
             self._logger.info("TaskManager.complete_attempt: completed Attempt %s for Task %s." % (str(attempt_id), str(task_id)))
             if self._find_task(task_id, in_process=True):
-                self._move_task_to_done(task)
+                self._move_task_to_done(task, time_stamp)
+                self._retally(task, before)
                 return True
+            if late_completion:
+                # the tasks waiting on it were cancelled when it failed and stay cancelled; they can be added again
+                self._logger.info("TaskManager.complete_attempt: Task %s completed late. Tasks cancelled because it "
+                                  "failed stay cancelled." % str(task_id))
         else:
             self._logger.warn("TaskManager.complete_attempt: Task %s not found in is_in_process or done. Can't complete task not in one of these sets." % str(task_id))
             return False
 
-    def add_task(self, task):
+    def add_task(self, task, idempotency_key=None):
+        """
+        :param idempotency_key: if a task was added with this key within the idempotency ttl (and is still around)
+         that task is returned instead of adding this one, so a retried submission doesn't add the task twice
+        :return: the task added, or the task already added with idempotency_key
+        """
         assert isinstance(task, Task)
+        if idempotency_key is not None:
+            existing_id = self._idempotency_keys.get(idempotency_key, task.created_time)
+            existing = self.task(existing_id) if existing_id is not None else None
+            if existing is not None:
+                self._logger.info("TaskManager.add_task: Task %s was already added with idempotency key %s." %
+                                  (str(existing_id), str(idempotency_key)))
+                return existing
         # all tasks dependent_on must exist
+        unmet = set()
+        upstream_failed = False
         for task_id in task.dependent_on:
-            if self._find_task(task_id, todo=True, in_process=True, done=True) is None:
+            dependency = self._find_task(task_id, todo=True, in_process=True, done=True)
+            if dependency is None:
                 raise UnknownDependencyException()
-        self._todo_queue.add_task(task)
+            if not dependency.is_completed():
+                unmet.add(task_id)
+                upstream_failed = upstream_failed or task_id in self._done
+        priority = 0
+        if self._critical_path is not None:
+            self._reprioritize(self._critical_path.add(task))
+            priority = -self._critical_path.rank(task.task_id())
+        # created_time is when the task is added
+        delayed = task.not_before is not None and task.not_before > task.created_time
+        if delayed:
+            self._delays.add(task.task_id(), task.not_before)
+        if task.expires_at is not None:
+            self._expiries.add(task.task_id(), task.expires_at)
+        self._todo_queue.add_task(task, ready=False, priority=priority)
+        self._index.add(task)
+        if unmet:
+            self._unmet[task.task_id()] = unmet
+        for task_id in task.dependent_on:
+            self._dependents.setdefault(task_id, []).append(task.task_id())
+        # the done lists show the tasks that depend on each task
+        self._changed("todo", *self._dependency_lists(task))
+        self._record("added", task.task_id(), "todo")
         self._logger.info("TaskManager.add_task: Added Task %s to todo." % str(task.task_id()))
+        if idempotency_key is not None:
+            self._idempotency_keys.add(idempotency_key, task.task_id(), task.created_time)
+        if not unmet and not delayed:
+            self._set_ready(task, task.created_time)
+        if upstream_failed:
+            # a task it depends on already failed (or was cancelled) so it can never run
+            task.cancel(self.UPSTREAM_FAILED)
+            self._move_task_to_done(task, task.created_time)
+            self._logger.info("TaskManager.add_task: Task %s %s." % (str(task.task_id()), self.UPSTREAM_FAILED))
+        return task
 
-    def delete_task(self, task_id):
+    def _forget_dependencies(self, task):
+        for dependency_id in task.dependent_on:
+            dependents = self._dependents.get(dependency_id)
+            if dependents is not None and task.task_id() in dependents:
+                dependents.remove(task.task_id())
+                if not dependents:
+                    del self._dependents[dependency_id]
+
+    def delete_task(self, task_id, time_stamp=None):
+        """
+        :param time_stamp: when the task was deleted, which the tasks cancelled with it are done at. Defaults to now.
+        """
+        time_stamp = time_stamp if time_stamp is not None else datetime.datetime.now()
+        task = self._find_task(task_id, todo=True, in_process=True, done=True)
+        if task is not None:
+            self._cancel_dependents(task_id, self.UPSTREAM_DELETED, time_stamp)
+            self._leave_cache(task)
+            self._forget_dependencies(task)
+            self._dependents.pop(task_id, None)
+            self._unmet.pop(task_id, None)
+            self._delays.remove(task_id)
+            self._expiries.remove(task_id)
+            self._index.remove(task_id)
+            if self._critical_path is not None:
+                self._reprioritize(self._critical_path.remove(task_id))
+            for attempt_id in task.attempt_ids():
+                self._attempt_ended(task.get_attempt(attempt_id))
+            self._changed(self._list_type(task), *self._dependency_lists(task))
+            before = self._tally(task)
         deleted = False
         if self._find_task(task_id, todo=True) is not None:
-            self._todo_queue.remove_task(task_id)
+            self._remove_from_todo(task)
             self._logger.info("TaskManager.delete_task: Task %s deleted from todo" % str(task_id))
             deleted = True
         elif self._find_task(task_id, done=True) is not None:
-            del self._done[task_id]
+            self._count(task, self._list_type(task), -1)
+            self._done.remove(task_id)
             self._logger.info("TaskManager.delete_task: Task %s deleted from done" % str(task_id))
             deleted = True
         elif self._find_task(task_id, in_process=True) is not None:
             self._in_process.remove_task(task_id)
+            self._count(task, "in_process", -1)
+            self._retally(task, before)
             self._logger.info("TaskManager.delete_task: Task %s deleted from inprocess" % str(task_id))
             deleted = True
         else:
             self._logger.info("TaskManager.delete_task: Task %s not found so not deleted." % str(task_id))
+        if deleted:
+            self._record("deleted", task_id, None)
         return deleted
 
+    def runner_seen(self, runner, time_stamp):
+        """
+        Records that the runner is alive. Getting an attempt also counts.
+        """
+        self._runners.seen(runner, time_stamp)
+
+    def reclaim_dead_runners(self, current_time):
+        """
+        Fails every attempt in flight on runners that haven't been seen within the runner timeout, so their tasks are
+         retried (or moved to failed) right away instead of waiting for each attempt's duration to run out.
+
+        :return: the number of attempts failed
+        """
+        failed = 0
+        for runner in self._runners.dead_runners(current_time):
+            for task_id, attempt_id in self._runners.attempts(runner):
+                self._logger.info("TaskManager.reclaim_dead_runners: Failing Attempt %s for Task %s as Runner %s is dead." %
+                                  (str(attempt_id), str(task_id), str(runner)))
+                self.fail_attempt(task_id, attempt_id, "runner %s stopped responding" % str(runner),
+                                  time_stamp=current_time)
+                failed += 1
+        return failed
+
+    def runners(self):
+        """
+        Every runner seen, alive ones in the order they were last seen. See RunnerRegistry.runners.
+        """
+        return self._runners.runners()
+
+    def query(self, name=None, runner=None, created_after=None, created_before=None, command_prefix=None, cursor=None,
+              limit=100):
+        """
+        Finds tasks in any list by name, runner, created time and command prefix. See TaskIndex.query.
+
+        :return: (list of (task, list type), cursor for the next page or None)
+        """
+        tasks, cursor = self._index.query(name=name, runner=runner, created_after=created_after,
+                                          created_before=created_before, command_prefix=command_prefix, cursor=cursor,
+                                          limit=limit)
+        return [(task, self._list_type(task)) for task in tasks], cursor
+
     def done_tasks(self):
-        return self._done.values()
+        return self._done.all_tasks()
+
+    def completed_tasks(self):
+        return self._done.completed_tasks()
+
+    def failed_tasks(self):
+        return self._done.failed_tasks()
+
+    def cancelled_tasks(self):
+        return self._done.cancelled_tasks()
 
     def todo_tasks(self):
         return self._todo_queue.all_tasks()
@@ -549,12 +2502,189 @@ class TaskManager(object):
         return self._in_process.all_tasks()
 
     def dependencies(self, task_id):
-        dependencies = []
-        tasks = []
-        tasks.extend(self.todo_tasks())
-        tasks.extend(self.in_process_tasks())
-        tasks.extend(self.done_tasks())
-        for task in tasks:
-            if task_id in task.dependent_on:
-                dependencies.append(task.task_id())
-        return dependencies
+        """
+        The ids of the tasks that are dependent on task_id.
+        """
+        return list(self._dependents.get(task_id, []))
+
+    def num_dependencies(self, task_id):
+        return len(self._dependents.get(task_id, []))
+
+
+class AttemptOutput(object):
+    """
+    The output of one attempt, kept bounded: the first head_bytes and the last tail_bytes. Anything in between is
+     only counted.
+    """
+
+    def __init__(self, head_bytes, tail_bytes):
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self.head = ""
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self.total_bytes = 0
+
+    def append(self, data):
+        """
+        :return: the change in the number of bytes held in memory
+        """
+        before = self.size()
+        self.total_bytes += len(data)
+        if len(self.head) < self._head_bytes:
+            room = self._head_bytes - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self._tail.append(data)
+            self._tail_size += len(data)
+            # drop whole chunks that are out of the tail, then trim the first chunk that is partly out
+            while self._tail_size - len(self._tail[0]) >= self._tail_bytes:
+                self._tail_size -= len(self._tail.popleft())
+            extra = self._tail_size - self._tail_bytes
+            if extra > 0:
+                self._tail[0] = self._tail[0][extra:]
+                self._tail_size -= extra
+        return self.size() - before
+
+    def tail(self):
+        return "".join(self._tail)
+
+    def skipped_bytes(self):
+        return self.total_bytes - len(self.head) - self._tail_size
+
+    def size(self):
+        return len(self.head) + self._tail_size
+
+
+class OutputStore(object):
+    """
+    Holds the output runners upload for their attempts.
+
+    Each attempt keeps a bounded head and tail (see AttemptOutput). On top of that all attempts share memory_limit
+     bytes; when it is passed, the outputs that were least recently appended to are spilled to files in spill_dir
+     (a temp directory by default). A spilled output is read back into memory if more is appended to it.
+
+    The spill files share disk_limit bytes, each counted as at least SPILL_BLOCK bytes as that is about what a
+     small file takes on disk (which also caps how many there are). When it is passed the outputs spilled longest
+     ago are forgotten and their files deleted.
+    """
+
+    SPILL_BLOCK = 4096
+
+    def __init__(self, logger, head_bytes=16 * 1024, tail_bytes=48 * 1024, memory_limit=64 * 1024 * 1024,
+                 spill_dir=None, disk_limit=1024 * 1024 * 1024):
+        self._logger = logger
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._memory_limit = memory_limit
+        self._spill_dir = spill_dir
+        # a spill directory the store made itself is removed by close
+        self._made_spill_dir = False
+        self._disk_limit = disk_limit
+        # ordered by least recently appended to
+        self._outputs = collections.OrderedDict()
+        # attempt id to its spill file's path and the bytes it is counted as, spilled longest ago first
+        self._spilled = collections.OrderedDict()
+        self._memory = 0
+        self._disk = 0
+
+    def _spill_path(self, attempt_id):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="stq_output_")
+            self._made_spill_dir = True
+        return os.path.join(self._spill_dir, "%s.out" % str(attempt_id))
+
+    def _spill(self, attempt_id):
+        output = self._outputs.pop(attempt_id)
+        self._memory -= output.size()
+        path = self._spill_path(attempt_id)
+        with open(path, "wb") as f:
+            f.write("%d %d %d\n" % (output.total_bytes, len(output.head), output.skipped_bytes()))
+            f.write(output.head)
+            f.write(output.tail())
+            size = max(f.tell(), self.SPILL_BLOCK)
+        self._spilled[attempt_id] = (path, size)
+        self._disk += size
+        self._logger.debug("OutputStore._spill: Output of Attempt %s spilled to %s." % (str(attempt_id), path))
+        while self._disk > self._disk_limit and self._spilled:
+            forgotten = next(iter(self._spilled))
+            self._remove_spilled(forgotten)
+            self._logger.info("OutputStore._spill: Forgot the output of Attempt %s to stay under %d bytes on disk." %
+                              (str(forgotten), self._disk_limit))
+
+    def _remove_spilled(self, attempt_id):
+        path, size = self._spilled.pop(attempt_id)
+        self._disk -= size
+        os.remove(path)
+
+    def _read_spilled(self, attempt_id):
+        output = AttemptOutput(self._head_bytes, self._tail_bytes)
+        with open(self._spilled[attempt_id][0], "rb") as f:
+            total_bytes, head_length = [int(i) for i in f.readline().split()][:2]
+            output.head = f.read(head_length)
+            tail = f.read()
+        if tail:
+            output._tail.append(tail)
+            output._tail_size = len(tail)
+        output.total_bytes = total_bytes
+        return output
+
+    def append(self, attempt_id, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        output = self._outputs.pop(attempt_id, None)
+        if output is None and attempt_id in self._spilled:
+            output = self._read_spilled(attempt_id)
+            self._remove_spilled(attempt_id)
+            self._memory += output.size()
+        elif output is None:
+            output = AttemptOutput(self._head_bytes, self._tail_bytes)
+        self._memory += output.append(data)
+        self._outputs[attempt_id] = output
+        while self._memory > self._memory_limit and len(self._outputs) > 1:
+            self._spill(next(iter(self._outputs)))
+
+    def get(self, attempt_id):
+        """
+        :return: dict with the head, tail, total_bytes and skipped_bytes (between head and tail) of the attempt's
+         output. None if nothing has been uploaded for the attempt.
+        """
+        output = self._outputs.get(attempt_id)
+        if output is None and attempt_id in self._spilled:
+            output = self._read_spilled(attempt_id)
+        if output is None:
+            return None
+        return {'head': output.head,
+                'tail': output.tail(),
+                'total_bytes': output.total_bytes,
+                'skipped_bytes': output.skipped_bytes()}
+
+    def remove(self, attempt_id):
+        output = self._outputs.pop(attempt_id, None)
+        if output is not None:
+            self._memory -= output.size()
+        if attempt_id in self._spilled:
+            self._remove_spilled(attempt_id)
+
+    def close(self):
+        """
+        Forgets every output and deletes the spill files, as they mean nothing to the next server.
+        """
+        for attempt_id in list(self._spilled):
+            self._remove_spilled(attempt_id)
+        self._outputs.clear()
+        self._memory = 0
+        if self._made_spill_dir:
+            os.rmdir(self._spill_dir)
+            self._spill_dir = None
+            self._made_spill_dir = False
+
+    def memory_used(self):
+        return self._memory
+
+    def disk_used(self):
+        return self._disk
+
+    def __len__(self):
+        return len(self._outputs) + len(self._spilled)
@@ -0,0 +1,100 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+"""
+Compares the makespan (time until every task is done) of the fifo and critical_path priority policies on random
+ DAGs, simulating runners against a TaskManager directly with a simulated clock.
+
+python -m test_scripts.benchmark_critical_path [-dags 20] [-tasks 300] [-runners 8]
+"""
+
+import argparse
+import heapq
+import logging
+import random
+from datetime import datetime
+from datetime import timedelta
+from simple_task_server import Task
+from simple_task_server import TaskManager
+
+START = datetime(year=2019, month=1, day=1)
+
+
+def random_dag(rng, num_tasks):
+    """
+    Mostly short independent-ish tasks plus a few long chains, added in a random (but dependency respecting) order.
+
+    :return: list of (task_id, duration, dependent_on)
+    """
+    tasks = []
+    for task_id in range(num_tasks):
+        dependent_on = []
+        if task_id > 0 and rng.random() < 0.6:
+            dependent_on = sorted(set(rng.randrange(max(0, task_id - 20), task_id) for _ in range(rng.randint(1, 2))))
+        tasks.append((task_id, rng.choice([1.0, 2.0, 5.0, 10.0]), dependent_on))
+    # a few long chains, added after all the short work, which is when fifo starts them too late
+    for chain in range(3):
+        previous = None
+        for _ in range(15):
+            task_id = len(tasks)
+            tasks.append((task_id, 20.0, [previous] if previous is not None else []))
+            previous = task_id
+    return tasks
+
+
+def makespan(tasks, num_runners, priority_policy):
+    logger = logging.getLogger("benchmark")
+    tm = TaskManager(logger, priority_policy=priority_policy)
+    durations = {}
+    for task_id, duration, dependent_on in tasks:
+        # the policy plans with the duration; simulated attempts finish right on it so they never time out
+        tm.add_task(Task(task_id, "sleep %s" % duration, START, duration=duration, dependent_on=dependent_on))
+        durations[task_id] = duration
+    now = 0.0
+    idle = ["runner_%d" % i for i in range(num_runners)]
+    running = []
+    done = 0
+    while done < len(tasks):
+        while idle:
+            task, attempt = tm.start_next_attempt(idle[-1], START + timedelta(seconds=now))
+            if task is None:
+                break
+            heapq.heappush(running, (now + durations[task.task_id()], task.task_id(), attempt.id(), idle.pop()))
+        now, task_id, attempt_id, runner = heapq.heappop(running)
+        tm.complete_attempt(task_id, attempt_id, START + timedelta(seconds=now))
+        idle.append(runner)
+        done += 1
+    return now
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dags", action="store", dest="dags", type=int, default=20, required=False)
+    parser.add_argument("-tasks", action="store", dest="tasks", type=int, default=300, required=False)
+    parser.add_argument("-runners", action="store", dest="runners", type=int, default=8, required=False)
+    args = parser.parse_args()
+    logging.getLogger("benchmark").setLevel(logging.WARNING)
+    rng = random.Random(24601)
+    total = {"fifo": 0.0, "critical_path": 0.0}
+    for i in range(args.dags):
+        dag = random_dag(rng, args.tasks)
+        spans = dict((policy, makespan(dag, args.runners, policy)) for policy in total)
+        for policy, span in spans.iteritems():
+            total[policy] += span
+        print "DAG %2d: fifo %7.1f  critical_path %7.1f" % (i, spans["fifo"], spans["critical_path"])
+    print "Mean makespan: fifo %.1f, critical_path %.1f (%.1f%% shorter)" % (
+        total["fifo"] / args.dags, total["critical_path"] / args.dags,
+        100.0 * (1 - total["critical_path"] / total["fifo"]))
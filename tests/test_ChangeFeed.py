@@ -0,0 +1,56 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import ChangeFeed
+
+
+def test_empty_feed():
+    feed = ChangeFeed(5)
+    assert len(feed) == 0
+    assert feed.last_seq() == 0
+    assert feed.since(0) == ([], False)
+    # a cursor from the future means the feed isn't the one the cursor came from
+    assert feed.since(3) == ([], True)
+
+
+def test_since():
+    feed = ChangeFeed(5)
+    for i in range(3):
+        assert feed.append({'n': i}) == i + 1
+    assert len(feed) == 3
+    events, resync = feed.since(0)
+    assert not resync
+    assert [e['seq'] for e in events] == [1, 2, 3]
+    assert [e['n'] for e in events] == [0, 1, 2]
+    events, resync = feed.since(2)
+    assert [e['seq'] for e in events] == [3]
+    assert feed.since(3) == ([], False)
+    events, resync = feed.since(0, limit=2)
+    assert [e['seq'] for e in events] == [1, 2]
+
+
+def test_aged_out_cursor_needs_resync():
+    feed = ChangeFeed(5)
+    for i in range(12):
+        feed.append({'n': i})
+    assert len(feed) == 5
+    assert feed.first_seq() == 8
+    assert feed.last_seq() == 12
+    events, resync = feed.since(7)
+    assert not resync
+    assert [e['seq'] for e in events] == [8, 9, 10, 11, 12]
+    assert feed.since(6) == ([], True)
+    assert feed.since(0) == ([], True)
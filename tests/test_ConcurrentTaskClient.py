@@ -0,0 +1,126 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from concurrent_task_client import ConcurrentTaskClient
+from concurrent_task_client import read_tasks
+from concurrent_task_client import _task_from_row
+import pytest
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_add_tasks():
+    client = ConcurrentTaskClient("http://localhost:1", concurrency=4)
+    added = []
+
+    def add_task(command, **kwargs):
+        if command == "bad":
+            raise IOError("server said no")
+        added.append(command)
+        return len(added)
+
+    client.client.add_task = add_task
+    tasks = [{'command': "run %d" % i} for i in range(10)] + [{'command': "bad"}]
+    results = list(client.add_tasks(tasks))
+    assert sorted(task['command'] for task, _, _ in results) == sorted(task['command'] for task in tasks)
+    assert sorted(task_id for _, task_id, error in results if error is None) == range(1, 11)
+    assert [(task['command'], str(error)) for task, _, error in results if error is not None] == \
+        [("bad", "server said no")]
+
+
+def test_failed_read_is_raised_after_tasks_read():
+    client = ConcurrentTaskClient("http://localhost:1", concurrency=2)
+    client.client.add_task = lambda command, **kwargs: command
+
+    def tasks():
+        yield {'command': "run 1"}
+        yield {'command': "run 2"}
+        raise ValueError("line 3 is not JSON")
+
+    results = []
+    with pytest.raises(ValueError) as e:
+        for result in client.add_tasks(tasks()):
+            results.append(result)
+    assert "line 3" in str(e.value)
+    assert sorted(task_id for _, task_id, _ in results) == ["run 1", "run 2"]
+
+
+def test_stopping_early_lets_the_threads_finish():
+    client = ConcurrentTaskClient("http://localhost:1", concurrency=2)
+    added = []
+
+    def add_task(command, **kwargs):
+        added.append(command)
+        return command
+
+    client.client.add_task = add_task
+    read = []
+
+    def tasks():
+        for i in range(1000):
+            read.append(i)
+            yield {'command': "run %d" % i}
+
+    before = threading.active_count()
+    results = client.add_tasks(tasks())
+    for result in results:
+        break
+    results.close()
+    assert threading.active_count() == before
+    # only what fit in the queues was read, and nothing read after the caller stopped was added
+    assert len(read) < 20
+    assert len(added) <= len(read)
+
+
+def test_read_tasks_ndjson(tmpdir):
+    f = tmpdir.join("tasks.ndjson")
+    f.write('{"command": "run 1", "dependent_on": ["a"], "max_attempts": 2}\n'
+            '\n'
+            '{"command": "run 2", "labels": ["gpu"], "cache": true, "idempotency_key": "k2"}\n')
+    assert list(read_tasks(str(f))) == [
+        {'command': "run 1", 'dependent_on': ["a"], 'max_attempts': 2},
+        {'command': "run 2", 'labels': ["gpu"], 'cache': True, 'idempotency_key': "k2"}]
+
+
+def test_read_tasks_malformed_line(tmpdir):
+    f = tmpdir.join("tasks.ndjson")
+    f.write('{"command": "run 1"}\n{"command": \n{"command": "run 3"}\n')
+    tasks = read_tasks(str(f))
+    assert next(tasks) == {'command': "run 1"}
+    with pytest.raises(ValueError) as e:
+        next(tasks)
+    assert "line 2" in str(e.value)
+
+
+def test_read_tasks_csv(tmpdir):
+    f = tmpdir.join("tasks.csv")
+    f.write("command,name,dependent_on,duration,cache\n"
+            "run 1,first,,,\n"
+            "run 2,second,a b,1.5,yes\n")
+    assert list(read_tasks(str(f))) == [
+        {'command': "run 1", 'name': "first"},
+        {'command': "run 2", 'name': "second", 'dependent_on': ["a", "b"], 'duration': 1.5, 'cache': True}]
+
+
+def test_task_from_row():
+    row = {'command': "run", 'name': "", 'queue': "batch", 'labels': "gpu big", 'max_attempts': "3",
+           'retry_delay': "10", 'retry_jitter': "", 'cache': "false", 'not_before': "2019-01-01 12:00:00"}
+    assert _task_from_row(row) == {'command': "run", 'queue': "batch", 'labels': ["gpu", "big"], 'max_attempts': 3,
+                                   'retry_delay': 10.0, 'cache': False, 'not_before': "2019-01-01 12:00:00"}
+    with pytest.raises(KeyError):
+        _task_from_row({'name': "no command"})
@@ -0,0 +1,60 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import CriticalPath
+from simple_task_server import Task
+from datetime import datetime
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _task(task_id, duration, dependent_on=None):
+    return Task(task_id, "run command example", datetime.now(), duration=duration, dependent_on=dependent_on)
+
+
+def test_ranks_go_up_as_dependents_are_added():
+    cp = CriticalPath(LOGGER, lambda task: task.duration)
+    assert cp.add(_task(1, 10)) == []
+    assert cp.rank(1) == 10
+    assert cp.add(_task(2, 5, dependent_on=[1])) == [1]
+    assert cp.add(_task(3, 20, dependent_on=[2])) == [2, 1]
+    assert (cp.rank(1), cp.rank(2), cp.rank(3)) == (35, 25, 20)
+    # a shorter branch doesn't change anything
+    assert cp.add(_task(4, 1, dependent_on=[1])) == []
+    assert cp.rank(1) == 35
+    assert len(cp) == 4
+
+
+def test_ranks_go_down_as_dependents_are_removed():
+    cp = CriticalPath(LOGGER, lambda task: task.duration)
+    cp.add(_task(1, 10))
+    cp.add(_task(2, 5, dependent_on=[1]))
+    cp.add(_task(3, 20, dependent_on=[2]))
+    cp.add(_task(4, 1, dependent_on=[1]))
+    assert cp.remove(3) == [2, 1]
+    assert (cp.rank(1), cp.rank(2)) == (15, 5)
+    assert cp.remove(2) == [1]
+    assert cp.rank(1) == 11
+    assert cp.remove(3) == []
+    assert cp.rank(3) is None
+
+
+def test_untracked_dependencies_are_ignored():
+    cp = CriticalPath(LOGGER, lambda task: task.duration)
+    # 1 is already finished so isn't tracked
+    assert cp.add(_task(2, 5, dependent_on=[1])) == []
+    assert cp.rank(2) == 5
@@ -0,0 +1,116 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import DoneTasks
+from simple_task_server import Task
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _done_task(task_id, completed):
+    task = Task(task_id, "run command example", datetime.now())
+    attempt = task.attempt_task("runner", datetime.now(), attempt_id=task_id)
+    if completed:
+        attempt.mark_completed(datetime.now())
+    else:
+        attempt.mark_failed("failed")
+    return task
+
+
+def test_add_and_remove():
+    done = DoneTasks(LOGGER)
+    assert len(done) == 0
+    done.add(_done_task(1, True))
+    done.add(_done_task(2, False))
+    done.add(_done_task(3, True))
+    assert len(done) == 3
+    assert (done.num_completed(), done.num_failed()) == (2, 1)
+    assert [t.task_id() for t in done.completed_tasks()] == [1, 3]
+    assert [t.task_id() for t in done.failed_tasks()] == [2]
+    assert 2 in done
+    assert done.get(2).task_id() == 2
+    assert done.get(4) is None
+
+    done.remove(1)
+    done.remove(2)
+    done.remove(4)
+    assert len(done) == 1
+    assert 1 not in done
+    assert 2 not in done
+
+
+def test_timed_out_task_is_failed():
+    done = DoneTasks(LOGGER)
+    task = Task(1, "run command example", datetime.now())
+    task.attempt_task("runner", datetime.now(), attempt_id=1)
+    done.add(task)
+    assert [t.task_id() for t in done.failed_tasks()] == [1]
+    assert not done.is_completed(1)
+
+
+def test_mark_completed():
+    done = DoneTasks(LOGGER)
+    task = _done_task(1, False)
+    done.add(task)
+    assert not done.mark_completed(2)
+    task.get_attempt(1).mark_completed(datetime.now())
+    assert done.mark_completed(1)
+    assert not done.mark_completed(1)
+    assert done.is_completed(1)
+    assert (done.num_completed(), done.num_failed()) == (1, 0)
+
+
+def test_cancelled():
+    done = DoneTasks(LOGGER)
+    task = Task(1, "run command example", datetime.now())
+    task.cancel("cancelled: upstream failed")
+    done.add(task)
+    done.add(_done_task(2, False))
+    assert [t.task_id() for t in done.cancelled_tasks()] == [1]
+    assert (done.num_completed(), done.num_failed(), done.num_cancelled()) == (0, 1, 1)
+    assert done.is_cancelled(1)
+    assert done.get(1) is task
+    assert len(done) == 2
+    done.remove(1)
+    assert 1 not in done
+    assert done.num_cancelled() == 0
+
+
+def test_next_expired():
+    done = DoneTasks(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    done.add(_done_task(1, True), done_time=now - timedelta(seconds=30))
+    done.add(_done_task(2, True), done_time=now - timedelta(seconds=10))
+    done.add(_done_task(3, False), done_time=now - timedelta(seconds=30))
+    assert done.done_time(2) == now - timedelta(seconds=10)
+    assert done.next_expired("completed", now) is None
+    assert done.next_expired("completed", now, max_age=20) == 1
+    assert done.next_expired("completed", now, max_age=40) is None
+    assert done.next_expired("completed", now, max_count=1) == 1
+    assert done.next_expired("completed", now, max_count=2) is None
+    assert done.next_expired("failed", now, max_age=20) == 3
+    assert done.next_expired("cancelled", now, max_age=0) is None
+
+    # a late completion is done when it completes
+    done.remove(1)
+    done.mark_completed(3, done_time=now)
+    assert done.next_expired("completed", now, max_age=5) == 2
+    done.remove(2)
+    assert done.next_expired("completed", now, max_age=5) is None
+    assert done.done_time(2) is None
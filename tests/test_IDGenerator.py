@@ -0,0 +1,63 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import ID_GENERATORS
+from simple_task_server import MonotonicIDGenerator
+from simple_task_server import ULIDGenerator
+from simple_task_server import UUIDGenerator
+import pytest
+
+
+def test_uuid_ids():
+    generator = UUIDGenerator()
+    first = generator.next_id()
+    assert len(first) == 32
+    assert first != generator.next_id()
+    assert generator.parse(first) == first
+
+
+def test_monotonic_ids_increase():
+    generator = MonotonicIDGenerator()
+    ids = [generator.next_id() for _ in range(5000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 5000
+    # small enough for javascript to represent exactly
+    assert ids[-1] < 2 ** 53
+
+
+def test_monotonic_ids_parse():
+    generator = MonotonicIDGenerator()
+    an_id = generator.next_id()
+    assert generator.parse(str(an_id)) == an_id
+    assert generator.parse(u"%d" % an_id) == an_id
+    # strings that aren't ids are passed through so they just aren't found
+    assert generator.parse("not an id") == "not an id"
+
+
+def test_ulids_sort_in_creation_order():
+    generator = ULIDGenerator()
+    ids = [generator.next_id() for _ in range(5000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 5000
+    for an_id in ids[:10]:
+        assert len(an_id) == 26
+        assert generator.parse(an_id) == an_id
+
+
+@pytest.mark.parametrize("scheme", ["uuid", "int", "ulid"])
+def test_id_generators_by_scheme(scheme):
+    generator = ID_GENERATORS[scheme]()
+    assert generator.next_id() != generator.next_id()
@@ -0,0 +1,45 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import IdempotencyKeys
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_ttl():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    keys = IdempotencyKeys(LOGGER, 60)
+    keys.add("a", 1, now)
+    keys.add("b", 2, now + timedelta(seconds=30))
+    assert keys.get("a", now + timedelta(seconds=60)) == 1
+    assert keys.get("c", now) is None
+    assert keys.get("a", now + timedelta(seconds=61)) is None
+    assert len(keys) == 1
+    assert keys.get("b", now + timedelta(seconds=61)) == 2
+
+
+def test_max_size():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    keys = IdempotencyKeys(LOGGER, 60, max_size=2)
+    keys.add("a", 1, now)
+    keys.add("b", 2, now)
+    keys.add("c", 3, now)
+    assert len(keys) == 2
+    assert keys.get("a", now) is None
+    assert keys.get("c", now) == 3
@@ -17,6 +17,7 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 from simple_task_server import Task
 from simple_task_server import OpenTasks
 from datetime import datetime
+from datetime import timedelta
 import logging
 import pytest
 
@@ -94,6 +95,131 @@ def test_task_to_retry_second_started_retry():
     assert len(failed_tasks) == 0
 
 
+def test_task_to_retry_heartbeat_extends_duration():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+
+    t1 = Task(1, "run command example", time_stamp, name="example run",
+              desc="this is a bologna command that does nothing", duration=100, max_attempts=3)
+    start_time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=6, microsecond=100222)
+    attempt = t1.attempt_task("runner", start_time_stamp)
+
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t1)
+    # heartbeat 90 seconds in, so at 120 seconds it has run longer than its duration but heartbeated 30 seconds ago
+    attempt.heartbeat(datetime(year=2018, month=8, day=13, hour=5, minute=11, second=36, microsecond=100222))
+    current_time = datetime(year=2018, month=8, day=13, hour=5, minute=12, second=6, microsecond=100222)
+    task, failed_tasks = ot.task_to_retry(current_time)
+    assert task is None
+    assert len(failed_tasks) == 0
+
+    # more than the duration without a heartbeat and it gets retried
+    current_time = datetime(year=2018, month=8, day=13, hour=5, minute=13, second=17, microsecond=100222)
+    task, failed_tasks = ot.task_to_retry(current_time)
+    assert task == t1
+    assert len(failed_tasks) == 0
+
+
+def test_task_to_retry_with_labels():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+
+    t1 = Task(1, "run command example", time_stamp, max_attempts=3, labels=["gpu"])
+    t1.attempt_task("runner", time_stamp).mark_failed("failed")
+    t2 = Task(2, "run command example 2", time_stamp, max_attempts=3)
+    t2.attempt_task("runner", time_stamp).mark_failed("failed")
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t1)
+    ot.add_task(t2)
+
+    task, failed_tasks = ot.task_to_retry(time_stamp, labels=frozenset())
+    assert task == t2
+    task, failed_tasks = ot.task_to_retry(time_stamp, labels=frozenset(["gpu", "big_memory"]))
+    assert task == t1
+    # no labels given means any task
+    task, failed_tasks = ot.task_to_retry(time_stamp)
+    assert task == t1
+
+
+def test_task_to_retry_timeout_for_tasks_without_duration():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+    t1 = Task(1, "run command example", time_stamp, max_attempts=2)
+    t1.attempt_task("runner", time_stamp)
+    t2 = Task(2, "run command example", time_stamp, max_attempts=1)
+    t2.attempt_task("runner", time_stamp)
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t2)
+    ot.add_task(t1)
+
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=90)) == (None, [])
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=90), timeout_for=lambda task: None) == (None, [])
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=30), timeout_for=lambda task: 60) == (None, [])
+    task, failed_tasks = ot.task_to_retry(time_stamp + timedelta(seconds=90), timeout_for=lambda task: 60)
+    assert task == t1
+    assert failed_tasks == [t2]
+
+
+def test_back_off():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+    t1 = Task(1, "run command example", time_stamp, max_attempts=3)
+    t1.attempt_task("runner", time_stamp).mark_failed("failed")
+    t2 = Task(2, "run command example", time_stamp, max_attempts=3, duration=10)
+    t2.attempt_task("runner", time_stamp).mark_failed("failed")
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t1)
+    ot.add_task(t2)
+    ot.back_off(1, time_stamp + timedelta(seconds=30))
+    ot.back_off(2, time_stamp + timedelta(seconds=60))
+    assert len(ot) == 2
+    assert ot.num_waiting() == 2
+    assert ot.get_task(2) == t2
+    assert ot.all_tasks() == [t1, t2]
+
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=10)) == (None, [])
+    task, failed_tasks = ot.task_to_retry(time_stamp + timedelta(seconds=30))
+    assert task == t1
+    assert ot.num_waiting() == 1
+    ot.remove_task(2)
+    assert ot.num_waiting() == 0
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=90)) == (t1, [])
+
+
+def test_straggler():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+    t1 = Task(1, "run command example", time_stamp, max_attempts=2)
+    t1.attempt_task("runner", time_stamp)
+    t2 = Task(2, "run command example", time_stamp, max_attempts=1)
+    t2.attempt_task("runner", time_stamp)
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t1)
+    ot.add_task(t2)
+    straggler_after = lambda task: 60
+
+    assert ot.straggler(time_stamp + timedelta(seconds=30), "runner 2", straggler_after) is None
+    # t2 has no attempts left to back up with
+    assert ot.straggler(time_stamp + timedelta(seconds=90), "runner 2", straggler_after) == t1
+    # not backed up on the runner already running it
+    assert ot.straggler(time_stamp + timedelta(seconds=90), "runner", straggler_after) is None
+    assert ot.straggler(time_stamp + timedelta(seconds=90), "runner 2", lambda task: None) is None
+
+    # one backup at a time
+    t1.attempt_task("runner 2", time_stamp + timedelta(seconds=90))
+    assert ot.straggler(time_stamp + timedelta(seconds=900), "runner 3", straggler_after) is None
+
+
+def test_task_to_retry_leaves_a_failed_backup_to_the_running_attempt():
+    time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
+    t1 = Task(1, "run command example", time_stamp, max_attempts=2, duration=60)
+    t1.attempt_task("runner", time_stamp)
+    t1.attempt_task("runner 2", time_stamp + timedelta(seconds=30)).mark_failed("failed")
+    ot = OpenTasks(LOGGER)
+    ot.add_task(t1)
+
+    assert ot.has_running_attempt(t1, time_stamp + timedelta(seconds=40))
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=40)) == (None, [])
+    # once the attempt it backs up times out the task has failed
+    assert not ot.has_running_attempt(t1, time_stamp + timedelta(seconds=90))
+    assert ot.task_to_retry(time_stamp + timedelta(seconds=90)) == (None, [t1])
+
+
 def test_add_task_with_an_attempt():
     time_stamp = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5, microsecond=100222)
 
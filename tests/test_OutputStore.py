@@ -0,0 +1,111 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import AttemptOutput
+from simple_task_server import OutputStore
+import logging
+import os
+import shutil
+import tempfile
+import pytest
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def spill_dir():
+    d = tempfile.mkdtemp()
+    yield d
+    shutil.rmtree(d)
+
+
+def test_attempt_output_head_and_tail():
+    output = AttemptOutput(4, 6)
+    assert output.append("ab") == 2
+    assert output.head == "ab"
+    assert output.tail() == ""
+    output.append("cdefgh")
+    assert output.head == "abcd"
+    assert output.tail() == "efgh"
+    output.append("ijklmnopq")
+    assert output.head == "abcd"
+    assert output.tail() == "lmnopq"
+    assert output.total_bytes == 17
+    assert output.skipped_bytes() == 7
+    assert output.size() == 10
+
+
+def test_output_store_append_and_get(spill_dir):
+    store = OutputStore(LOGGER, head_bytes=4, tail_bytes=4, spill_dir=spill_dir)
+    assert store.get("a1") is None
+    store.append("a1", "hello ")
+    store.append("a1", u"world")
+    out = store.get("a1")
+    assert out == {'head': "hell", 'tail': "orld", 'total_bytes': 11, 'skipped_bytes': 3}
+    assert store.memory_used() == 8
+    store.remove("a1")
+    assert store.get("a1") is None
+    assert store.memory_used() == 0
+    assert len(store) == 0
+
+
+def test_output_store_spills_least_recently_appended(spill_dir):
+    store = OutputStore(LOGGER, head_bytes=10, tail_bytes=10, memory_limit=25, spill_dir=spill_dir)
+    store.append("a1", "0123456789")
+    store.append("a2", "0123456789")
+    store.append("a1", "abc")
+    # a2 was appended to least recently so it gets spilled to stay under 25 bytes
+    store.append("a3", "0123456789")
+    assert store.memory_used() == 23
+    assert len(store) == 3
+    assert store.get("a2") == {'head': "0123456789", 'tail': "", 'total_bytes': 10, 'skipped_bytes': 0}
+
+    # appending to a spilled output brings it back into memory (and spills something else)
+    store.append("a2", "xyz")
+    assert store.get("a2") == {'head': "0123456789", 'tail': "xyz", 'total_bytes': 13, 'skipped_bytes': 0}
+    assert store.memory_used() <= 25
+    assert store.get("a1")['tail'] == "abc"
+    store.remove("a1")
+    store.remove("a2")
+    store.remove("a3")
+    assert len(store) == 0
+
+
+def test_output_store_caps_spilled_output(spill_dir):
+    store = OutputStore(LOGGER, head_bytes=10, tail_bytes=10, memory_limit=10, spill_dir=spill_dir,
+                        disk_limit=2 * OutputStore.SPILL_BLOCK)
+    for attempt_id in ("a1", "a2", "a3", "a4"):
+        store.append(attempt_id, "0123456789")
+    # a1, a2 and a3 were spilled, each counted as a block, so a1 was forgotten
+    assert store.disk_used() == 2 * OutputStore.SPILL_BLOCK
+    assert store.get("a1") is None
+    assert store.get("a2")['head'] == "0123456789"
+    assert len(store) == 3
+    assert len(os.listdir(spill_dir)) == 2
+    store.remove("a2")
+    assert store.disk_used() == OutputStore.SPILL_BLOCK
+
+
+def test_output_store_close():
+    store = OutputStore(LOGGER, memory_limit=10)
+    store.append("a1", "0123456789")
+    store.append("a2", "0123456789")
+    spill_dir = store._spill_dir
+    assert os.listdir(spill_dir) == ["a1.out"]
+    store.close()
+    assert not os.path.exists(spill_dir)
+    assert len(store) == 0 and store.memory_used() == 0 and store.disk_used() == 0
+
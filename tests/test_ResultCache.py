@@ -0,0 +1,49 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import ResultCache
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_ttl():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    cache = ResultCache(LOGGER, 60)
+    cache.put("key", 1, now)
+    assert cache.get("key", now + timedelta(seconds=60)) == 1
+    assert cache.get("other", now) is None
+    # an expired result is forgotten
+    assert cache.get("key", now + timedelta(seconds=61)) is None
+    assert "key" not in cache
+    cache.put("key", 2, now + timedelta(seconds=61))
+    assert cache.get("key", now + timedelta(seconds=90)) == 2
+
+
+def test_lru():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    cache = ResultCache(LOGGER, 60, max_size=2)
+    cache.put("a", 1, now)
+    cache.put("b", 2, now)
+    assert cache.get("a", now) == 1
+    cache.put("c", 3, now)
+    # b was used least recently
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert cache.get("a", now) == 1
+    assert cache.get("c", now) == 3
@@ -0,0 +1,75 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import RunnerRegistry
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+START = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5)
+
+
+def test_seen():
+    registry = RunnerRegistry(LOGGER, liveness_seconds=60)
+    registry.seen("a", START)
+    registry.seen("b", START + timedelta(seconds=10))
+    registry.seen("a", START + timedelta(seconds=20))
+    assert len(registry) == 2
+    assert [(r["runner"], r["alive"]) for r in registry.runners()] == [("b", True), ("a", True)]
+
+
+def test_attempts():
+    registry = RunnerRegistry(LOGGER)
+    registry.attempt_started("a", 1, 10)
+    registry.attempt_started("a", 2, 20)
+    assert registry.attempts("a") == [(1, 10), (2, 20)]
+    registry.attempt_ended("a", 10)
+    registry.attempt_ended("a", 30)
+    registry.attempt_ended("b", 10)
+    assert registry.attempts("a") == [(2, 20)]
+    registry.attempt_ended("a", 20)
+    assert registry.attempts("a") == []
+
+
+def test_dead_runners():
+    registry = RunnerRegistry(LOGGER, liveness_seconds=60)
+    registry.seen("a", START)
+    registry.seen("b", START + timedelta(seconds=30))
+    assert registry.dead_runners(START + timedelta(seconds=60)) == []
+    assert registry.dead_runners(START + timedelta(seconds=61)) == ["a"]
+    # only reported once
+    assert registry.dead_runners(START + timedelta(seconds=61)) == []
+    assert [(r["runner"], r["alive"]) for r in registry.runners()] == [("b", True), ("a", False)]
+    # and comes back to life when seen again
+    registry.seen("a", START + timedelta(seconds=70))
+    assert [(r["runner"], r["alive"]) for r in registry.runners()] == [("b", True), ("a", True)]
+
+
+def test_max_dead():
+    registry = RunnerRegistry(LOGGER, liveness_seconds=60, max_dead=2)
+    for i, runner in enumerate(["a", "b", "c"]):
+        registry.seen(runner, START + timedelta(seconds=i))
+    assert registry.dead_runners(START + timedelta(seconds=70)) == ["a", "b", "c"]
+    # the longest dead is forgotten
+    assert [(r["runner"], r["alive"]) for r in registry.runners()] == [("b", False), ("c", False)]
+
+
+def test_no_liveness_window():
+    registry = RunnerRegistry(LOGGER)
+    registry.seen("a", START)
+    assert registry.dead_runners(START + timedelta(days=365)) == []
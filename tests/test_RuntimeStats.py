@@ -0,0 +1,87 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import RuntimeSketch
+from simple_task_server import RuntimeStats
+import logging
+import pytest
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_sketch():
+    sketch = RuntimeSketch(alpha=0.5, accuracy=0.01)
+    assert sketch.quantile(0.5) is None
+    assert sketch.ewma is None
+    for seconds in (4, 1, 3, 2):
+        sketch.add(seconds)
+    assert sketch.count == 4
+    assert sketch.ewma == pytest.approx(2.375)
+    assert sketch.quantile(0.5) == pytest.approx(2, rel=0.01)
+    assert sketch.quantile(0.5) >= 2
+    assert sketch.quantile(1) == pytest.approx(4, rel=0.01)
+    assert sketch.quantile(0) == pytest.approx(1, rel=0.01)
+
+
+def test_sketch_is_bounded():
+    sketch = RuntimeSketch(accuracy=0.05)
+    for i in range(100000):
+        sketch.add(0.0001 + i * 0.9)
+    # from the smallest runtime counted to more than a day
+    assert sketch.num_buckets() < 400
+    assert sketch.quantile(0.99) == pytest.approx(0.99 * 90000, rel=0.05)
+
+
+def test_quantile():
+    runtimes = RuntimeStats(LOGGER, min_samples=5, accuracy=0.01)
+    for seconds in (5, 1, 4, 2):
+        runtimes.observe("build", seconds)
+    assert runtimes.quantile("build", 0.5) is None
+    assert runtimes.ewma("build") is not None
+    runtimes.observe("build", 3)
+    assert runtimes.quantile("build", 0.5) == pytest.approx(3, rel=0.01)
+    assert runtimes.quantile("build", 0.9) == pytest.approx(5, rel=0.01)
+    runtimes.observe("build", 50)
+    assert runtimes.quantile("build", 0.9) == pytest.approx(50, rel=0.01)
+    assert runtimes.quantile("test", 0.5) is None
+    assert runtimes.ewma("test") is None
+    assert runtimes.num_samples("build") == 6
+
+
+def test_max_families():
+    runtimes = RuntimeStats(LOGGER, max_families=2, min_samples=1)
+    runtimes.observe("build", 1)
+    runtimes.observe("test", 1)
+    runtimes.observe("build", 1)
+    runtimes.observe("deploy", 1)
+    # test got a runtime least recently
+    assert len(runtimes) == 2
+    assert runtimes.num_samples("test") == 0
+    assert runtimes.num_samples("build") == 2
+
+
+def test_quantiles_only_cached_for_known_families():
+    runtimes = RuntimeStats(LOGGER, max_families=1, min_samples=2)
+    for family in range(100):
+        assert runtimes.quantile(family, 0.5) is None
+    runtimes.observe("build", 1)
+    assert runtimes.quantile("build", 0.5) is None
+    runtimes.observe("build", 1)
+    assert runtimes.quantile("build", 0.5) is not None
+    assert list(runtimes._quantiles) == ["build"]
+    # forgetting the family forgets its quantiles
+    runtimes.observe("test", 1)
+    assert runtimes._quantiles == {}
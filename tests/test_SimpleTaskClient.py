@@ -0,0 +1,225 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_client import SimpleTaskClient
+from simple_task_client import Runner
+import BaseHTTPServer
+import json
+import threading
+import time
+import pytest
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with the server's status and body and records the method and path of each.
+    """
+
+    def _answer(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        self.server.requests.append((self.command, self.path.split("?")[0]))
+        body = json.dumps(self.server.body)
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.status = 503
+    server.body = {'message': "busy"}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server):
+    return SimpleTaskClient("http://127.0.0.1:%d/" % server.server_port, retries=2, backoff_factor=0)
+
+
+def test_reads_are_retried(stub_server):
+    client = _client(stub_server)
+    assert client.get_next_attempt("runner") == {'message': "busy"}
+    assert stub_server.requests == [('GET', '/attempt')] * 3
+    client.close()
+
+
+def test_reports_are_not_retried(stub_server):
+    client = _client(stub_server)
+    client.report_completed_attempt("runner", 1, 2)
+    client.report_failed_attempt("runner", 1, 3, message="failed")
+    client.heartbeat("runner", [(1, 4)])
+    client.set_pool_limit("db", 2)
+    assert stub_server.requests == [('PUT', '/attempt'), ('PUT', '/attempt'), ('PUT', '/heartbeat'),
+                                    ('PUT', '/admin/pools')]
+    client.close()
+
+
+def test_adds_are_not_retried(stub_server):
+    client = _client(stub_server)
+    stub_server.body = {'task_id': 7}
+    assert client.add_task("run command") == "7"
+    assert stub_server.requests == [('POST', '/task')]
+    client.close()
+
+
+class FakeClient(object):
+    """
+    Stands in for SimpleTaskClient in a Runner: hands out the attempts it is given and records what is sent back.
+    """
+
+    def __init__(self, attempts=(), stop=()):
+        self.attempts = list(attempts)
+        self.stop = list(stop)
+        self.heartbeats = []
+        self.reports = []
+
+    def get_next_attempt(self, runner_id, labels=None):
+        if not self.attempts:
+            return {'status': "none"}
+        return dict(self.attempts.pop(0), status="attempt")
+
+    def heartbeat(self, runner_id, attempts):
+        self.heartbeats.append(attempts)
+        return self.stop
+
+    def report_completed_attempt(self, runner_id, task_id, attempt_id, message=None):
+        self.reports.append(("completed", attempt_id))
+
+    def report_failed_attempt(self, runner_id, task_id, attempt_id, message=None):
+        self.reports.append(("failed", attempt_id))
+
+
+class FakeProcess(object):
+
+    def __init__(self, return_code=None):
+        self.return_code = return_code
+        self.terminated = False
+
+    def poll(self):
+        return self.return_code
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeReader(object):
+
+    def __init__(self):
+        self.alive = True
+        self.tail = "the end"
+
+    def is_alive(self):
+        return self.alive
+
+
+def _sent(runner):
+    """
+    Sends everything the runner has queued to send, as its send thread would.
+    """
+    while not runner._sends.empty():
+        send, args, kwargs = runner._sends.get()
+        send(*args, **kwargs)
+        runner._sends.task_done()
+
+
+def test_prefetched_attempt_is_heartbeated():
+    client = FakeClient(attempts=[{'task_id': 2, 'attempt_id': 20, 'command': "true"}])
+    runner = Runner(client, "runner", slots=2, heartbeat_seconds=0.01)
+    runner._running[FakeProcess()] = {'task_id': 1, 'attempt_id': 10, 'command': "true"}
+    assert runner._prefetch() == 0
+    # only one attempt is leased ahead
+    assert runner._prefetch() == Runner.POLL_INTERVAL
+    time.sleep(0.02)
+    runner._heartbeat()
+    _sent(runner)
+    assert sorted(client.heartbeats[0]) == [(1, 10), (2, 20)]
+    assert runner._next_attempt()['attempt_id'] == 20
+    assert runner._leased == {}
+
+
+def test_stopped_prefetched_attempt_is_not_started():
+    client = FakeClient(attempts=[{'task_id': 2, 'attempt_id': 20, 'command': "true"}], stop=[20])
+    runner = Runner(client, "runner", slots=2, heartbeat_seconds=0.01)
+    runner._prefetch()
+    time.sleep(0.02)
+    runner._heartbeat()
+    _sent(runner)
+    assert runner._next_attempt() is None
+    assert runner._stopped == set()
+
+
+def test_reap_does_not_wait_for_output():
+    client = FakeClient()
+    runner = Runner(client, "runner", slots=2)
+    done = FakeProcess(return_code=1)
+    reader = FakeReader()
+    runner._running[done] = {'task_id': 1, 'attempt_id': 10, 'command': "false"}
+    runner._readers[done] = reader
+    started = time.time()
+    runner._reap()
+    assert time.time() - started < Runner.POLL_INTERVAL
+    # the slot is free but the outcome waits for the rest of the output
+    assert runner._running == {}
+    _sent(runner)
+    assert client.reports == []
+    reader.alive = False
+    runner._reap()
+    _sent(runner)
+    assert client.reports == [("failed", 10)]
+    assert runner._finishing == {} and runner._readers == {}
+
+
+def test_one_slot_reports_synchronously():
+    client = FakeClient()
+    runner = Runner(client, "runner", slots=1)
+    runner._start_thread(runner._send_loop)
+    done = FakeProcess(return_code=0)
+    runner._running[done] = {'task_id': 1, 'attempt_id': 10, 'command': "true"}
+    runner._reap()
+    # sent by the time reaping is done
+    assert client.reports == [("completed", 10)]
+
+
+
+def test_stopped_attempt_is_terminated_and_not_reported():
+    client = FakeClient(stop=[10])
+    runner = Runner(client, "runner", slots=2)
+    process = FakeProcess()
+    runner._running[process] = {'task_id': 1, 'attempt_id': 10, 'command': "true"}
+    runner._send_heartbeat([(1, 10)])
+    assert process.terminated
+    process.return_code = -15
+    runner._reap()
+    _sent(runner)
+    assert client.reports == []
+    assert runner._stopped == set()
@@ -15,6 +15,7 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 """
 
 from simple_task_server import SimpleTaskQueue
+from simple_task_server import Pools
 from simple_task_server import Task
 from datetime import datetime
 import pytest
@@ -95,3 +96,126 @@ def test_get_non_existent_task(basic_simple_task_queue):
     assert tq.task(54663.00) is None
 
 
+
+
+def test_ready_tasks():
+    tq = SimpleTaskQueue(LOGGER)
+    tq.add_task(Task(1, 'run command', datetime.now()), ready=False)
+    tq.add_task(Task(2, 'run command', datetime.now()))
+    tq.add_task(Task(3, 'run command', datetime.now()), ready=False)
+    assert len(tq) == 3
+    assert tq.num_ready() == 1
+    assert tq.next_task().task_id() == 2
+    # a task that becomes ready keeps its place in line
+    tq.set_ready(3)
+    tq.set_ready(1)
+    assert tq.num_ready() == 3
+    assert tq.next_task().task_id() == 1
+    tq.remove_task(1)
+    assert tq.num_ready() == 2
+    assert tq.next_task().task_id() == 2
+
+
+def test_next_task_with_labels():
+    tq = SimpleTaskQueue(LOGGER)
+    tq.add_task(Task(1, 'run command', datetime.now(), labels=["gpu"]))
+    tq.add_task(Task(2, 'run command', datetime.now(), labels=["gpu", "big_memory"]))
+    tq.add_task(Task(3, 'run command', datetime.now()))
+    assert tq.num_ready() == 3
+    assert tq.next_task(labels=frozenset()).task_id() == 3
+    assert tq.next_task(labels=frozenset(["big_memory"])).task_id() == 3
+    assert tq.next_task(labels=frozenset(["gpu"])).task_id() == 1
+    assert tq.next_task(labels=frozenset(["gpu"]), skip_task_ids={1}).task_id() == 3
+    assert tq.next_task().task_id() == 1
+    tq.remove_task(1)
+    assert tq.next_task(labels=frozenset(["gpu", "big_memory"])).task_id() == 2
+    tq.remove_task(3)
+    assert tq.next_task(labels=frozenset(["gpu"])) is None
+    assert tq.num_ready() == 1
+
+
+def _take(tq, n, labels=None):
+    taken = []
+    for _ in range(n):
+        task = tq.next_task(labels=labels)
+        if task is None:
+            break
+        tq.remove_task(task.task_id())
+        taken.append(task.queue)
+    return taken
+
+
+def test_queues_share_by_weight():
+    tq = SimpleTaskQueue(LOGGER, weights={"interactive": 3})
+    for i in range(100):
+        tq.add_task(Task(i, 'run command', datetime.now(), queue="backfill"))
+    for i in range(100, 110):
+        tq.add_task(Task(i, 'run command', datetime.now(), queue="interactive"))
+    taken = _take(tq, 8)
+    assert taken.count("interactive") == 6
+    assert taken.count("backfill") == 2
+    # once a queue runs dry the others get everything
+    taken = _take(tq, 20)
+    assert taken.count("interactive") == 4
+    assert taken.count("backfill") == 16
+    assert tq.queue_stats() == {"backfill": {"todo": 82, "ready": 82, "weight": 1.0}}
+
+
+def test_queue_fractional_weight():
+    tq = SimpleTaskQueue(LOGGER, weights={"low": 0.5})
+    for i in range(10):
+        tq.add_task(Task(i, 'run command', datetime.now(), queue="low"))
+        tq.add_task(Task(i + 10, 'run command', datetime.now()))
+    taken = _take(tq, 9)
+    assert taken.count("low") == 3
+    assert taken.count(SimpleTaskQueue.DEFAULT_QUEUE) == 6
+
+
+def test_queue_without_runnable_task_keeps_its_turn():
+    tq = SimpleTaskQueue(LOGGER)
+    for i in range(4):
+        tq.add_task(Task(i, 'run command', datetime.now(), queue="gpu", labels=["gpu"]))
+        tq.add_task(Task(i + 10, 'run command', datetime.now(), queue="cpu"))
+    assert _take(tq, 2, labels=frozenset()) == ["cpu", "cpu"]
+    assert _take(tq, 2, labels=frozenset(["gpu"])) == ["gpu", "cpu"]
+    assert _take(tq, 10, labels=frozenset()) == ["cpu"]
+    assert tq.num_ready() == 3
+    assert tq.num_ready(queue="gpu") == 3
+
+
+def test_full_pool_parks_tasks():
+    pools = Pools(LOGGER, limits={"db": 1})
+    tq = SimpleTaskQueue(LOGGER, pools=pools)
+    tq.add_task(Task(1, 'run command', datetime.now(), pool="db"))
+    tq.add_task(Task(2, 'run command', datetime.now(), pool="db"))
+    tq.add_task(Task(3, 'run command', datetime.now()))
+    assert tq.next_task().task_id() == 1
+    tq.remove_task(1)
+    pools.acquire("db")
+    # 2 gets parked, not skipped over again and again
+    assert tq.next_task().task_id() == 3
+    assert tq.num_parked() == 1
+    assert tq.num_ready() == 1
+    assert not tq.is_ready(2)
+    tq.remove_task(3)
+    assert tq.next_task() is None
+
+    pools.release("db")
+    tq.unpark("db", count=pools.free("db"))
+    assert tq.num_parked() == 0
+    assert tq.next_task().task_id() == 2
+
+
+def test_parked_task_with_room_in_pool_is_not_stranded():
+    pools = Pools(LOGGER, limits={"db": 1})
+    tq = SimpleTaskQueue(LOGGER, pools=pools)
+    tq.add_task(Task(1, 'run command', datetime.now(), pool="db"))
+    tq.add_task(Task(2, 'run command', datetime.now(), pool="db"))
+    pools.acquire("db")
+    assert tq.next_task() is None
+    assert tq.num_parked() == 2
+
+    # room in the pool without unparking anything still gets the parked tasks looked at
+    pools.release("db")
+    assert tq.next_task().task_id() == 1
+    assert tq.num_parked() == 1
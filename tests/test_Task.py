@@ -17,6 +17,7 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 from simple_task_server import Task
 import logging
 import datetime
+import pytest
 
 LOGGER = logging.getLogger(__name__)
 
@@ -399,3 +400,26 @@ def test_completed_time_multiple_completed_attempts():
     attempt_2 = task.attempt_task("runner 2", attempt_time_2)
     attempt_2.mark_completed(datetime.datetime(2018, 1, 15, 12, 35, 48))
     assert task.completed_time() == attempt_completed_time
+
+
+def test_retry_backoff():
+    task_created_time = datetime.datetime(2018, 1, 15, 12, 35, 0)
+    assert Task("1234", "some cmd", task_created_time).retry_backoff() is None
+
+    task = Task("1234", "some cmd", task_created_time, max_attempts=5, retry_delay=2, retry_multiplier=3,
+                retry_max_delay=30, retry_jitter=0.5)
+    delays = []
+    for i in range(4):
+        task.attempt_task("runner 1", task_created_time).mark_failed("failed")
+        delays.append(task.retry_backoff(rand=lambda: 0))
+    assert delays == [2, 6, 18, 30]
+    # jitter takes off up to half of it
+    assert task.retry_backoff(rand=lambda: 1) == 15
+
+
+def test_retry_jitter_is_from_0_to_1():
+    task_created_time = datetime.datetime(2018, 1, 15, 12, 35, 0)
+    assert Task("1234", "some cmd", task_created_time, retry_delay=2, retry_jitter=1).retry_jitter == 1
+    for jitter in (-0.5, 1.5):
+        with pytest.raises(ValueError):
+            Task("1234", "some cmd", task_created_time, retry_delay=2, retry_jitter=jitter)
@@ -45,3 +45,13 @@ def test_state_tracking_with_completed():
     assert attempt.is_failed() is False
     assert attempt.is_completed() is True
     assert attempt.is_in_process() is False
+
+
+def test_heartbeat():
+    attempt = TaskAttempt("runner 1", datetime.datetime(2018, 1, 15, 12, 35, 0))
+    # with no heartbeats the last heartbeat is the start
+    assert attempt.last_heartbeat == datetime.datetime(2018, 1, 15, 12, 35, 0)
+    attempt.heartbeat(datetime.datetime(2018, 1, 15, 12, 36, 0))
+    assert attempt.last_heartbeat == datetime.datetime(2018, 1, 15, 12, 36, 0)
+    assert attempt.start_time == datetime.datetime(2018, 1, 15, 12, 35, 0)
+    assert attempt.is_in_process() is True
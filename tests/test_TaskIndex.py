@@ -0,0 +1,113 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import TaskIndex
+from simple_task_server import Task
+from datetime import datetime
+from datetime import timedelta
+import pytest
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+START = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5)
+
+
+@pytest.fixture
+def task_index():
+    index = TaskIndex(LOGGER, index_commands=True)
+    for i in range(10):
+        index.add(Task(i, "python -m job_%d" % (i % 3) if i % 2 else "ls -l", START + timedelta(minutes=i),
+                       name="even" if i % 2 == 0 else "odd"))
+        index.add_runner(i, "runner_%d" % (i % 2))
+    return index
+
+
+def _ids(result):
+    return [task.task_id() for task in result[0]]
+
+
+def test_query_all(task_index):
+    assert len(task_index) == 10
+    assert _ids(task_index.query()) == range(10)
+    assert task_index.query()[1] is None
+
+
+def test_query_by_name(task_index):
+    assert _ids(task_index.query(name="odd")) == [1, 3, 5, 7, 9]
+    assert _ids(task_index.query(name="unknown")) == []
+
+
+def test_query_by_runner(task_index):
+    task_index.add_runner(1, "runner_0")
+    task_index.add_runner(1, "runner_0")
+    assert _ids(task_index.query(runner="runner_0")) == [0, 1, 2, 4, 6, 8]
+    assert _ids(task_index.query(runner="runner_1")) == [1, 3, 5, 7, 9]
+
+
+def test_query_by_created_time(task_index):
+    result = task_index.query(created_after=START + timedelta(minutes=2), created_before=START + timedelta(minutes=5))
+    assert _ids(result) == [2, 3, 4]
+
+
+def test_query_by_command_prefix(task_index):
+    assert _ids(task_index.query(command_prefix="python")) == [1, 3, 5, 7, 9]
+    assert _ids(task_index.query(command_prefix="python -m job_1")) == [1, 7]
+    assert _ids(task_index.query(command_prefix="z")) == []
+    unindexed = TaskIndex(LOGGER)
+    unindexed.add(Task(1, "python -m job", START))
+    unindexed.add(Task(2, "ls -l", START))
+    assert _ids(unindexed.query(command_prefix="py")) == [1]
+
+
+def test_query_paging_by_command_prefix(task_index):
+    # job_0, job_1 and job_2 commands are interleaved in created order
+    tasks, cursor = task_index.query(command_prefix="python -m job_", limit=2)
+    assert [t.task_id() for t in tasks] == [1, 3]
+    tasks, cursor = task_index.query(command_prefix="python -m job_", limit=2, cursor=cursor)
+    assert [t.task_id() for t in tasks] == [5, 7]
+    tasks, cursor = task_index.query(command_prefix="python -m job_", limit=2, cursor=cursor,
+                                     created_before=START + timedelta(minutes=9))
+    assert [t.task_id() for t in tasks] == []
+    assert cursor is None
+
+
+def test_query_combined(task_index):
+    assert _ids(task_index.query(name="odd", command_prefix="python -m job_0",
+                                 created_after=START + timedelta(minutes=4))) == [9]
+
+
+def test_query_paging(task_index):
+    tasks, cursor = task_index.query(name="even", limit=2)
+    assert [t.task_id() for t in tasks] == [0, 2]
+    # a deleted task doesn't lose the place
+    task_index.remove(2)
+    tasks, cursor = task_index.query(name="even", limit=2, cursor=cursor)
+    assert [t.task_id() for t in tasks] == [4, 6]
+    tasks, cursor = task_index.query(name="even", limit=2, cursor=cursor)
+    assert [t.task_id() for t in tasks] == [8]
+    assert cursor is None
+
+
+def test_remove(task_index):
+    for i in range(10):
+        task_index.remove(i)
+    task_index.remove(15)
+    assert len(task_index) == 0
+    assert _ids(task_index.query()) == []
+    assert _ids(task_index.query(name="odd")) == []
+    assert _ids(task_index.query(runner="runner_0")) == []
+    assert _ids(task_index.query(command_prefix="ls")) == []
@@ -17,7 +17,9 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 from simple_task_server import SimpleTaskQueue
 from simple_task_server import Task
 from simple_task_server import TaskManager
+from simple_task_server import MonotonicIDGenerator
 from datetime import datetime
+from datetime import timedelta
 import pytest
 import logging
 
@@ -568,3 +570,779 @@ def test_find_task_done_looking_in_all(basic_task_manager):
     assert basic_task_manager._find_task(1, todo=True, in_process=True, done=True) == task
 
 
+def test_heartbeat(basic_task_manager):
+    start_time = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=30, microsecond=100222)
+    heartbeat_time = datetime(year=2018, month=8, day=13, hour=5, minute=11, second=30, microsecond=100222)
+    task, attempt = basic_task_manager.start_next_attempt("runner", start_time)
+    assert basic_task_manager.heartbeat(task.task_id(), attempt.id(), heartbeat_time - timedelta(seconds=1),
+                                        runner="runner") is True
+    assert basic_task_manager.heartbeat(task.task_id(), attempt.id(), heartbeat_time) is True
+    assert attempt.last_heartbeat == heartbeat_time
+    # another runner can't keep the attempt alive
+    assert not basic_task_manager.heartbeat(task.task_id(), attempt.id(), heartbeat_time + timedelta(seconds=1),
+                                            runner="other runner")
+    assert attempt.last_heartbeat == heartbeat_time
+
+    # unknown attempts and attempts of tasks that aren't in process are no longer wanted
+    assert basic_task_manager.heartbeat(task.task_id(), "unknown attempt id", heartbeat_time) is False
+    basic_task_manager.complete_attempt(task.task_id(), attempt.id(), heartbeat_time)
+    assert basic_task_manager.heartbeat(task.task_id(), attempt.id(), heartbeat_time) is False
+    assert basic_task_manager.heartbeat(2, "some attempt", heartbeat_time) is False
+
+
+def test_attempt_ids_come_from_id_generator():
+    tm = TaskManager(LOGGER, attempt_ids=MonotonicIDGenerator())
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now()))
+    task1, attempt1 = tm.start_next_attempt("runner", datetime.now())
+    task2, attempt2 = tm.start_next_attempt("runner", datetime.now())
+    assert isinstance(attempt1.id(), int)
+    assert attempt1.id() < attempt2.id()
+    assert task1.get_attempt(attempt1.id()) == attempt1
+
+
+def test_dependencies():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now(), dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", datetime.now(), dependent_on=[1, 2]))
+    assert tm.dependencies(1) == [2, 3]
+    assert tm.dependencies(2) == [3]
+    assert tm.dependencies(3) == []
+    assert tm.num_dependencies(1) == 2
+
+    tm.delete_task(3)
+    assert tm.dependencies(1) == [2]
+    assert tm.dependencies(2) == []
+    tm.delete_task(1)
+    assert tm.dependencies(1) == []
+
+
+def test_list_versions():
+    tm = TaskManager(LOGGER)
+    assert tm.list_version("not a list") is None
+    versions = dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    assert tm.list_version("todo") > versions["todo"]
+    assert tm.list_version("inprocess") == versions["inprocess"]
+    versions = dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert tm.list_version("todo") > versions["todo"]
+    assert tm.list_version("inprocess") > versions["inprocess"]
+    assert tm.list_version("completed") == versions["completed"]
+    versions = dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    # nothing to start and heartbeats don't change any list
+    tm.start_next_attempt("runner", datetime.now())
+    tm.heartbeat(task.task_id(), attempt.id(), datetime.now())
+    assert versions == dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    tm.complete_attempt(task.task_id(), attempt.id(), datetime.now())
+    assert tm.list_version("inprocess") > versions["inprocess"]
+    assert tm.list_version("completed") > versions["completed"]
+    assert tm.list_version("failed") == versions["failed"]
+    versions = dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    # an unrelated task leaves the done lists as they were
+    tm.add_task(Task(2, "run command example", datetime.now()))
+    assert tm.list_version("todo") > versions["todo"]
+    assert tm.list_version("completed") == versions["completed"]
+    assert tm.list_version("failed") == versions["failed"]
+
+    # but a task depending on a completed one shows up in its dependencies
+    tm.add_task(Task(3, "run command example", datetime.now(), dependent_on=[task.task_id()]))
+    assert tm.list_version("completed") > versions["completed"]
+    assert tm.list_version("failed") == versions["failed"]
+    versions = dict((list_type, tm.list_version(list_type)) for list_type in TaskManager.LIST_TYPES)
+
+    tm.delete_task(2)
+    assert tm.list_version("todo") > versions["todo"]
+    assert tm.list_version("completed") == versions["completed"]
+    assert tm.list_version("inprocess") == versions["inprocess"]
+
+
+def test_changes():
+    tm = TaskManager(LOGGER, change_feed_size=100)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now()))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.complete_attempt(task.task_id(), attempt.id(), datetime.now())
+    tm.delete_task(2)
+
+    changes, resync, last_seq = tm.changes(0)
+    assert not resync
+    assert last_seq == 6
+    assert [(c['event'], c['task_id'], c['list']) for c in changes] == [("added", 1, "todo"),
+                                                                         ("added", 2, "todo"),
+                                                                         ("attempt_started", 1, "inprocess"),
+                                                                         ("attempt_completed", 1, "inprocess"),
+                                                                         ("done", 1, "completed"),
+                                                                         ("deleted", 2, None)]
+    assert changes[2]['attempt_id'] == attempt.id()
+    changes, resync, last_seq = tm.changes(4)
+    assert [c['seq'] for c in changes] == [5, 6]
+
+
+def test_stats():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now(), max_attempts=2))
+    tm.add_task(Task(2, "run command example", datetime.now(), dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", datetime.now()))
+    stats = tm.stats()
+    assert (stats["todo"], stats["ready"], stats["blocked"]) == (3, 2, 1)
+
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+    tm.fail_attempt(1, attempt.id(), "failed")
+    stats = tm.stats()
+    assert (stats["in_process"], stats["attempts_in_flight"], stats["retries_pending"]) == (1, 0, 1)
+
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+    stats = tm.stats()
+    assert (stats["attempts_in_flight"], stats["retries_pending"]) == (1, 0)
+
+    # completing 1 unblocks 2
+    tm.complete_attempt(1, attempt.id(), datetime.now())
+    stats = tm.stats()
+    assert (stats["todo"], stats["ready"], stats["blocked"]) == (2, 2, 0)
+    assert (stats["in_process"], stats["attempts_in_flight"], stats["completed"]) == (0, 0, 1)
+
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.fail_attempt(task.task_id(), attempt.id(), "failed")
+    assert (tm.stats()["failed"], tm.stats()["completed"]) == (1, 1)
+    tm.delete_task(task.task_id())
+    tm.delete_task(1)
+    assert (tm.stats()["failed"], tm.stats()["completed"]) == (0, 0)
+
+
+def test_blocked_task_is_skipped():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now(), dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", datetime.now()))
+    task1, attempt1 = tm.start_next_attempt("runner", datetime.now())
+    task3, attempt3 = tm.start_next_attempt("runner", datetime.now())
+    assert task3.task_id() == 3
+    assert tm.start_next_attempt("runner", datetime.now()) == (None, None)
+    tm.complete_attempt(1, attempt1.id(), datetime.now())
+    task2, attempt2 = tm.start_next_attempt("runner", datetime.now())
+    assert task2.task_id() == 2
+
+
+def test_query():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now(), name="first"))
+    tm.add_task(Task(2, "run command example", datetime.now(), name="second"))
+    tm.start_next_attempt("runner", datetime.now())
+    tasks, cursor = tm.query(runner="runner")
+    assert [(task.task_id(), list_type) for task, list_type in tasks] == [(1, "inprocess")]
+    tasks, cursor = tm.query(name="second")
+    assert [(task.task_id(), list_type) for task, list_type in tasks] == [(2, "todo")]
+    tm.delete_task(2)
+    assert tm.query(name="second") == ([], None)
+
+
+def test_reclaim_dead_runners():
+    start = datetime(year=2018, month=8, day=13, hour=5, minute=10, second=5)
+    tm = TaskManager(LOGGER, runner_timeout=60)
+    tm.add_task(Task(1, "run command example", start, max_attempts=2))
+    tm.add_task(Task(2, "run command example", start))
+    task1, attempt1 = tm.start_next_attempt("dies", start)
+    task2, attempt2 = tm.start_next_attempt("dies", start)
+    assert [r["attempts"] for r in tm.runners()] == [[(1, attempt1.id()), (2, attempt2.id())]]
+
+    tm.runner_seen("lives", start + timedelta(seconds=30))
+    assert tm.reclaim_dead_runners(start + timedelta(seconds=61)) == 2
+    assert attempt1.is_failed()
+    assert attempt2.is_failed()
+    stats = tm.stats()
+    assert (stats["in_process"], stats["retries_pending"], stats["failed"]) == (1, 1, 1)
+
+    task, attempt = tm.start_next_attempt("lives", start + timedelta(seconds=62))
+    assert task.task_id() == 1
+    assert [(r["runner"], r["alive"], len(r["attempts"])) for r in tm.runners()] == [("lives", True, 1),
+                                                                                   ("dies", False, 0)]
+    tm.delete_task(1)
+    assert [len(r["attempts"]) for r in tm.runners()] == [0, 0]
+
+
+def test_labels():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now(), labels=["gpu"]))
+    tm.add_task(Task(2, "run command example", datetime.now()))
+    assert tm.start_next_attempt("cpu runner", datetime.now())[0].task_id() == 2
+    assert tm.start_next_attempt("cpu runner", datetime.now()) == (None, None)
+    assert tm.start_next_attempt("gpu runner", datetime.now(), labels=["gpu"])[0].task_id() == 1
+
+
+def test_queue_stats():
+    tm = TaskManager(LOGGER, queue_weights={"interactive": 2})
+    tm.add_task(Task(1, "run command example", datetime.now(), queue="interactive"))
+    tm.add_task(Task(2, "run command example", datetime.now(), queue="interactive"))
+    tm.add_task(Task(3, "run command example", datetime.now()))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.complete_attempt(task.task_id(), attempt.id(), datetime.now())
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert tm.stats()["queues"] == {
+        "interactive": {"todo": 0, "ready": 0, "in_process": 1, "completed": 1, "failed": 0, "cancelled": 0,
+            "weight": 2.0},
+        "default": {"todo": 1, "ready": 1, "in_process": 0, "completed": 0, "failed": 0, "cancelled": 0,
+            "weight": 1.0}}
+    tm.delete_task(task.task_id())
+    assert tm.stats()["queues"]["interactive"]["in_process"] == 0
+
+
+def test_pools():
+    tm = TaskManager(LOGGER, pool_limits={"db": 2})
+    for i in range(1, 5):
+        tm.add_task(Task(i, "run command example", datetime.now(), pool="db", max_attempts=2))
+    tm.add_task(Task(5, "run command example", datetime.now()))
+    task1, attempt1 = tm.start_next_attempt("runner", datetime.now())
+    task2, attempt2 = tm.start_next_attempt("runner", datetime.now())
+    task5, attempt5 = tm.start_next_attempt("runner", datetime.now())
+    assert [task1.task_id(), task2.task_id(), task5.task_id()] == [1, 2, 5]
+    assert tm.start_next_attempt("runner", datetime.now()) == (None, None)
+    assert tm.stats()["pools"] == {"db": {"limit": 2, "in_flight": 2, "parked": 2}}
+
+    # a failed attempt frees its place but its retry takes it back before anything parked
+    tm.fail_attempt(1, attempt1.id(), "failed")
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+    assert tm.start_next_attempt("runner", datetime.now()) == (None, None)
+
+    tm.complete_attempt(2, attempt2.id(), datetime.now())
+    assert tm.stats()["pools"]["db"] == {"limit": 2, "in_flight": 1, "parked": 1}
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 3
+
+    tm.set_pool_limit("db", 3)
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 4
+    tm.delete_task(4)
+    assert tm.stats()["pools"]["db"] == {"limit": 3, "in_flight": 2, "parked": 0}
+
+
+def test_timed_out_attempt_hands_its_pool_place_to_its_retry():
+    tm = TaskManager(LOGGER, pool_limits={"db": 1})
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, pool="db", duration=10, max_attempts=3))
+    tm.add_task(Task(2, "run command example", now, pool="db"))
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert tm.start_next_attempt("runner", now) == (None, None)
+
+    # the pool is full only because of the attempt that timed out, so it is retried
+    task, attempt = tm.start_next_attempt("other", now + timedelta(seconds=11))
+    assert task.task_id() == 1
+    assert tm.stats()["pools"]["db"] == {"limit": 1, "in_flight": 1, "parked": 1}
+    task, attempt = tm.start_next_attempt("other", now + timedelta(seconds=22))
+    assert (task.task_id(), task.num_attempts()) == (1, 3)
+
+    # its last attempt times out too, so it fails and 2 gets the place
+    task, attempt = tm.start_next_attempt("other", now + timedelta(seconds=33))
+    assert task.task_id() == 2
+    assert [t.task_id() for t in tm.failed_tasks()] == [1]
+    assert tm.stats()["pools"]["db"] == {"limit": 1, "in_flight": 1, "parked": 0}
+
+
+def test_delete_unparked_task_unparks_the_next():
+    tm = TaskManager(LOGGER, pool_limits={"db": 1})
+    for i in range(1, 4):
+        tm.add_task(Task(i, "run command example", datetime.now(), pool="db"))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert tm.start_next_attempt("runner", datetime.now()) == (None, None)
+    assert tm.stats()["pools"]["db"] == {"limit": 1, "in_flight": 1, "parked": 2}
+
+    # 2 is let out for the place 1 gives up, then deleted before it starts, so 3 gets the place
+    tm.complete_attempt(1, attempt.id(), datetime.now())
+    assert tm.stats()["pools"]["db"]["parked"] == 1
+    tm.delete_task(2)
+    assert tm.stats()["pools"]["db"]["parked"] == 0
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 3
+
+
+def test_critical_path_priority():
+    tm = TaskManager(LOGGER, priority_policy="critical_path")
+    tm.add_task(Task(1, "run command example", datetime.now(), duration=10))
+    tm.add_task(Task(2, "run command example", datetime.now(), duration=10))
+    tm.add_task(Task(3, "run command example", datetime.now(), duration=30, dependent_on=[2]))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 2
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+
+    fifo = TaskManager(LOGGER)
+    fifo.add_task(Task(1, "run command example", datetime.now(), duration=10))
+    fifo.add_task(Task(2, "run command example", datetime.now(), duration=10))
+    fifo.add_task(Task(3, "run command example", datetime.now(), duration=30, dependent_on=[2]))
+    task, attempt = fifo.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+
+
+def test_failed_task_cancels_dependents():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now(), dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", datetime.now(), dependent_on=[2]))
+    tm.add_task(Task(4, "run command example", datetime.now()))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 1
+    tm.fail_attempt(1, attempt.id(), "failed")
+    assert [t.task_id() for t in tm.cancelled_tasks()] == [2, 3]
+    assert tm.task(3).cancel_reason == TaskManager.UPSTREAM_FAILED
+    stats = tm.stats()
+    assert (stats["todo"], stats["failed"], stats["cancelled"]) == (1, 1, 2)
+    assert stats["queues"]["default"]["cancelled"] == 2
+
+    # a task added onto a failed (or cancelled) task is cancelled right away
+    tm.add_task(Task(5, "run command example", datetime.now(), dependent_on=[3]))
+    assert tm.task(5).is_cancelled()
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 4
+    assert tm.start_next_attempt("runner", datetime.now()) == (None, None)
+
+    tm.delete_task(5)
+    assert tm.stats()["cancelled"] == 2
+
+
+def test_late_completion_leaves_dependents_cancelled():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, duration=10))
+    tm.add_task(Task(2, "run command example", now, dependent_on=[1]))
+    task, attempt = tm.start_next_attempt("runner", now)
+    # the attempt times out, so 1 fails and 2 is cancelled
+    assert tm.start_next_attempt("other", now + timedelta(seconds=11)) == (None, None)
+    assert [t.task_id() for t in tm.cancelled_tasks()] == [2]
+
+    tm.complete_attempt(1, attempt.id(), now + timedelta(seconds=12))
+    assert [t.task_id() for t in tm.completed_tasks()] == [1]
+    assert [t.task_id() for t in tm.cancelled_tasks()] == [2]
+    assert tm.task(2).cancel_reason == TaskManager.UPSTREAM_FAILED
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=13)) == (None, None)
+
+
+def test_deleted_task_cancels_dependents():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    tm.add_task(Task(2, "run command example", datetime.now(), dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", datetime.now(), dependent_on=[1]))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.complete_attempt(1, attempt.id(), datetime.now())
+    tm.add_task(Task(4, "run command example", datetime.now(), dependent_on=[2]))
+    # 2 is in process so it is not cancelled, but 4, waiting on it, is when 2 is deleted
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    assert task.task_id() == 2
+    tm.delete_task(2)
+    assert tm.task(4).cancel_reason == TaskManager.UPSTREAM_DELETED
+    assert not tm.task(3).is_cancelled()
+    assert tm.stats()["cancelled"] == 1
+
+
+def test_done_time_is_when_the_task_was_done():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now))
+    tm.add_task(Task(2, "run command example", now))
+    tm.add_task(Task(3, "run command example", now, dependent_on=[2]))
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.complete_attempt(1, attempt.id(), now + timedelta(seconds=5))
+    assert tm._done.done_time(1) == now + timedelta(seconds=5)
+    # the dependents cancelled by a failure are done when it failed
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.fail_attempt(2, attempt.id(), "failed", time_stamp=now + timedelta(seconds=7))
+    assert tm._done.done_time(2) == now + timedelta(seconds=7)
+    assert tm._done.done_time(3) == now + timedelta(seconds=7)
+
+
+def test_compact():
+    tm = TaskManager(LOGGER, retention={"completed": (60, 2), "failed": (None, 1)})
+    for task_id in range(1, 6):
+        tm.add_task(Task(task_id, "run command example", datetime.now()))
+    tm.add_task(Task(6, "run command example", datetime.now(), dependent_on=[5]))
+    for task_id in range(1, 4):
+        task, attempt = tm.start_next_attempt("runner", datetime.now())
+        tm.complete_attempt(task.task_id(), attempt.id(), datetime.now())
+    for task_id in range(4, 6):
+        task, attempt = tm.start_next_attempt("runner", datetime.now())
+        tm.fail_attempt(task.task_id(), attempt.id(), "failed")
+    assert (tm.stats()["completed"], tm.stats()["failed"], tm.stats()["cancelled"]) == (3, 2, 1)
+
+    # batches of at most max_tasks, oldest first
+    assert [task.task_id() for task in tm.compact(datetime.now(), max_tasks=1)] == [1]
+    assert sorted(task.task_id() for task in tm.compact(datetime.now())) == [4]
+    assert (tm.stats()["completed"], tm.stats()["failed"], tm.stats()["cancelled"]) == (2, 1, 1)
+    assert tm.task(1) is None
+    assert tm.compact(datetime.now()) == []
+
+    # by age
+    later = datetime.now() + timedelta(seconds=61)
+    assert sorted(task.task_id() for task in tm.compact(later)) == [2, 3]
+    assert tm.stats()["completed"] == 0
+
+    # nothing is compacted without a retention policy
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now()))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.complete_attempt(1, attempt.id(), datetime.now())
+    assert tm.compact(datetime.now() + timedelta(days=365)) == []
+
+
+def test_delete_tasks():
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", datetime.now(), name="nightly"))
+    tm.add_task(Task(2, "run command example", datetime.now(), name="nightly"))
+    tm.add_task(Task(3, "run command example", datetime.now(), name="hourly"))
+    task, attempt = tm.start_next_attempt("runner", datetime.now())
+    tm.complete_attempt(1, attempt.id(), datetime.now())
+
+    deleted, cursor = tm.delete_tasks(list_types=["completed"], name="nightly")
+    assert ([task.task_id() for task in deleted], cursor) == ([1], None)
+    assert tm.task(2) is not None
+
+    deleted, cursor = tm.delete_tasks(limit=1)
+    assert [task.task_id() for task in deleted] == [2]
+    deleted, cursor = tm.delete_tasks(cursor=cursor, limit=1)
+    assert ([task.task_id() for task in deleted], cursor) == ([3], None)
+    assert tm.stats()["todo"] == 0
+
+
+def test_speculative_backup_attempt():
+    tm = TaskManager(LOGGER, speculate_quantile=0.9)
+    start = datetime(2019, 1, 1, 12, 0, 0)
+    for task_id in range(10):
+        tm.add_task(Task(task_id, "run command example", start, name="build", max_attempts=2))
+        task, attempt = tm.start_next_attempt("runner", start)
+        tm.complete_attempt(task_id, attempt.id(), start + timedelta(seconds=10 + task_id))
+
+    tm.add_task(Task(10, "run command example", start, name="build", max_attempts=2))
+    tm.add_task(Task(11, "run command example", start, name="build", max_attempts=2))
+    slow, slow_attempt = tm.start_next_attempt("slow runner", start)
+    assert slow.task_id() == 10
+    # new work comes before backups
+    task, attempt = tm.start_next_attempt("runner", start + timedelta(seconds=30))
+    assert task.task_id() == 11
+    tm.complete_attempt(11, attempt.id(), start + timedelta(seconds=31))
+
+    # not yet past the 0.9 quantile of its peers' runtimes (19 seconds)
+    assert tm.start_next_attempt("runner", start + timedelta(seconds=15)) == (None, None)
+    task, backup = tm.start_next_attempt("runner", start + timedelta(seconds=40))
+    assert task.task_id() == 10
+    assert tm.stats()["attempts_in_flight"] == 2
+    assert tm.start_next_attempt("other runner", start + timedelta(seconds=60)) == (None, None)
+
+    # the first to complete wins and the other attempt is no longer wanted
+    tm.complete_attempt(10, backup.id(), start + timedelta(seconds=50))
+    assert [t.task_id() for t in tm.completed_tasks()][-1] == 10
+    assert not tm.heartbeat(10, slow_attempt.id(), start + timedelta(seconds=55))
+    assert [r["attempts"] for r in tm.runners() if r["runner"] == "slow runner"] == [[]]
+
+    # nothing is backed up unless asked for
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", start, name="build", max_attempts=2))
+    tm.start_next_attempt("slow runner", start)
+    assert tm.start_next_attempt("runner", start + timedelta(days=1)) == (None, None)
+
+
+def test_failed_backup_leaves_the_task_to_the_attempt_it_backs_up():
+    tm = TaskManager(LOGGER, speculate_quantile=0.9)
+    start = datetime(2019, 1, 1, 12, 0, 0)
+    for task_id in range(10):
+        tm.add_task(Task(task_id, "run command example", start, name="build", max_attempts=2))
+        task, attempt = tm.start_next_attempt("runner", start)
+        tm.complete_attempt(task_id, attempt.id(), start + timedelta(seconds=10))
+
+    tm.add_task(Task(10, "run command example", start, name="build", max_attempts=2))
+    tm.add_task(Task(11, "run other command", start, dependent_on=[10]))
+    slow, slow_attempt = tm.start_next_attempt("slow runner", start)
+    task, backup = tm.start_next_attempt("runner", start + timedelta(seconds=40))
+    assert task.task_id() == 10
+
+    # the backup was the last attempt allowed but the attempt it backs up is still running
+    tm.fail_attempt(10, backup.id(), "failed", time_stamp=start + timedelta(seconds=45))
+    assert tm.stats()["failed"] == 0
+    assert tm.start_next_attempt("runner", start + timedelta(seconds=46)) == (None, None)
+    assert tm.heartbeat(10, slow_attempt.id(), start + timedelta(seconds=50), runner="slow runner")
+
+    tm.complete_attempt(10, slow_attempt.id(), start + timedelta(seconds=60))
+    task, attempt = tm.start_next_attempt("runner", start + timedelta(seconds=61))
+    assert task.task_id() == 11
+    tm.complete_attempt(11, attempt.id(), start + timedelta(seconds=62))
+    stats = tm.stats()
+    assert (stats["completed"], stats["failed"], stats["cancelled"]) == (12, 0, 0)
+
+    # once nothing of it is running the task fails
+    tm.add_task(Task(12, "run command example", start, name="build", max_attempts=2))
+    slow, slow_attempt = tm.start_next_attempt("slow runner", start)
+    task, backup = tm.start_next_attempt("runner", start + timedelta(seconds=40))
+    tm.fail_attempt(12, backup.id(), "failed", time_stamp=start + timedelta(seconds=45))
+    tm.fail_attempt(12, slow_attempt.id(), "failed", time_stamp=start + timedelta(seconds=46))
+    assert [t.task_id() for t in tm.failed_tasks()] == [12]
+
+
+def test_learned_runtimes():
+    tm = TaskManager(LOGGER, adaptive_timeout=2)
+    start = datetime(2019, 1, 1, 12, 0, 0)
+    for task_id in range(10):
+        tm.add_task(Task(task_id, "process --day 2019-01-%02d" % (task_id + 1), start, max_attempts=2))
+        task, attempt = tm.start_next_attempt("runner", start)
+        tm.complete_attempt(task_id, attempt.id(), start + timedelta(seconds=10))
+
+    task = Task(10, "process --day 2019-01-11", start, max_attempts=2)
+    assert TaskManager.task_family(task) == "process --day #-#-#"
+    assert tm.expected_duration(task) == pytest.approx(10)
+    assert tm.expected_duration(Task(11, "other", start)) == TaskManager.DEFAULT_EXPECTED_DURATION
+    assert tm.expected_duration(Task(12, "other", start, duration=5)) == 5
+
+    # without a duration it times out after twice the family's 99th percentile
+    tm.add_task(task)
+    task, attempt = tm.start_next_attempt("runner", start)
+    assert tm.start_next_attempt("runner", start + timedelta(seconds=15)) == (None, None)
+    task, attempt = tm.start_next_attempt("runner", start + timedelta(seconds=25))
+    assert (task.task_id(), task.num_attempts()) == (10, 2)
+
+    # not without adaptive timeouts
+    tm = TaskManager(LOGGER)
+    for task_id in range(10):
+        tm.add_task(Task(task_id, "process", start))
+        task, attempt = tm.start_next_attempt("runner", start)
+        tm.complete_attempt(task_id, attempt.id(), start + timedelta(seconds=10))
+    tm.add_task(Task(10, "process", start, max_attempts=2))
+    tm.start_next_attempt("runner", start)
+    assert tm.start_next_attempt("runner", start + timedelta(days=1)) == (None, None)
+
+
+def test_delayed_task():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, not_before=now + timedelta(seconds=60)))
+    tm.add_task(Task(2, "run command example", now))
+    tm.add_task(Task(3, "run command example", now, dependent_on=[2], not_before=now + timedelta(seconds=30)))
+    # already due
+    tm.add_task(Task(4, "run command example", now, not_before=now))
+    stats = tm.stats()
+    assert (stats["todo"], stats["ready"], stats["delayed"], stats["blocked"]) == (4, 2, 2, 0)
+
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 2
+    tm.complete_attempt(2, attempt.id(), now)
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 4
+    # 3 has its dependency but isn't due yet
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=10)) == (None, None)
+    task, attempt = tm.start_next_attempt("runner", now + timedelta(seconds=30))
+    assert task.task_id() == 3
+    task, attempt = tm.start_next_attempt("runner", now + timedelta(seconds=60))
+    assert task.task_id() == 1
+    assert tm.stats()["delayed"] == 0
+
+
+def test_expired_task():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, expires_at=now + timedelta(seconds=60),
+                     not_before=now + timedelta(seconds=30)))
+    tm.add_task(Task(2, "run command example", now, dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", now, expires_at=now + timedelta(seconds=60)))
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 3
+
+    # 3 was attempted in time so it doesn't expire
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=90)) == (None, None)
+    assert tm.task(1).cancel_reason == TaskManager.EXPIRED
+    assert tm.task(2).cancel_reason == TaskManager.UPSTREAM_EXPIRED
+    assert tm.task(3).cancel_reason is None
+    stats = tm.stats()
+    assert (stats["todo"], stats["delayed"], stats["cancelled"], stats["in_process"]) == (0, 0, 2, 1)
+
+    tm.add_task(Task(4, "run command example", now, not_before=now + timedelta(seconds=30)))
+    tm.delete_task(4)
+    assert tm.stats()["delayed"] == 0
+
+
+def test_retry_backoff():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, max_attempts=3, retry_delay=10, retry_multiplier=2))
+    tm.add_task(Task(2, "run command example", now, max_attempts=3))
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.fail_attempt(1, attempt.id(), "failed", time_stamp=now)
+    stats = tm.stats()
+    assert (stats["in_process"], stats["retries_pending"], stats["retries_waiting"]) == (1, 1, 1)
+
+    # 1 waits, so 2 goes first
+    task, attempt = tm.start_next_attempt("runner", now + timedelta(seconds=5))
+    assert task.task_id() == 2
+    tm.complete_attempt(2, attempt.id(), now + timedelta(seconds=6))
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=9)) == (None, None)
+    task, attempt = tm.start_next_attempt("runner", now + timedelta(seconds=10))
+    assert (task.task_id(), task.num_attempts()) == (1, 2)
+
+    # the second failure waits twice as long
+    tm.fail_attempt(1, attempt.id(), "failed", time_stamp=now + timedelta(seconds=10))
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=29)) == (None, None)
+    task, attempt = tm.start_next_attempt("runner", now + timedelta(seconds=30))
+    assert (task.task_id(), task.num_attempts()) == (1, 3)
+    tm.fail_attempt(1, attempt.id(), "failed", time_stamp=now + timedelta(seconds=30))
+    assert [t.task_id() for t in tm.failed_tasks()] == [1]
+    assert tm.stats()["retries_waiting"] == 0
+
+
+def test_fail_report_after_last_attempt_timed_out():
+    tm = TaskManager(LOGGER)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, duration=10))
+    task, attempt = tm.start_next_attempt("runner", now)
+    # the only attempt times out, so the task is failed
+    assert tm.start_next_attempt("other", now + timedelta(seconds=11)) == (None, None)
+    assert [t.task_id() for t in tm.failed_tasks()] == [1]
+    changes = len(tm.changes(0)[0])
+    done_time = tm._done.done_time(1)
+
+    # the runner reports the failure late and the task is left as it was
+    tm.fail_attempt(1, attempt.id(), "failed", time_stamp=now + timedelta(seconds=12))
+    assert [t.task_id() for t in tm.failed_tasks()] == [1]
+    assert tm.stats()["queues"]["default"]["failed"] == 1
+    assert tm._done.done_time(1) == done_time
+    assert [change for change in tm.changes(0)[0][changes:] if change["event"] == "done"] == []
+
+
+def test_result_cache():
+    tm = TaskManager(LOGGER, result_cache_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    key = Task.command_cache_key("run command example")
+    assert key == Task.command_cache_key("run command example")
+    assert key != Task.command_cache_key("run other command")
+
+    tm.add_task(Task(1, "run command example", now, cache_key=key))
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.complete_attempt(1, attempt.id(), now + timedelta(seconds=10))
+
+    # within the ttl it is completed right away
+    tm.add_task(Task(2, "run command example", now + timedelta(seconds=30), cache_key=key))
+    assert tm.task(2).is_completed()
+    assert tm.task(2).cached_from == 1
+    # without a cache key or after the ttl it runs
+    tm.add_task(Task(3, "run command example", now + timedelta(seconds=30)))
+    tm.add_task(Task(4, "run command example", now + timedelta(seconds=71), cache_key=key))
+    assert tm.stats()["ready"] == 2
+    assert tm.stats()["completed"] == 2
+
+    # caching is opt in
+    tm = TaskManager(LOGGER)
+    tm.add_task(Task(1, "run command example", now, cache_key=key))
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.complete_attempt(1, attempt.id(), now)
+    tm.add_task(Task(2, "run command example", now, cache_key=key))
+    assert not tm.task(2).is_completed()
+
+
+def test_coalesced_tasks():
+    tm = TaskManager(LOGGER, result_cache_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    for task_id in range(1, 4):
+        tm.add_task(Task(task_id, "run command example", now, cache_key="build"))
+    stats = tm.stats()
+    assert (stats["ready"], stats["coalesced"], stats["blocked"]) == (1, 2, 0)
+
+    # the leader fails so the next one stands in for the rest
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 1
+    tm.fail_attempt(1, attempt.id(), "failed")
+    assert tm.stats()["coalesced"] == 1
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 2
+    assert tm.start_next_attempt("runner", now) == (None, None)
+
+    # one attempt completes every task riding on it
+    tm.add_task(Task(4, "run command example", now, cache_key="build"))
+    tm.delete_task(3)
+    tm.complete_attempt(2, attempt.id(), now + timedelta(seconds=5))
+    assert tm.task(4).cached_from == 2
+    stats = tm.stats()
+    assert (stats["todo"], stats["coalesced"], stats["completed"], stats["failed"]) == (0, 0, 2, 1)
+
+
+def test_waiting_task_does_not_hold_up_its_cache_key():
+    tm = TaskManager(LOGGER, result_cache_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now))
+    # 2 waits on 1 and 3 waits until later, so neither stands in for 4
+    tm.add_task(Task(2, "run command example", now, cache_key="build", dependent_on=[1]))
+    tm.add_task(Task(3, "run command example", now, cache_key="build", not_before=now + timedelta(seconds=30)))
+    tm.add_task(Task(4, "run command example", now, cache_key="build"))
+    stats = tm.stats()
+    assert (stats["ready"], stats["coalesced"], stats["blocked"], stats["delayed"]) == (2, 0, 1, 1)
+    task1, attempt1 = tm.start_next_attempt("runner", now)
+    task4, attempt4 = tm.start_next_attempt("runner", now)
+    assert [task1.task_id(), task4.task_id()] == [1, 4]
+
+    # once 2 is ready it rides on 4, which is running
+    tm.complete_attempt(1, attempt1.id(), now + timedelta(seconds=1))
+    assert tm.stats()["coalesced"] == 1
+    tm.complete_attempt(4, attempt4.id(), now + timedelta(seconds=2))
+    assert tm.task(2).cached_from == 4
+
+    # and 3 gets the result when it is due
+    assert tm.start_next_attempt("runner", now + timedelta(seconds=30)) == (None, None)
+    assert tm.task(3).cached_from == 4
+    stats = tm.stats()
+    assert (stats["todo"], stats["completed"]) == (0, 4)
+
+
+def test_dependent_due_with_its_cache_hit_is_made_ready_once():
+    tm = TaskManager(LOGGER, result_cache_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    tm.add_task(Task(1, "run command example", now, cache_key="build"))
+    task, attempt = tm.start_next_attempt("runner", now)
+    tm.complete_attempt(1, attempt.id(), now)
+    # 2 is completed from the cache when it is due, which releases 3 in the same batch of due timers
+    later = now + timedelta(seconds=30)
+    tm.add_task(Task(2, "run command example", now, cache_key="build", not_before=later))
+    tm.add_task(Task(3, "run other command", now, cache_key="test", dependent_on=[2], not_before=later))
+    tm.fire_timers(later)
+    assert tm.task(2).cached_from == 1
+    stats = tm.stats()
+    assert (stats["ready"], stats["coalesced"], stats["delayed"]) == (1, 0, 0)
+
+    task, attempt = tm.start_next_attempt("runner", later)
+    assert task.task_id() == 3
+    tm.complete_attempt(3, attempt.id(), later)
+    # once 3's result is gone from the cache the next task with its key runs instead of riding on 3
+    tm.add_task(Task(4, "run other command", later + timedelta(seconds=61), cache_key="test"))
+    stats = tm.stats()
+    assert (stats["ready"], stats["coalesced"]) == (1, 0)
+
+
+def test_deleted_cache_leader_hands_over():
+    tm = TaskManager(LOGGER, result_cache_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    for task_id in range(1, 4):
+        tm.add_task(Task(task_id, "run command example", now, cache_key="build"))
+    tm.delete_task(1)
+    stats = tm.stats()
+    assert (stats["ready"], stats["coalesced"]) == (1, 1)
+    task, attempt = tm.start_next_attempt("runner", now)
+    assert task.task_id() == 2
+    tm.complete_attempt(2, attempt.id(), now + timedelta(seconds=1))
+    assert tm.task(3).cached_from == 2
+
+
+def test_idempotency_key():
+    tm = TaskManager(LOGGER, idempotency_ttl=60)
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    task = Task(1, "run command example", now)
+    assert tm.add_task(task, idempotency_key="load-1") is task
+    assert tm.add_task(Task(2, "run command example", now + timedelta(seconds=5)), idempotency_key="load-1") is task
+    assert tm.task(2) is None
+    assert tm.add_task(Task(3, "run command example", now), idempotency_key="load-2").task_id() == 3
+    assert tm.stats()["todo"] == 2
+
+    # once the key is forgotten, or its task is gone, it adds again
+    assert tm.add_task(Task(4, "run command example", now + timedelta(seconds=61)),
+                       idempotency_key="load-1").task_id() == 4
+    tm.delete_task(3)
+    assert tm.add_task(Task(5, "run command example", now), idempotency_key="load-2").task_id() == 5
@@ -0,0 +1,48 @@
+"""
+Copyright 2019 Peter F Nabicht, Big Shoulders Software
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+ documentation files (the "Software"), to deal in the Software without restriction, including without
+ limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+ the Software, and to permit persons to whom the Software is furnished to do so, subject to the following
+ conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions
+ of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+ TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ DEALINGS IN THE SOFTWARE.
+"""
+
+from simple_task_server import Timers
+from datetime import datetime
+from datetime import timedelta
+
+
+def test_due():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    timers = Timers()
+    timers.add(1, now + timedelta(seconds=20))
+    timers.add(2, now + timedelta(seconds=10))
+    timers.add(3, now + timedelta(seconds=30))
+    assert len(timers) == 3
+    assert timers.due(now) == []
+    assert timers.due(now + timedelta(seconds=20)) == [2, 1]
+    assert 1 not in timers
+    assert 3 in timers
+    assert timers.when(3) == now + timedelta(seconds=30)
+    assert len(timers) == 1
+
+
+def test_remove_and_move():
+    now = datetime(2019, 1, 1, 12, 0, 0)
+    timers = Timers()
+    timers.add(1, now + timedelta(seconds=10))
+    timers.add(2, now + timedelta(seconds=10))
+    timers.remove(1)
+    timers.remove(4)
+    # adding again moves it
+    timers.add(2, now + timedelta(seconds=30))
+    assert timers.due(now + timedelta(seconds=20)) == []
+    assert timers.due(now + timedelta(seconds=30)) == [2]
+    assert len(timers) == 0